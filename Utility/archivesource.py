@@ -0,0 +1,120 @@
+import glob
+import hashlib
+import os
+import typing
+import zipfile
+
+from integrity import IntegrityError, IntegrityManifest
+from sinks import getMemberParts
+from sync import FileEntry
+
+# Archive-only transport: the USB stick carries just the downloaded zip and an index of it,
+#     CodeArchive\<branch>.zip         - exactly as it came from GitHub
+#     CodeArchive\<branch>.index.json  - the same record as "NewCode.manifest.json" (see integrity.py): the archive's
+#                                        ETag and SHA-256, and the size, timestamp and SHA-256 of every file in it
+# rather than thousands of small files under `NewCode`, which are the slowest thing a flash stick can write (and the
+# updater then reads them all back one by one)
+# The updater extracts each new or changed file straight from the zip into the staging directory next to `Code`, on
+# the PC's own disk, checking it against the index as it goes, so the stick only ever reads one big file
+# The index is built as the download finishes by reading the zip back once (see pipeline.indexZipFile())
+copyBufferSize = 1024 * 1024
+indexSuffix = ".index.json"
+
+
+def getMemberPath(name: str) -> typing.Optional[str]:
+    # The path a member is extracted to, relative to where it is extracted (as sinks.safeMemberPath())
+    parts = getMemberParts(name)
+    return "/".join(parts) if parts else None
+
+
+def getTopLevelFolder(files: typing.Dict[str, FileEntry]) -> str:
+    # GitHub puts everything in the archive under a single "Jinn-<branch>" folder
+    folders = sorted({relPath.split("/")[0] for relPath in files if "/" in relPath})
+    return folders[0] if folders else ""
+
+
+def listArchives(zipDirPath: str) -> typing.List[str]:
+    # The branches with an archive and its index in zipDirPath
+    branches = []
+    for indexPath in sorted(glob.glob(os.path.join(zipDirPath, "*" + indexSuffix))):
+        branch = os.path.basename(indexPath)[:-len(indexSuffix)]
+        if os.path.exists(os.path.join(zipDirPath, "{}.zip".format(branch))):
+            branches.append(branch)
+    return branches
+
+
+class ZipSource:
+    """The code in an archive on the USB stick, as a source for building the staging directory (see install.py)"""
+    # Holds the zip open, so use it in a `with` statement
+
+    def __init__(self, zipFilePath: str, index: IntegrityManifest):
+        self.zipFilePath = zipFilePath
+        self.index = index
+        self.prefix = getTopLevelFolder(index.files)
+        self.files = index.getFiles(self.prefix)
+        self.zip = zipfile.ZipFile(zipFilePath, 'r')
+        self.members = {}
+        self.memberDirectories = set()
+        for info in self.zip.infolist():
+            memberPath = getMemberPath(info.filename)
+            if memberPath is None or (self.prefix and not memberPath.startswith(self.prefix + "/")):
+                continue
+            relPath = memberPath[len(self.prefix) + 1:] if self.prefix else memberPath
+            if info.is_dir():
+                self.memberDirectories.add(relPath)
+            else:
+                self.members[relPath] = info
+
+    def getDescription(self) -> str:
+        return "archive \"{}\"".format(self.zipFilePath)
+
+    def manifest(self) -> typing.Dict[str, FileEntry]:
+        # A zip which isn't the one indexed (e.g. a later download which never finished indexing) is caught here,
+        # before anything is extracted
+        expectedSize = self.index.archive.get("size")
+        if expectedSize is not None and os.path.getsize(self.zipFilePath) != expectedSize:
+            raise IntegrityError("\"{}\" is not the archive which was downloaded ({} bytes, expected {})"
+                                 .format(self.zipFilePath, os.path.getsize(self.zipFilePath), expectedSize))
+        missing = sorted(relPath for relPath, entry in self.files.items()
+                         if relPath not in self.members or self.members[relPath].file_size != entry.size)
+        if missing:
+            raise IntegrityError("\"{}\" does not match its index: {} file(s) missing or the wrong size"
+                                 .format(self.zipFilePath, len(missing)))
+        return dict(self.files)
+
+    def directories(self) -> typing.Set[str]:
+        directories = {"."}
+        for relPath in list(self.files) + list(self.memberDirectories):
+            parts = relPath.split("/")
+            # A file's parents, or a (possibly empty) directory and its parents
+            parts = parts if relPath in self.memberDirectories else parts[:-1]
+            for i in range(1, len(parts) + 1):
+                directories.add("/".join(parts[:i]))
+        return directories
+
+    def copyFile(self, relPath: str, targetPath: str):
+        # Extract one member to targetPath, checking its SHA-256 on the way through
+        entry = self.files[relPath]
+        sha = hashlib.sha256()
+        with self.zip.open(self.members[relPath]) as source, open(targetPath, 'wb') as target:
+            while True:
+                data = source.read(copyBufferSize)
+                if not data:
+                    break
+                sha.update(data)
+                target.write(data)
+        if sha.hexdigest() != entry.hash:
+            os.unlink(targetPath)
+            raise IntegrityError("\"{}\" in \"{}\" is not the file which was downloaded (SHA-256 {}, expected {})"
+                                 .format(relPath, self.zipFilePath, sha.hexdigest(), entry.hash))
+        if entry.mtime is not None:
+            os.utime(targetPath, (entry.mtime, entry.mtime))
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,339 @@
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import typing
+import zipfile
+
+import updatevariables
+from connections import BandwidthLimiter
+from pipeline import downloadZipFile, extractFromZipFile, streamZipFile, stageNewCode, installStagedCode
+from updatevariables import UpdateVariables
+
+# Benchmark for the download/extract/update pipeline, run from the command line (no Qt needed):
+#     python benchmark.py --output results.json
+#     python benchmark.py --baseline results.json          (compare against an earlier run)
+# Each scenario is a synthetic archive of a particular shape, served from a local HTTP server
+# (optionally throttled to the speed of the office link, or per connection with added latency, which is what
+# limits a single connection over a long distance), and each step is timed on its own:
+#     download    - downloadZipFile()            extract     - extractFromZipFile()
+#     clear       - clearExtractedFolder()       stream      - streamZipFile() (download and extract together)
+#     segmented   - downloadZipFile() over several connections at once (download is always one)
+#     update      - stageNewCode() + installStagedCode() into an empty Jinn\Code
+#     incremental - the same again, with nothing changed
+# Archives are generated from a fixed seed, so two runs with the same arguments time exactly the same work
+# Everything happens in a temporary directory, never next to this script (i.e. on the USB stick)
+LogFunc = typing.Callable[[str], None]
+
+phases = ["download", "extract", "clear", "segmented", "stream", "update", "incremental"]
+# Phases whose throughput is measured against the archive's size, the rest against the extracted size
+archivePhases = {"download", "segmented", "stream"}
+branch = "benchmark"
+chunkSize = 64 * 1024
+
+
+def textBytes(rng: random.Random, size: int) -> bytes:
+    # Compresses roughly like source code does
+    words = [b"def", b"self", b"return", b"import", b"for", b"in", b"if", b"None", b"value", b"name", b"\n    "]
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return b" ".join(parts)[:size]
+
+
+def binaryBytes(rng: random.Random, size: int) -> bytes:
+    # Doesn't compress at all, like images or installers
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def tinyFiles(rng: random.Random, scale: float):
+    for i in range(int(5000 * scale)):
+        yield "pkg{}/module{}.py".format(i // 100, i), textBytes(rng, rng.randint(100, 2000))
+
+
+def largeBinaries(rng: random.Random, scale: float):
+    for i in range(4):
+        yield "resources/blob{}.bin".format(i), binaryBytes(rng, int(16 * 1024 * 1024 * scale))
+    for i in range(20):
+        yield "module{}.py".format(i), textBytes(rng, 4000)
+
+
+def deepTree(rng: random.Random, scale: float):
+    for i in range(int(1000 * scale)):
+        depth = rng.randint(1, 16)
+        yield "/".join("level{}".format(rng.randint(0, 2)) for _ in range(depth)) + "/file{}.py".format(i), \
+            textBytes(rng, rng.randint(100, 4000))
+
+
+def mixed(rng: random.Random, scale: float):
+    # Roughly the shape of the Jinn repository
+    for i in range(int(2000 * scale)):
+        yield "jinn/package{}/module{}.py".format(i // 50, i), textBytes(rng, rng.randint(500, 20000))
+    for i in range(int(20 * scale)):
+        yield "GUI/images/image{}.png".format(i), binaryBytes(rng, 200 * 1024)
+    for i in range(2):
+        yield "tools/tool{}.exe".format(i), binaryBytes(rng, int(8 * 1024 * 1024 * scale))
+
+
+scenarios = {
+    "tiny-files": tinyFiles,
+    "large-binaries": largeBinaries,
+    "deep-tree": deepTree,
+    "mixed": mixed,
+}
+
+
+def buildArchive(scenario: str, scale: float, seed: int) -> typing.Tuple[bytes, int, int]:
+    # Returns (archive, number of files, total extracted size)
+    rng = random.Random("{}-{}".format(scenario, seed))
+    buffer = io.BytesIO()
+    count = 0
+    size = 0
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, data in scenarios[scenario](rng, scale):
+            # A fixed timestamp too, so the archive is byte for byte the same every run
+            info = zipfile.ZipInfo("Jinn-{}/{}".format(branch, name), (2020, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zip_ref.writestr(info, data)
+            count += 1
+            size += len(data)
+    return buffer.getvalue(), count, size
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the current archive like GitHub does: ETag, Range requests, keep-alive"""
+    protocol_version = "HTTP/1.1"
+    archive = b""
+    etag = ""
+    limiter = None
+    # Bytes per second for each response on its own, and seconds before each response starts
+    connectionBytesPerSecond = None
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        archive = ArchiveHandler.archive
+        etag = ArchiveHandler.etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if ArchiveHandler.latency:
+            time.sleep(ArchiveHandler.latency)
+        start = 0
+        end = len(archive)
+        rangeHeader = self.headers.get("Range")
+        if rangeHeader and rangeHeader.startswith("bytes=") and self.headers.get("If-Range") in (None, etag):
+            first, last = rangeHeader[6:].split("-")
+            start = min(int(first), len(archive))
+            end = min(int(last) + 1, len(archive)) if last else len(archive)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, len(archive)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        connectionLimiter = None
+        if ArchiveHandler.connectionBytesPerSecond:
+            connectionLimiter = BandwidthLimiter(ArchiveHandler.connectionBytesPerSecond)
+            # No free first second for each new connection, which would favour more of them
+            connectionLimiter.available = 0.0
+        for offset in range(start, end, chunkSize):
+            chunk = archive[offset:min(offset + chunkSize, end)]
+            for limiter in (ArchiveHandler.limiter, connectionLimiter):
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+            self.wfile.write(chunk)
+
+
+def startServer(bytesPerSecond: int = None, connectionBytesPerSecond: int = None,
+                latency: float = 0.0) -> http.server.ThreadingHTTPServer:
+    ArchiveHandler.limiter = BandwidthLimiter(bytesPerSecond) if bytesPerSecond else None
+    ArchiveHandler.connectionBytesPerSecond = connectionBytesPerSecond
+    ArchiveHandler.latency = latency
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class BenchmarkVariables(UpdateVariables):
+    """UpdateVariables pointing at the benchmark's own directory and server"""
+    workDir = None
+    serverUrl = None
+
+    def __init__(self):
+        super().__init__(branch)
+        self.zipFileUrl = BenchmarkVariables.serverUrl
+
+    def setRootDir(self):
+        updatevariables.rootDir = BenchmarkVariables.workDir
+        return BenchmarkVariables.workDir
+
+
+def timePhase(timings: typing.Dict[str, typing.List[float]], name: str, func: typing.Callable[[], typing.Any]):
+    start = time.perf_counter()
+    func()
+    timings.setdefault(name, []).append(time.perf_counter() - start)
+
+
+def runOnce(workDir: str, log: LogFunc, timings: typing.Dict[str, typing.List[float]]):
+    # One pass of every phase, in a fresh directory
+    if os.path.exists(workDir):
+        shutil.rmtree(workDir)
+    os.makedirs(workDir)
+    BenchmarkVariables.workDir = workDir
+    uv = BenchmarkVariables()
+    os.makedirs(uv.getZipExtractedDir(), exist_ok=True)
+    codeDirPath = os.path.join(workDir, "Jinn", "Code")
+
+    uv.downloadSegments = 1
+    timePhase(timings, "download", lambda: downloadZipFile(log, uv))
+    timePhase(timings, "extract", lambda: extractFromZipFile(log, uv))
+    timePhase(timings, "clear", lambda: BenchmarkVariables().clearExtractedFolder())
+    # Nothing left to make the request conditional, so the whole archive again
+    timePhase(timings, "segmented", lambda: downloadZipFile(log, BenchmarkVariables()))
+    timePhase(timings, "stream", lambda: streamZipFile(log, BenchmarkVariables()))
+
+    def update():
+        stageNewCode(log, BenchmarkVariables(), codeDirPath)
+        installStagedCode(log, BenchmarkVariables(), codeDirPath)
+    timePhase(timings, "update", update)
+    timePhase(timings, "incremental", update)
+
+
+def summarise(runs: typing.List[float], size: int) -> dict:
+    median = statistics.median(runs)
+    return {"runs": [round(run, 4) for run in runs], "median": round(median, 4), "min": round(min(runs), 4),
+            "mbPerSecond": round(size / median / 1e6, 2) if median > 0 else None}
+
+
+def runScenario(scenario: str, args, log: LogFunc) -> dict:
+    archive, fileCount, extractedSize = buildArchive(scenario, args.scale, args.seed)
+    ArchiveHandler.archive = archive
+    ArchiveHandler.etag = "\"{}\"".format(hashlib.sha1(archive).hexdigest())
+    print("{}: {} files, {:.1f} MB extracted, {:.1f} MB archive".format(
+        scenario, fileCount, extractedSize / 1e6, len(archive) / 1e6), file=sys.stderr)
+    timings = {}
+    for repeat in range(args.repeat):
+        runOnce(os.path.join(args.workdir, scenario), log, timings)
+    if not args.keep:
+        shutil.rmtree(os.path.join(args.workdir, scenario), ignore_errors=True)
+    return {"files": fileCount, "extractedBytes": extractedSize, "archiveBytes": len(archive),
+            "phases": {name: summarise(timings[name], len(archive) if name in archivePhases else extractedSize)
+                       for name in phases}}
+
+
+def compareWithBaseline(results: dict, baseline: dict, tolerance: float) -> typing.List[str]:
+    # Prints a table of median times against the baseline's, returns the phases which got slower
+    regressions = []
+    print("{:<16}{:<13}{:>10}{:>10}{:>8}".format("scenario", "phase", "baseline", "now", "ratio"), file=sys.stderr)
+    for scenario, result in results["scenarios"].items():
+        baseScenario = baseline.get("scenarios", {}).get(scenario)
+        if baseScenario is None:
+            continue
+        for name, phase in result["phases"].items():
+            basePhase = baseScenario["phases"].get(name)
+            if basePhase is None or not basePhase["median"]:
+                continue
+            ratio = phase["median"] / basePhase["median"]
+            verdict = ""
+            if ratio > 1 + tolerance:
+                verdict = "slower"
+                regressions.append("{}/{}".format(scenario, name))
+            elif ratio < 1 - tolerance:
+                verdict = "faster"
+            print("{:<16}{:<13}{:>9.3f}s{:>9.3f}s{:>7.2f}x {}".format(
+                scenario, name, basePhase["median"], phase["median"], ratio, verdict), file=sys.stderr)
+    return regressions
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Time the Jinn download/extract/update pipeline")
+    parser.add_argument("--scenario", action="append", choices=sorted(scenarios),
+                        help="scenario to run (may be repeated, default all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number and size of files")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each scenario, the median is reported")
+    parser.add_argument("--seed", type=int, default=1, help="seed for generating the archives")
+    parser.add_argument("--bandwidth", type=int, default=0,
+                        help="throttle the server to this many KB/s (default unlimited)")
+    parser.add_argument("--connection-bandwidth", type=int, default=0,
+                        help="throttle each connection to this many KB/s (default unlimited)")
+    parser.add_argument("--latency", type=int, default=0, help="milliseconds before each response (default 0)")
+    parser.add_argument("--workdir", help="where to run (default a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the working files afterwards")
+    parser.add_argument("--output", help="write the results to this JSON file (default standard output)")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction slower than the baseline counted as a regression (default 0.1)")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's log")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parseArgs(argv)
+    temporaryDir = None
+    if args.workdir is None:
+        temporaryDir = tempfile.mkdtemp(prefix="jinn-benchmark-")
+        args.workdir = temporaryDir
+    log = (lambda text: print(text, file=sys.stderr)) if args.verbose else (lambda text: None)
+
+    server = startServer(args.bandwidth * 1024, args.connection_bandwidth * 1024, args.latency / 1000)
+    BenchmarkVariables.serverUrl = "http://127.0.0.1:{}/archive".format(server.server_port)
+    try:
+        results = {
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpus": os.cpu_count()},
+            "settings": {"scale": args.scale, "repeat": args.repeat, "seed": args.seed,
+                         "bandwidthKBps": args.bandwidth, "connectionBandwidthKBps": args.connection_bandwidth,
+                         "latencyMs": args.latency},
+            "scenarios": {scenario: runScenario(scenario, args, log)
+                          for scenario in (args.scenario or sorted(scenarios))},
+        }
+    finally:
+        server.shutdown()
+        if temporaryDir is not None and not args.keep:
+            shutil.rmtree(temporaryDir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != results["settings"]:
+            print("Warning: the baseline was run with different settings {}".format(baseline.get("settings")),
+                  file=sys.stderr)
+        regressions = compareWithBaseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Slower than the baseline: {}".format(", ".join(regressions)), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import struct
+import typing
+
+# A binary diff of one version of a file against another, for delta packages (see delta.py)
+# A delta is a list of operations which rebuild the new file from the old one:
+#     copy(offset, length)  - bytes from the old file
+#     insert(data)          - bytes which are new
+# Matches are found as rsync finds them: the old file is indexed in fixed-size blocks, and the new one looked up
+# at every byte until a block matches, then the match is extended as far as it goes both ways, so an edit anywhere
+# (including one which shifts the rest of the file along) costs only the bytes around it
+# Unmatched bytes are the slow part (one lookup each, in Python), so a file which has changed throughout gives up
+# after maxUnmatched of them, and is sent whole instead
+magic = b"JDIF1"
+opCopy = 0
+opInsert = 1
+copyFormat = struct.Struct(">BQQ")
+insertFormat = struct.Struct(">BQ")
+
+# The index is on each block's first keySize bytes only (cheap to look up), then checked by extending the match
+keySize = 32
+minimumBlockSize = 64
+maximumBlockSize = 8192
+# A match must be at least this long to be worth a copy operation rather than inserting the bytes
+minimumMatch = 64
+maxUnmatched = 4 * 1024 * 1024
+compareChunk = 4096
+
+
+class DeltaError(Exception):
+    """A delta which does not fit the file it is applied to"""
+
+
+def getBlockSize(size: int) -> int:
+    # About the square root of the file's size (as rsync), a power of two
+    blockSize = minimumBlockSize
+    while blockSize * blockSize < size and blockSize < maximumBlockSize:
+        blockSize *= 2
+    return blockSize
+
+
+def extendForward(old: bytes, oldPos: int, new: bytes, newPos: int) -> int:
+    # How many bytes match from these positions on, a chunk at a time while they can
+    length = 0
+    while (newPos + length + compareChunk <= len(new) and oldPos + length + compareChunk <= len(old) and
+           new[newPos + length:newPos + length + compareChunk] == old[oldPos + length:oldPos + length + compareChunk]):
+        length += compareChunk
+    while (newPos + length < len(new) and oldPos + length < len(old) and
+           new[newPos + length] == old[oldPos + length]):
+        length += 1
+    return length
+
+
+def makeDelta(old: bytes, new: bytes) -> typing.Optional[bytes]:
+    # None if the files have too little in common to be worth it
+    blockSize = getBlockSize(len(old))
+    index = {}
+    for offset in range(0, len(old) - keySize + 1, blockSize):
+        index.setdefault(old[offset:offset + keySize], offset)
+
+    ops = [magic]
+    literalStart = 0
+    unmatched = 0
+    pos = 0
+    while pos <= len(new) - keySize:
+        offset = index.get(new[pos:pos + keySize])
+        length = extendForward(old, offset, new, pos) if offset is not None else 0
+        if length < minimumMatch:
+            pos += 1
+            unmatched += 1
+            if unmatched > maxUnmatched:
+                return None
+            continue
+        # Take the match back over any bytes just before it which match too
+        start = pos
+        while start > literalStart and offset > 0 and new[start - 1] == old[offset - 1]:
+            start -= 1
+            offset -= 1
+            length += 1
+        if start > literalStart:
+            ops.append(insertFormat.pack(opInsert, start - literalStart))
+            ops.append(new[literalStart:start])
+        ops.append(copyFormat.pack(opCopy, offset, length))
+        pos = literalStart = start + length
+    if literalStart < len(new):
+        ops.append(insertFormat.pack(opInsert, len(new) - literalStart))
+        ops.append(new[literalStart:])
+    return b"".join(ops)
+
+
+def applyDelta(old: bytes, delta: bytes) -> bytes:
+    if not delta.startswith(magic):
+        raise DeltaError("Not a delta")
+    parts = []
+    pos = len(magic)
+    while pos < len(delta):
+        op = delta[pos]
+        if op == opCopy:
+            _, offset, length = copyFormat.unpack_from(delta, pos)
+            pos += copyFormat.size
+            if offset + length > len(old):
+                raise DeltaError("The delta copies beyond the end of the old file, so was not made from it")
+            parts.append(old[offset:offset + length])
+        elif op == opInsert:
+            _, length = insertFormat.unpack_from(delta, pos)
+            pos += insertFormat.size
+            parts.append(delta[pos:pos + length])
+            pos += length
+        else:
+            raise DeltaError("Unknown delta operation {}".format(op))
+    return b"".join(parts)
@@ -0,0 +1,92 @@
+import glob
+import importlib.util
+import os
+import py_compile
+import sys
+import threading
+import typing
+
+# Keeps `__pycache__` next to the tools on the USB stick valid for whichever Python is running them, so a start
+# doesn't have to compile every module again (slow enough on its own, and the new .pyc is then written to the stick)
+# Python normally checks a .pyc by the source's timestamp, but FAT/exFAT store local time with 2 second resolution,
+# so moving the stick between the internet PC and the work PC (or a clock change) can make every .pyc look out of
+# date. Here they are written as "checked hash" .pycs instead, checked against a hash of the source's contents,
+# which Python keeps up to date itself from then on (see PEP 552)
+# Each Python version has its own .pyc files (e.g. "updater.cpython-39.pyc"), so the two PCs needn't match, and only
+# the running version's files are ever touched
+LogFunc = typing.Optional[typing.Callable[[str], None]]
+
+# Seconds after the window first appears before checking, so it doesn't compete with starting up
+refreshDelay = 2.0
+
+headerSize = 16
+# Flags in a .pyc header
+flagHashBased = 0b01
+flagCheckSource = 0b10
+
+
+def isCacheValid(sourcePath: str) -> bool:
+    # Whether there is a checked-hash .pyc for this Python which matches the source
+    try:
+        with open(importlib.util.cache_from_source(sourcePath), 'rb') as f:
+            header = f.read(headerSize)
+        with open(sourcePath, 'rb') as f:
+            source = f.read()
+    except OSError:
+        return False
+    if len(header) < headerSize or header[:4] != importlib.util.MAGIC_NUMBER:
+        return False
+    flags = int.from_bytes(header[4:8], 'little')
+    if flags != flagHashBased | flagCheckSource:
+        # A timestamp .pyc, or an unchecked one which would go on being used after the source changes
+        return False
+    return header[8:16] == importlib.util.source_hash(source)
+
+
+def getOrphanedCaches(directory: str) -> typing.List[str]:
+    # This Python's .pyc files whose source has gone, e.g. a module since removed from the stick
+    pattern = os.path.join(directory, "__pycache__", "*.{}.pyc".format(sys.implementation.cache_tag))
+    orphans = []
+    for cachePath in glob.glob(pattern):
+        moduleName = os.path.basename(cachePath).split(".")[0]
+        if not os.path.exists(os.path.join(directory, moduleName + ".py")):
+            orphans.append(cachePath)
+    return orphans
+
+
+def refreshBytecodeCache(directory: str, log: LogFunc = None) -> int:
+    # Compile each module in directory whose .pyc is missing, out of date or timestamp based
+    # Returns the number compiled; nothing is done if Python has been told not to write bytecode
+    if sys.dont_write_bytecode:
+        return 0
+    compiled = 0
+    for sourcePath in sorted(glob.glob(os.path.join(directory, "*.py"))):
+        if isCacheValid(sourcePath):
+            continue
+        try:
+            py_compile.compile(sourcePath, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+        except (OSError, py_compile.PyCompileError) as ex:
+            # e.g. a read-only stick, never worth failing over
+            if log is not None:
+                log("Could not compile \"{}\": {}".format(sourcePath, ex))
+            continue
+        compiled += 1
+    for cachePath in getOrphanedCaches(directory):
+        try:
+            os.unlink(cachePath)
+        except OSError:
+            pass
+    if compiled and log is not None:
+        log("{} module(s) compiled into \"{}\"".format(compiled, os.path.join(directory, "__pycache__")))
+    return compiled
+
+
+def refreshInBackground(directory: str = None, delay: float = refreshDelay) -> threading.Timer:
+    # Refresh the cache for the tools' directory (by default the one this module is in) on a background thread
+    # Only the next start benefits, so this one carries on regardless
+    if directory is None:
+        directory = os.path.dirname(os.path.realpath(__file__))
+    timer = threading.Timer(delay, refreshBytecodeCache, (directory,))
+    timer.daemon = True
+    timer.start()
+    return timer
@@ -0,0 +1,320 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+import typing
+
+from progressmodel import PipelineCancelled, ProgressMeter, ProgressThrottle
+from tracing import RunTrace
+from updatevariables import UpdateVariables
+
+# The downloader and updater without the GUI, for scripting or when there is no desktop to hand:
+#     python cli.py download [--branch HJinn] [--store | --archive-only | --delta] [--no-stream]
+#     python cli.py download --branches HJinn LJinn master [--limit 500]
+#     python cli.py download --packages [--index-url <url>]    (see wheelhouse.py)
+#     python cli.py update [--code-dir C:/Jinn/Code | --locate] [--from-branch LJinn | --from-archive LJinn |
+#                          --from-delta LJinn] [--full] [--packages]
+#     python cli.py update --dry-run    (what an update would do and how long it should take, changing nothing)
+#     python cli.py rollback [--list | --snapshot <path>]
+#     python cli.py locate
+#     python cli.py fleet     (the offline PCs this stick has updated, and the version each has)
+# It runs exactly the same steps as the dialogs (see jobs.py) and never imports Qt, so it also works where PyQt5
+# isn't installed
+# The log goes to standard output, progress to standard error (a single updating line when that is a terminal),
+# with the throughput and time left
+# Ctrl+C stops at the next safe point, just as the dialogs' Cancel does; a second Ctrl+C stops straight away
+# Exit status: 0 succeeded, 1 failed, 2 bad arguments, 130 cancelled
+# The pipeline (see jobs.py) is only imported by the commands which run it, so e.g. `--help` and `fleet` are quick
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+exitSucceeded = 0
+exitFailed = 1
+exitUsage = 2
+exitCancelled = 130
+
+branches = ["HJinn", "LJinn", "master"]
+defaultCodeDir = "C:/Jinn/Code"
+# How often the progress line is redrawn on a terminal, in seconds
+redrawInterval = 0.2
+# Otherwise (e.g. output to a log file) a line every this many percent
+percentStep = 10
+
+
+class TextProgress:
+    """Log and progress as text, safe to call from several threads (e.g. several branches downloading at once)"""
+
+    def __init__(self, stream: typing.TextIO = None):
+        self.stream = stream or sys.stderr
+        self.isTerminal = self.stream.isatty()
+        self.lock = threading.Lock()
+        self.lineOpen = False
+        self.lastDrawn = {}
+        # Throughput and time left for each phase (see progressmodel.py)
+        self.meters = {}
+        self.throttle = ProgressThrottle(redrawInterval)
+        self.cancelled = threading.Event()
+
+    def log(self, text: str):
+        with self.lock:
+            self.endLine()
+            print(text.rstrip("\n"), flush=True)
+
+    def endLine(self):
+        if self.lineOpen:
+            self.stream.write("\n")
+            self.lineOpen = False
+
+    def progressFor(self, name: str) -> ProgressFunc:
+        def progress(done: int, total: int):
+            # Called regularly by every step, so it doubles as the cancellation point, as in workers.PipelineWorker
+            if self.cancelled.is_set():
+                raise PipelineCancelled("Cancelled during \"{}\"".format(name))
+            self.show(name, done, total)
+        return progress
+
+    def show(self, name: str, done: int, total: int):
+        # Most calls are dropped straight away, only a few a second are worth measuring and drawing
+        if not self.throttle.isDue(name, done, total):
+            return
+        percent = done * 100 // total if total else None
+        with self.lock:
+            meter = self.meters.setdefault(name, ProgressMeter())
+            meter.update(done, total)
+            if self.isTerminal:
+                text = "{}: {}".format(name, meter.describe())
+                if percent is not None:
+                    text = "{}: {}%, {}".format(name, percent, meter.describe())
+                self.stream.write("\r{:<79}".format(text))
+                self.lineOpen = True
+            else:
+                # Only whole steps, and nothing at all when the total isn't known
+                last = self.lastDrawn.get(name)
+                if percent is None or (last is not None and percent // percentStep <= last // percentStep):
+                    return
+                self.lastDrawn[name] = percent
+                self.stream.write("{}: {}%, {}\n".format(name, percent, meter.describe()))
+            self.stream.flush()
+
+    def finish(self):
+        with self.lock:
+            self.endLine()
+            self.stream.flush()
+
+
+def installInterruptHandler(output: TextProgress):
+    def interrupt(signum, frame):
+        output.cancelled.set()
+        output.log("Stopping...")
+        # Leave a second Ctrl+C to do what it normally does
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, interrupt)
+
+
+def runRecorded(output: TextProgress, phases: typing.List[tuple], trace: RunTrace) -> int:
+    # Run the phases, keep their timings in the run history on the stick (see tracing.py), and give the exit status
+    from jobs import runPhases
+    from pipeline import recordRun
+    try:
+        runPhases(phases, output.log, output.progressFor, trace, output.cancelled.is_set)
+    except PipelineCancelled as ex:
+        output.finish()
+        output.log("{}".format(ex))
+        recordRun(output.log, UpdateVariables(), trace, "cancelled", str(ex))
+        return exitCancelled
+    except Exception as ex:
+        output.finish()
+        output.log("{} failed: {}".format(trace.kind.capitalize(), ex))
+        recordRun(output.log, UpdateVariables(), trace, "failed", str(ex))
+        return exitFailed
+    output.finish()
+    recordRun(output.log, UpdateVariables(), trace, "succeeded")
+    return exitSucceeded
+
+
+def doDownload(args, output: TextProgress) -> int:
+    from jobs import getDownloadPhases
+    from pipeline import setRootDir, checkNotRunningFromCodeDir
+    trace = RunTrace("download", ", ".join(args.branches) if args.branches else args.branch)
+    with trace.span("setup"):
+        updateVariables = UpdateVariables(args.branch)
+        checkNotRunningFromCodeDir(updateVariables)
+        # compute the root directory (`Jinn`) via where this script is being run from
+        output.log(setRootDir())
+    updateVariables.trace = trace
+    updateVariables.packageIndexUrl = args.index_url
+    bytesPerSecond = args.limit * 1024 if args.limit else None
+    phases = getDownloadPhases(updateVariables, not args.no_stream, args.store, args.branches, bytesPerSecond, trace,
+                               args.archive_only, args.delta, args.packages)
+    status = runRecorded(output, phases, trace)
+    if status == exitSucceeded:
+        output.log("Finished downloading the latest Jinn code. Plug this USB stick into your work PC and run the "
+                   "updater.")
+    return status
+
+
+def locateCodeDir(output: TextProgress) -> typing.Optional[str]:
+    # Only imported when needed, as the search is the only thing which uses it
+    from locator import locateJinnInstallations
+    possibleDirs = locateJinnInstallations(log=output.log)
+    if len(possibleDirs) != 1:
+        output.log("No Jinn installation could be found" if not possibleDirs else
+                   "More than one Jinn installation was found, please choose one with --code-dir:\n    " +
+                   "\n    ".join(possibleDirs))
+        return None
+    output.log("Using Jinn installation \"{}\"".format(possibleDirs[0]))
+    return possibleDirs[0]
+
+
+def doUpdate(args, output: TextProgress) -> int:
+    from jobs import getPlanPhases, getUpdatePhases, getTidyPhases, runPhases
+    from pipeline import checkNewCodeSource
+    codeDirPath = args.code_dir
+    if args.locate:
+        codeDirPath = locateCodeDir(output)
+        if codeDirPath is None:
+            return exitFailed
+    # Only a run which gets going is recorded in the run history, not one which could never have started
+    checkNewCodeSource(UpdateVariables(), args.from_branch, args.from_archive, args.from_delta)
+    if args.dry_run:
+        # Only what the update would do, nothing is changed (see planner.py)
+        trace = RunTrace("plan", args.from_branch or args.from_archive or args.from_delta)
+        updateVariables = UpdateVariables()
+        updateVariables.trace = trace
+        return runRecorded(output, getPlanPhases(updateVariables, codeDirPath, not args.full, args.compare_contents,
+                                                 args.from_branch, args.from_archive, args.from_delta), trace)
+    trace = RunTrace("update", args.from_branch or args.from_archive or args.from_delta)
+    updateVariables = UpdateVariables()
+    updateVariables.trace = trace
+    phases = getUpdatePhases(updateVariables, codeDirPath, not args.full, args.compare_contents, args.from_branch,
+                             args.from_archive, args.from_delta, args.packages)
+    status = runRecorded(output, phases, trace)
+    if status == exitSucceeded and not args.no_tidy:
+        # Unimportant, so a failure here is only reported and doesn't change the outcome
+        try:
+            runPhases(getTidyPhases(UpdateVariables(), codeDirPath), output.log, output.progressFor,
+                      isCancelled=output.cancelled.is_set)
+        except Exception as ex:
+            output.log("Tidying old versions stopped: {}".format(ex))
+        output.finish()
+    return status
+
+
+def doRollback(args, output: TextProgress) -> int:
+    from jobs import getRollbackPhases
+    from snapshots import listAllSnapshots
+    snapshots = listAllSnapshots(args.code_dir)
+    if args.list:
+        for snapshot in snapshots:
+            print(snapshot)
+        return exitSucceeded
+    snapshotPath = args.snapshot
+    if snapshotPath is None:
+        if not snapshots:
+            output.log("There is no previous version next to \"{}\" to roll back to".format(args.code_dir))
+            return exitFailed
+        snapshotPath = snapshots[0]
+    elif not os.path.isdir(snapshotPath):
+        output.log("\"{}\" does not exist".format(snapshotPath))
+        return exitFailed
+    trace = RunTrace("rollback")
+    updateVariables = UpdateVariables()
+    updateVariables.trace = trace
+    status = runRecorded(output, getRollbackPhases(updateVariables, args.code_dir, snapshotPath), trace)
+    if status == exitSucceeded:
+        output.log("\"{}\" is now the Jinn code again".format(snapshotPath))
+    return status
+
+
+def doLocate(args, output: TextProgress) -> int:
+    from locator import locateJinnInstallations
+    possibleDirs = locateJinnInstallations(log=output.log)
+    for path in possibleDirs:
+        print(path)
+    return exitSucceeded if possibleDirs else exitFailed
+
+
+def doFleet(args, output: TextProgress) -> int:
+    from fleet import loadFleet
+    for record in loadFleet(UpdateVariables().getFleetPath()):
+        print(record.describe())
+    return exitSucceeded
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Download and install the Jinn code without the GUI")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    download = commands.add_parser("download", help="download the latest code to this USB stick")
+    download.add_argument("--branch", choices=branches, default=branches[0],
+                          help="branch to download (default %(default)s)")
+    download.add_argument("--no-stream", action="store_true",
+                          help="save the zip file first, then extract it, rather than extracting while downloading")
+    # Where the code is kept on the stick, only one of these
+    keep = download.add_mutually_exclusive_group()
+    keep.add_argument("--store", action="store_true", help="keep the branch in the shared branch store")
+    keep.add_argument("--archive-only", action="store_true",
+                      help="keep only the zip file (and an index of it), to be extracted on the work PC")
+    keep.add_argument("--delta", action="store_true",
+                      help="put only the changes each work PC needs since its last update on the stick")
+    download.add_argument("--branches", nargs="+", choices=branches,
+                          help="download all of these branches at once into the shared branch store")
+    download.add_argument("--limit", type=int, default=0,
+                          help="bandwidth limit for --branches in KB/s (default unlimited)")
+    download.add_argument("--packages", action="store_true",
+                          help="put the Python packages the code needs on the stick too (needs pip, see wheelhouse.py)")
+    download.add_argument("--index-url",
+                          help="with --packages, the package index to get them from (default pip's, normally PyPI)")
+    download.set_defaults(func=doDownload)
+
+    update = commands.add_parser("update", help="install the code on this USB stick on this PC")
+    location = update.add_mutually_exclusive_group()
+    location.add_argument("--code-dir", default=defaultCodeDir, help="the Jinn Code directory (default %(default)s)")
+    location.add_argument("--locate", action="store_true", help="search this PC for the Jinn Code directory")
+    source = update.add_mutually_exclusive_group()
+    source.add_argument("--from-branch", choices=branches,
+                        help="install this branch from the shared branch store rather than the downloaded code")
+    source.add_argument("--from-archive", choices=branches,
+                        help="install this branch straight from its zip file (see download --archive-only)")
+    source.add_argument("--from-delta", choices=branches,
+                        help="install this branch by applying its changes to the code here (see download --delta)")
+    update.add_argument("--full", action="store_true", help="copy every file, not only the changed ones")
+    update.add_argument("--compare-contents", action="store_true", help="compare file contents (slower)")
+    update.add_argument("--no-tidy", action="store_true", help="leave old versions as they are afterwards")
+    update.add_argument("--packages", action="store_true",
+                        help="install the Python packages the code needs from the USB stick (see download --packages)")
+    update.add_argument("--dry-run", action="store_true",
+                        help="only report what would be copied and deleted, the space needed and the time needed")
+    update.set_defaults(func=doUpdate)
+
+    rollback = commands.add_parser("rollback", help="go back to a previous version")
+    rollback.add_argument("--code-dir", default=defaultCodeDir, help="the Jinn Code directory (default %(default)s)")
+    choice = rollback.add_mutually_exclusive_group()
+    choice.add_argument("--list", action="store_true", help="list the previous versions, newest first")
+    choice.add_argument("--snapshot", help="the previous version to go back to (default the newest)")
+    rollback.set_defaults(func=doRollback)
+
+    locate = commands.add_parser("locate", help="list the Jinn Code directories on this PC")
+    locate.set_defaults(func=doLocate)
+
+    fleet = commands.add_parser("fleet", help="list the PCs this USB stick has updated, and what each has")
+    fleet.set_defaults(func=doFleet)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parseArgs(argv)
+    output = TextProgress()
+    installInterruptHandler(output)
+    try:
+        return args.func(args, output)
+    except Exception as ex:
+        # Anything before the pipeline proper starts, e.g. being run from inside the Code directory
+        output.finish()
+        output.log("{}".format(ex))
+        return exitFailed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
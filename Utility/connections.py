@@ -0,0 +1,183 @@
+import http.client
+import io
+import sys
+import threading
+import time
+import typing
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# A small pool of persistent ("keep-alive") HTTP connections, shared by several downloads running at once
+# Fetching HJinn, LJinn and master one after another with urllib costs a new TCP (and TLS) connection per
+# request, plus one per redirect hop (GitHub redirects archive urls to codeload.github.com)
+# Here a connection to each host is kept open and handed to the next request for that host, and no more than
+# maxConnections are ever open at once, so several branches can download together without hogging the office link
+# The optional bandwidth limit is shared by every download using the pool
+#
+# Responses look enough like urllib's for fetch.py and pipeline.py not to care which they have:
+# `status`, `headers`, `read()`, `close()`, usable in a `with` statement, and HTTP errors raise urllib.error.HTTPError
+LogFunc = typing.Optional[typing.Callable[[str], None]]
+
+# Socket timeout for each request, in seconds
+requestTimeout = 60
+# Redirects followed before giving up
+maxRedirects = 5
+redirectCodes = (301, 302, 303, 307, 308)
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every thread downloading through the pool, in bytes per second"""
+
+    def __init__(self, bytesPerSecond: int):
+        self.rate = bytesPerSecond
+        self.available = float(bytesPerSecond)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count: int):
+        with self.lock:
+            now = time.monotonic()
+            # Unused allowance only builds up to a second's worth, so an idle spell doesn't allow a long burst after
+            self.available = min(float(self.rate), self.available + (now - self.last) * self.rate)
+            self.last = now
+            self.available -= count
+            # Whoever takes the allowance below zero waits until it is paid back, and later callers queue behind
+            wait = -self.available / self.rate if self.available < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PooledResponse:
+    """A response whose connection goes back to the pool once the body has been read"""
+
+    def __init__(self, pool: 'ConnectionPool', key: tuple, connection: http.client.HTTPConnection,
+                 response: http.client.HTTPResponse, url: str):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+
+    def getheader(self, name: str, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amount: int = None) -> bytes:
+        data = self.response.read(amount)
+        if data and self.pool.limiter is not None:
+            self.pool.limiter.consume(len(data))
+        return data
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        # The connection can only be reused if the whole body has been read and the server will keep it open
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        self.pool.release(self.key, connection, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, maxConnections: int = 4, bytesPerSecond: int = None):
+        self.maxConnections = maxConnections
+        self.limiter = BandwidthLimiter(bytesPerSecond) if bytesPerSecond else None
+        # Bounds the number of connections open (busy or idle) at once
+        self.slots = threading.BoundedSemaphore(maxConnections)
+        self.idle = {}
+        self.idleLock = threading.Lock()
+
+    def acquire(self, key: tuple) -> typing.Tuple[http.client.HTTPConnection, bool]:
+        # Returns (connection, whether it is a reused one)
+        with self.idleLock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+        # Every slot may be held by idle connections to other hosts, if so close one of those to make room
+        while not self.slots.acquire(timeout=0.1):
+            self.closeOneIdle()
+        scheme, host, port = key
+        connectionClass = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connectionClass(host, port, timeout=requestTimeout), False
+
+    def closeOneIdle(self):
+        with self.idleLock:
+            for connections in self.idle.values():
+                if connections:
+                    connection = connections.pop()
+                    break
+            else:
+                return
+        connection.close()
+        self.slots.release()
+
+    def release(self, key: tuple, connection: http.client.HTTPConnection, reusable: bool):
+        if reusable:
+            with self.idleLock:
+                self.idle.setdefault(key, []).append(connection)
+            return
+        connection.close()
+        self.slots.release()
+
+    def close(self):
+        with self.idleLock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle = {}
+        for connection in connections:
+            connection.close()
+            self.slots.release()
+
+    def open(self, url: str, headers: dict = None) -> PooledResponse:
+        # GET url, following redirects, raising urllib.error.HTTPError for anything but a 2xx response
+        for _ in range(maxRedirects + 1):
+            response = self.request(url, headers or {})
+            if response.status in redirectCodes and response.getheader("Location"):
+                location = urllib.parse.urljoin(url, response.getheader("Location"))
+                response.read()
+                response.close()
+                url = location
+                continue
+            if response.status >= 300:
+                body = response.read()
+                response.close()
+                raise urllib.error.HTTPError(url, response.status, response.response.reason, response.headers,
+                                             io.BytesIO(body))
+            return response
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+    def request(self, url: str, headers: dict) -> PooledResponse:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        # Same as urllib, so servers treat us the same
+        headers = dict(headers)
+        headers.setdefault("User-Agent", "Python-urllib/{}.{}".format(*sys.version_info[:2]))
+        while True:
+            connection, reused = self.acquire(key)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError, OSError) as ex:
+                self.release(key, connection, False)
+                if reused and isinstance(ex, (http.client.RemoteDisconnected, ConnectionError)):
+                    # The server closed the idle connection while it sat in the pool, just try a new one
+                    continue
+                raise urllib.error.URLError(ex)
+            return PooledResponse(self, key, connection, response, url)
+
+
+def isProxied(url: str) -> bool:
+    # The pool talks to servers directly, so anything that has to go through a proxy is left to urllib
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(parts.hostname or "")
@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+import typing
+
+from bindiff import applyDelta, makeDelta
+from fleet import MachineRecord
+from integrity import IntegrityError, copyVerified
+from objectstore import ObjectStore
+from sync import FileEntry, getManifestDigest, toNativePath
+
+# Delta packages: the USB stick carries only what has changed since the versions the offline PCs already have
+# On the internet PC a cache (see UpdateVariables.getDeliveryCachePath()) is an object store (see objectstore.py) of
+#     branches/<branch>.json   - the latest download of each branch
+#     branches/<digest>.json   - each version packaged for the stick, by its digest (see sync.getManifestDigest())
+# so the versions installed on the offline PCs are still to hand to diff against, without the stick carrying them
+# On the stick `CodeDelta` is another object store, holding just the new files and patches, with a package for each
+# branch and version some offline PC has (see fleet.py), all made in one pass:
+#     branches/<branch>@<digest>.json  - made against that version of the branch
+#     branches/<branch>.json           - made against nothing (every file carried whole), for a PC with no version
+#                                        known, or one not in the cache any more
+# A package lists every file of the new version, each one
+#     {"base": hash}                   unchanged, taken from `Code` as it is
+#     {"base": hash, "patch": hash}    changed, `Code`'s copy patched (see bindiff.py)
+#     (neither)                        new, or not worth diffing, carried whole
+# with the digests of the version it was made against and of the new version; anything in `Code` not listed is
+# deleted. Patches and files are stored once however many packages use them
+# The updater builds the staging directory from the package as from any other source (see install.py): unchanged
+# files are linked from `Code` and never rewritten, and a file is only patched if its SHA-256 shows it is the version
+# the patch was made against, and the result is checked against the new version's SHA-256 before it is used
+LogFunc = typing.Callable[[str], None]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+# Files bigger than this are carried whole rather than diffed, as diffing holds both versions in memory
+maxDiffSize = 64 * 1024 * 1024
+# A patch is only used if it is smaller than this fraction of the file
+patchRatio = 0.5
+
+
+def hashBytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def isVersionName(name: str) -> bool:
+    # Versions in the delivery cache are named by their digest, branches by their name
+    return len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+
+class DeltaStore(ObjectStore):
+    """The delta packages on the stick"""
+
+    @staticmethod
+    def getPackageName(branch: str, base: typing.Optional[str]) -> str:
+        return branch if base is None else "{}@{}".format(branch, base)
+
+    def listPackages(self) -> typing.List[typing.Tuple[str, typing.Optional[str]]]:
+        # (branch, base digest) of each package
+        packages = []
+        for name in self.listBranches():
+            branch, _, base = name.partition("@")
+            packages.append((branch, base or None))
+        return packages
+
+    def listPackageBranches(self) -> typing.List[str]:
+        return sorted({branch for branch, _ in self.listPackages()})
+
+    def loadPackage(self, branch: str, base: str = None) -> typing.Optional[dict]:
+        return self.loadBranch(self.getPackageName(branch, base))
+
+    def savePackage(self, branch: str, base: typing.Optional[str], package: dict):
+        os.makedirs(self.branchesDir, exist_ok=True)
+        packagePath = self.getBranchPath(self.getPackageName(branch, base))
+        with open(packagePath + ".tmp", 'w') as f:
+            json.dump(package, f)
+        os.replace(packagePath + ".tmp", packagePath)
+
+    def removePackage(self, branch: str, base: typing.Optional[str]):
+        os.unlink(self.getBranchPath(self.getPackageName(branch, base)))
+
+    def getReferenced(self) -> typing.Set[str]:
+        # Only patches and the files carried whole are in the store, the rest are in `Code`
+        referenced = set()
+        for name in self.listBranches():
+            package = self.loadBranch(name) or {"files": {}}
+            for record in package["files"].values():
+                if "patch" in record:
+                    referenced.add(record["patch"])
+                elif "base" not in record:
+                    referenced.add(record["hash"])
+        return referenced
+
+    def addObject(self, sourcePath: str, hash: str):
+        # A blob from another store (the delivery cache), copied in if this store doesn't have it
+        if self.hasObject(hash):
+            return
+        with self.createTempFile() as f, open(sourcePath, 'rb') as source:
+            while True:
+                data = source.read(1024 * 1024)
+                if not data:
+                    break
+                f.write(data)
+        self.commitFile(f.name, hash)
+
+
+class PackageStats:
+    def __init__(self):
+        self.unchanged = 0
+        self.patched = 0
+        self.patchBytes = 0
+        self.patchedFileBytes = 0
+        self.whole = 0
+        self.wholeBytes = 0
+        self.deleted = 0
+
+    def add(self, other: 'PackageStats'):
+        self.unchanged += other.unchanged
+        self.patched += other.patched
+        self.patchBytes += other.patchBytes
+        self.patchedFileBytes += other.patchedFileBytes
+        self.whole += other.whole
+        self.wholeBytes += other.wholeBytes
+        self.deleted += other.deleted
+
+    def getBytes(self) -> int:
+        return self.patchBytes + self.wholeBytes
+
+    def summary(self) -> str:
+        return ("{} file(s) unchanged, {} patched ({} bytes of patches for {} bytes of files), "
+                "{} carried whole ({} bytes), {} deleted".format(self.unchanged, self.patched, self.patchBytes,
+                                                                self.patchedFileBytes, self.whole, self.wholeBytes,
+                                                                self.deleted))
+
+
+def makePatch(cache: ObjectStore, oldHash: str, newEntry: FileEntry) -> typing.Optional[bytes]:
+    # A patch from one version of a file to the next, None if it is not worth it
+    if newEntry.size > maxDiffSize or os.path.getsize(cache.getObjectPath(oldHash)) > maxDiffSize:
+        return None
+    with open(cache.getObjectPath(oldHash), 'rb') as f:
+        old = f.read()
+    with open(cache.getObjectPath(newEntry.hash), 'rb') as f:
+        new = f.read()
+    patch = makeDelta(old, new)
+    if patch is None or len(patch) >= len(new) * patchRatio:
+        return None
+    return patch
+
+
+def buildPackage(log: LogFunc, cache: ObjectStore, branch: str, base: typing.Optional[str], deltaStore: DeltaStore,
+                 progress: ProgressFunc = None) -> PackageStats:
+    # Package the latest download of branch in the cache against version base of it (None for every file whole)
+    data = cache.loadBranch(branch)
+    target = cache.getBranchManifest(branch)
+    baseFiles = cache.getBranchManifest(base) if base is not None else {}
+
+    stats = PackageStats()
+    stats.deleted = len(set(baseFiles) - set(target))
+    files = {}
+    # Progress is in bytes of changed files, which are all that take any time
+    changed = [relPath for relPath, entry in target.items()
+               if relPath not in baseFiles or baseFiles[relPath].hash != entry.hash]
+    total = sum(target[relPath].size for relPath in changed)
+    done = 0
+    for relPath, entry in sorted(target.items()):
+        record = entry.toJson()
+        old = baseFiles.get(relPath)
+        if old is not None and old.hash == entry.hash:
+            record["base"] = old.hash
+            stats.unchanged += 1
+            files[relPath] = record
+            continue
+        patch = makePatch(cache, old.hash, entry) if old is not None else None
+        if patch is not None:
+            record["base"] = old.hash
+            record["patch"] = deltaStore.addBytes(patch)
+            stats.patched += 1
+            stats.patchBytes += len(patch)
+            stats.patchedFileBytes += entry.size
+        else:
+            deltaStore.addObject(cache.getObjectPath(entry.hash), entry.hash)
+            stats.whole += 1
+            stats.wholeBytes += entry.size
+        files[relPath] = record
+        done += entry.size
+        if progress is not None:
+            progress(done, total)
+
+    # Only now is the package recorded, so an interrupted one never replaces a complete one
+    deltaStore.savePackage(branch, base, {"branch": branch, "base": base, "target": getManifestDigest(target),
+                                          "validators": data.get("validators"), "files": files})
+    return stats
+
+
+def getPackageBases(log: LogFunc, cache: ObjectStore, branch: str,
+                    fleet: typing.List[MachineRecord]) -> typing.Set[typing.Optional[str]]:
+    # The versions of branch the PCs have which packages are needed against (None for one with every file whole)
+    bases = set()
+    versions = set(cache.listBranches())
+    for record in fleet:
+        if record.branch != branch:
+            continue
+        if record.digest is None:
+            log("{}, so it gets every file".format(record.describe()))
+        elif record.digest not in versions:
+            log("{}, which is not in \"{}\", so it gets every file".format(record.describe(), cache.root))
+        else:
+            log(record.describe())
+        bases.add(record.digest if record.digest in versions else None)
+    if not bases:
+        log("No PC has branch \"{}\" yet, so every file is carried whole".format(branch))
+        bases.add(None)
+    return bases
+
+
+def buildPackages(log: LogFunc, cache: ObjectStore, branches: typing.List[str], deltaStore: DeltaStore,
+                  fleet: typing.List[MachineRecord], progress: ProgressFunc = None) -> PackageStats:
+    # One package of each branch's latest download for each version of it the PCs have, returns the totals
+    total = PackageStats()
+    built = set()
+    for branch in branches:
+        if cache.loadBranch(branch) is None:
+            raise Exception("Branch \"{}\" has not been downloaded to \"{}\"".format(branch, cache.root))
+        for base in sorted(getPackageBases(log, cache, branch, fleet), key=lambda base: base or ""):
+            stats = buildPackage(log, cache, branch, base, deltaStore, progress)
+            log("Branch \"{}\" {}: {}".format(branch, "from version {}".format(base[:12]) if base else "whole",
+                                              stats.summary()))
+            total.add(stats)
+            built.add((branch, base))
+        # Keep this version to make the next packages against
+        cache.saveBranch(getManifestDigest(cache.getBranchManifest(branch)), cache.getBranchManifest(branch))
+
+    # Packages against versions no PC has any more are of no use
+    for branch, base in deltaStore.listPackages():
+        if branch in branches and (branch, base) not in built:
+            deltaStore.removePackage(branch, base)
+    removed = deltaStore.removeUnreferenced()
+    if removed:
+        log("{} patch(es) and file(s) from earlier packages removed from \"{}\"".format(removed, deltaStore.root))
+
+    # Drop versions nothing will be made against again: only those some PC has, or will have once updated
+    keep = {record.digest for record in fleet}
+    for branch, base in deltaStore.listPackages():
+        keep.add((deltaStore.loadPackage(branch, base) or {}).get("target"))
+    for name in cache.listBranches():
+        if isVersionName(name) and name not in keep:
+            os.unlink(cache.getBranchPath(name))
+    cache.removeUnreferenced()
+    return total
+
+
+class DeltaSource:
+    """A delta package applied to `Code`, as a source for building the staging directory (see install.py)"""
+
+    # base: the version of branch `Code` has, if known (see fleet.py), to take the package made against it,
+    # otherwise the one with every file whole
+
+    def __init__(self, store: DeltaStore, branch: str, base: typing.Optional[str], codeDirPath: str):
+        self.store = store
+        self.branch = branch
+        self.codeDirPath = codeDirPath
+        self.package = store.loadPackage(branch, base) if base is not None else None
+        if self.package is None:
+            self.package = store.loadPackage(branch)
+        if self.package is None and base is None:
+            raise Exception("This PC's version of branch \"{}\" is not recorded on the USB stick, so there is no "
+                            "package of changes for it, please update it from a full download once".format(branch))
+        if self.package is None:
+            raise Exception("There is no package of branch \"{}\" for the version this PC has in \"{}\", please run "
+                            "the downloader again now the USB stick knows it".format(branch, store.root))
+        self.records = self.package["files"]
+        self.files = {relPath: FileEntry.fromJson(record) for relPath, record in self.records.items()}
+
+    def getDescription(self) -> str:
+        return "the changes to branch \"{}\" in \"{}\"".format(self.branch, self.store.root)
+
+    def manifest(self) -> typing.Dict[str, FileEntry]:
+        manifest = {}
+        for relPath, entry in self.files.items():
+            record = self.records[relPath]
+            if "base" in record and "patch" not in record:
+                # Unchanged, so described as `Code` has it, for it to be linked rather than copied
+                try:
+                    st = os.stat(toNativePath(self.codeDirPath, relPath))
+                except OSError:
+                    st = None
+                if st is not None and st.st_size == entry.size:
+                    entry = FileEntry(st.st_size, st.st_mtime, entry.hash)
+            manifest[relPath] = entry
+        return manifest
+
+    def directories(self) -> typing.Set[str]:
+        directories = {"."}
+        for relPath in self.files:
+            parts = relPath.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                directories.add("/".join(parts[:i]))
+        return directories
+
+    def copyFile(self, relPath: str, targetPath: str):
+        record = self.records[relPath]
+        entry = self.files[relPath]
+        if "base" not in record:
+            self.store.copyObject(entry.hash, targetPath, entry.mtime, verify=True)
+            return
+        basePath = toNativePath(self.codeDirPath, relPath)
+        if not os.path.exists(basePath):
+            raise IntegrityError("\"{}\" is not in \"{}\", so this package cannot be applied to it, please update "
+                                 "from a full download instead".format(relPath, self.codeDirPath))
+        if "patch" not in record:
+            # Unchanged, but being copied rather than linked
+            copyVerified(basePath, targetPath, record["base"])
+        else:
+            with open(basePath, 'rb') as f:
+                old = f.read()
+            if hashBytes(old) != record["base"]:
+                raise IntegrityError("\"{}\" in \"{}\" is not the version this package was made against, please "
+                                     "update from a full download instead".format(relPath, self.codeDirPath))
+            with open(self.store.getObjectPath(record["patch"]), 'rb') as f:
+                patch = f.read()
+            if hashBytes(patch) != record["patch"]:
+                raise IntegrityError("The patch for \"{}\" in \"{}\" is damaged".format(relPath, self.store.root))
+            new = applyDelta(old, patch)
+            if hashBytes(new) != entry.hash:
+                raise IntegrityError("Patching \"{}\" did not give the file which was downloaded".format(relPath))
+            with open(targetPath, 'wb') as f:
+                f.write(new)
+        if entry.mtime is not None:
+            os.utime(targetPath, (entry.mtime, entry.mtime))
@@ -1,20 +1,23 @@
-import os
-import shutil
 import sys
-import urllib.request
-import zipfile
 
-from PyQt5.QtGui import QTextCursor, QIcon
-from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QFrame, QPushButton
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QFrame, QPushButton, QCheckBox, QSpinBox
 from dialogs import JDialog, InfoMsgBox
-from widgets import JPushButton, JCancelButton, LabelledComboBox, JTextEdit
+from widgets import JPushButton, JCancelButton, LabelledComboBox, JLogView, LabelledWidget, ProgressPanel
 from updatevariables import UpdateVariables
+from tracing import RunTrace
+from workers import PipelineWorker
+from bytecache import refreshInBackground
 
 class DownloaderDialog(JDialog):
     def __init__(self):
         super().__init__()
         self.setWindowIcon(QIcon('GUI\jinndl.ico'))
         self.setInitialSize(800,800)
+        self.worker = None
+        self.trace = None
+        # Set once Cancel has been pressed during a download: the dialog closes when the worker has stopped
+        self.closing = False
 
         self.initUi()
         self.setActions()
@@ -30,8 +33,46 @@ class DownloaderDialog(JDialog):
 
         self.comboBranch = LabelledComboBox("Choose branch:")
         self.comboBranch.cb.addItems(["HJinn", "LJinn", "master"])
-        self.advancedOptionsLayout = QHBoxLayout()
-        self.advancedOptionsLayout.addWidget(self.comboBranch)
+        # Extracting while downloading means the zip itself is never written to the (slow) USB stick
+        self.chkStreamExtract = QCheckBox("Extract while downloading")
+        self.chkStreamExtract.setChecked(True)
+        # The shared store keeps every branch downloaded on the stick at once, each file content stored only once
+        self.chkUseStore = QCheckBox("Keep in shared branch store")
+        # Only the zip (and an index of it) goes on the stick, the updater extracts it on the work PC's own disk
+        self.chkArchiveOnly = QCheckBox("Keep as a zip file only")
+        # Only what has changed since each work PC's last update from the stick goes on it (see delta.py),
+        # for every branch a work PC has as well as the one chosen (see fleet.py)
+        self.chkDelta = QCheckBox("Carry only the changes")
+        # The Python packages the code needs go on the stick too, as wheels (see wheelhouse.py)
+        # Off unless asked for, as it needs pip and the package index as well as GitHub
+        self.chkPackages = QCheckBox("Python packages")
+        self.singleBranchLayout = QHBoxLayout()
+        self.singleBranchLayout.addWidget(self.comboBranch)
+        self.singleBranchLayout.addWidget(self.chkStreamExtract)
+        self.singleBranchLayout.addWidget(self.chkUseStore)
+        self.singleBranchLayout.addWidget(self.chkArchiveOnly)
+        self.singleBranchLayout.addWidget(self.chkDelta)
+        self.singleBranchLayout.addWidget(self.chkPackages)
+
+        # Several branches at once, all into the shared store, sharing a few keep-alive connections (see connections.py)
+        self.chkAllBranches = QCheckBox("Download all selected branches:")
+        self.branchChecks = {}
+        self.multiBranchLayout = QHBoxLayout()
+        self.multiBranchLayout.addWidget(self.chkAllBranches)
+        for branch in ["HJinn", "LJinn", "master"]:
+            self.branchChecks[branch] = QCheckBox(branch)
+            self.branchChecks[branch].setChecked(True)
+            self.multiBranchLayout.addWidget(self.branchChecks[branch])
+        # So as not to take over the office's internet connection, shared by all the downloads
+        self.spinBandwidth = QSpinBox()
+        self.spinBandwidth.setRange(0, 1000000)
+        self.spinBandwidth.setSpecialValueText("No limit")
+        self.bandwidthLimit = LabelledWidget("Limit (KB/s):", self.spinBandwidth)
+        self.multiBranchLayout.addWidget(self.bandwidthLimit)
+
+        self.advancedOptionsLayout = QVBoxLayout()
+        self.advancedOptionsLayout.addLayout(self.singleBranchLayout)
+        self.advancedOptionsLayout.addLayout(self.multiBranchLayout)
 
         self.advancedOptionsFrame = QFrame()
         self.advancedOptionsFrame.setHidden(True)
@@ -39,9 +80,13 @@ class DownloaderDialog(JDialog):
         self.topBar.addWidget(self.btnAdvancedOptions)
         self.topBar.addWidget(self.advancedOptionsFrame)
 
-        self.updateLog = JTextEdit("Press 'Download' below to download the latest Jinn code to the USB memory stick")
+        self.updateLog = JLogView("Press 'Download' below to download the latest Jinn code to the USB memory stick",
+                                  collapsePrefixes=["Extracting: "])
 
+        # A progress bar for each phase, or for each branch when downloading several (see progressmodel.py)
+        self.progressPanel = ProgressPanel()
         self.statusLayout = QVBoxLayout()
+        self.statusLayout.addWidget(self.progressPanel)
         self.statusLayout.addWidget(self.updateLog)
 
         self.btnDownload = JPushButton("Download")
@@ -70,130 +115,114 @@ class DownloaderDialog(JDialog):
     def getBranch(self):
         return self.comboBranch.cb.currentText()
 
+    def getSelectedBranches(self):
+        return [branch for branch, check in self.branchChecks.items() if check.isChecked()]
+
+    def getBandwidthLimit(self):
+        # In bytes per second, None for no limit
+        return self.spinBandwidth.value() * 1024 or None
+
     def doDownload(self):
+        # The pipeline is only imported once there is something for it to do, to keep start up quick
+        from jobs import getDownloadPhases
+        from pipeline import setRootDir, checkNotRunningFromCodeDir
         branch = self.getBranch()
-        updateVariables = UpdateVariables(branch)
-        try:
-            cwd = os.getcwd()
-            dirname = os.path.basename(cwd)
-            if dirname.upper() == updateVariables.codeDir.upper():
-                raise Exception("This script must not be run with the current directory being \"{}\""
-                                ", because it needs to replace that directory".format(cwd))
+        branches = self.getSelectedBranches()
+        if self.chkAllBranches.isChecked() and not branches:
+            self.updateLog.appendLine("Please select at least one branch to download")
+            return
+        # Each step is timed, and the timings kept in the run history on the stick (see tracing.py)
+        self.trace = RunTrace("download", ", ".join(branches) if self.chkAllBranches.isChecked() else branch)
+        with self.trace.span("setup"):
+            updateVariables = UpdateVariables(branch)
+            checkNotRunningFromCodeDir(updateVariables)
 
             # compute the root directory (`Jinn`) via where this script is being run from
             stdOut = setRootDir()
-
-            updateJTextEdit(self.updateLog, stdOut)
-            # download the zip file from github to the `Jinn` directory
-            downloadZipFile(self.updateLog, updateVariables)
-
-            # extract from the zip file to create `Jinn-master` directory in `Jinn` directory
-            extractFromZipFile(self.updateLog, updateVariables)
-
-            updateJTextEdit(self.updateLog,"Finished downloading and extracting latest Jinn code. Please insert the USB into your "
-                            "work computer and run the installer.")
-        except Exception as ex:
-            raise ex
+        self.updateLog.appendLine(stdOut)
+        updateVariables.trace = self.trace
+
+        # All the network and disk work happens on a background thread so the window keeps repainting
+        self.worker = PipelineWorker(self)
+        worker = self.worker
+        worker.trace = self.trace
+        self.progressPanel.clear()
+        if self.chkAllBranches.isChecked():
+            # all the selected branches at once, into the object store on the stick
+            for name in branches:
+                self.progressPanel.addBar(name)
+        else:
+            branches = None
+        # The same steps as `cli.py download` (see jobs.py)
+        worker.addPhases(getDownloadPhases(updateVariables, self.chkStreamExtract.isChecked(),
+                                           self.chkUseStore.isChecked(), branches, self.getBandwidthLimit(),
+                                           self.trace, self.chkArchiveOnly.isChecked(), self.chkDelta.isChecked(),
+                                           self.chkPackages.isChecked()))
+        worker.logMessage.connect(self.updateLog.appendLine)
+        worker.progressChanged.connect(self.progressPanel.updateProgress)
+        worker.succeeded.connect(self.downloadFinished)
+        worker.failed.connect(self.downloadFailed)
+        worker.finished.connect(self.workerFinished)
+
+        self.setRunning(True)
+        worker.start()
+
+    def setRunning(self, running: bool):
+        self.btnDownload.setEnabled(not running)
+        self.comboBranch.setEnabled(not running)
+        self.chkStreamExtract.setEnabled(not running)
+        self.chkUseStore.setEnabled(not running)
+        self.chkArchiveOnly.setEnabled(not running)
+        self.chkDelta.setEnabled(not running)
+        self.chkPackages.setEnabled(not running)
+        self.chkAllBranches.setEnabled(not running)
+        for check in self.branchChecks.values():
+            check.setEnabled(not running)
+        self.bandwidthLimit.setEnabled(not running)
+
+    def workerFinished(self):
+        # Make sure the log is up to date before any "finished"/"failed" message box
+        self.updateLog.flush()
+        self.setRunning(False)
+        self.worker.deleteLater()
+        self.worker = None
+        if self.closing:
+            self.reject()
+
+    def downloadFinished(self):
+        from pipeline import recordRun
+        self.progressPanel.setFinished()
+        recordRun(self.updateLog.appendLine, UpdateVariables(), self.trace, "succeeded")
+        self.updateLog.appendLine("Finished downloading and extracting latest Jinn code. Please insert the USB into your "
+                                  "work computer and run the installer.")
+        self.updateLog.flush()
+        if self.closing:
+            return
         InfoMsgBox("Finished","Download has finished. You can now close the downloader and remove the USB stick. To continue "
                    "upgrading Jinn plug this USB stick into your work PC and run the 'Jinn updater' shortcut",
                    "Download finished").exec()
 
-
-def updateJTextEdit(jTextEdit: JTextEdit, newText):
-    Text = jTextEdit.toPlainText() + "\n" + newText
-    jTextEdit.moveCursor(QTextCursor.End)
-    jTextEdit.setText(Text)
-    jTextEdit.moveCursor(QTextCursor.End)
-
-def setRootDir():
-    # Store the parent of the directory this module is executing from in rootDir
-    # this will be used as the root/parent of where the "Code" directory resides
-    from inspect import currentframe, getframeinfo
-    filename = getframeinfo(currentframe()).filename
-    # get "Code" directory
-    dir = os.path.dirname(os.path.realpath(filename))
-    # set rootDir as *parent* of "Code" directory, i.e. "Jinn" directory
-    global rootDir
-    rootDir = os.path.dirname(dir)
-    # Return output as string
-    UpdateVariables.rootDir = rootDir
-    return str(rootDir)
-
-
-def checkProceed() -> bool:
-    while True:
-        sys.stderr.write("Proceed? [y/n]")
-        sys.stderr.flush()
-        answer = sys.stdin.readline().lower()
-        if answer.startswith("y"):
-            return True
-        elif answer.startswith("n"):
-            return False
-        else:
-            sys.stderr.write("Please type 'y' or 'n', followed by the RETURN/ENTER key\n")
-
-
-def downloadZipFile(updateLog: JTextEdit, updateVariables: UpdateVariables):
-    # First clear old zip files
-
-    zipFilePath = updateVariables.getPath(updateVariables.zipDir)
-    zipFile = updateVariables.getZipFile()
-    zipFileTarget = os.path.join(zipFilePath, zipFile)
-    zipFileUrl = updateVariables.getZipFileUrl()
-    updateJTextEdit(updateLog, "Downloading Zip file from \"{}\" to \"{}\"\n".format(zipFileUrl, zipFileTarget))
-    # taken from https://stackoverflow.com/a/7244263/489865
-    # Download the file from `url` and save it locally under `file_name`:
-
-    req = urllib.request.Request(zipFileUrl)
-    with urllib.request.urlopen(req) as response, open(zipFileTarget, 'wb') as out_file:
-
-        shutil.copyfileobj(response, out_file)
-        out_file.close()
-        updateJTextEdit(updateLog,"Download finished.")
-    if not os.path.exists(zipFileTarget):
-        raise Exception("Something went wrong: expected to create \"{}\"".format(zipFileTarget))
-
-
-def extractFromZipFile(updateLog: JTextEdit, updateVariables: UpdateVariables):
-    updateJTextEdit(updateLog, "Clearing old extracted code")
-    updateVariables.clearExtractedFolder()
-    zipFileDir = updateVariables.getPath(updateVariables.zipDir)
-    zipFile = updateVariables.getZipFile()
-    zipFilePath = os.path.join(zipFileDir, zipFile)
-    zipExtractedDirPath = updateVariables.getZipExtractedDir()
-    updateJTextEdit(updateLog, "Extracting from Zip file \"{}\" to \"{}\"\n".format(zipFilePath, zipExtractedDirPath))
-    # taken from https://stackoverflow.com/a/3451150
-    with zipfile.ZipFile(zipFilePath, 'r') as zip_ref:
-        nameList = zip_ref.namelist()
-
-        for x, name in enumerate(nameList):
-            updateJTextEdit(updateLog, "Extracting: {}".format(name))
-            zip_ref.extract(name, zipExtractedDirPath)
-
-    if not os.path.exists(zipExtractedDirPath):
-        raise Exception("Something went wrong: expected to create \"{}\"".format(zipExtractedDirPath))
-    if os.path.exists(zipFilePath):
-        os.unlink(zipFilePath)
-
-
-def renameCodeDirectory(updateLog: JTextEdit, updateVariables: UpdateVariables):
-    updateJTextEdit(updateLog, "Renaming Code directory")
-    codeDirPath = os.path.join(rootDir, updateVariables.codeDir)
-    zipExtractedDirPath = updateVariables.getZipExtractedDir()
-    codeDirAlreadyExists = os.path.exists(codeDirPath)
-    if codeDirAlreadyExists:
-        updateJTextEdit(updateLog, "Rename existing \"{}\" directory to \"{}\", and ".format(updateVariables.codeDir, updateVariables.oldCodeDir))
-    updateJTextEdit(updateLog, "Rename \"{}\" to \"{}\"\n".format(updateVariables.getZipExtractedDir, updateVariables.codeDir))
-    # rename existing `Code` directory to `OldCode`
-
-    if codeDirAlreadyExists:
-        oldCodeDirPath = updateVariables.getOldCodeDirWithDateTime()
-        updateJTextEdit(updateLog,"Renaming \"{}\" to \"{}\"\n".format(codeDirPath, oldCodeDirPath))
-        os.rename(codeDirPath, oldCodeDirPath)
-    # rename directory from extracted zip file to `Code`
-        updateJTextEdit(updateLog,"Renaming \"{}\" to \"{}\"\n".format(zipExtractedDirPath, codeDirPath))
-    os.rename(zipExtractedDirPath, codeDirPath)
-
+    def downloadFailed(self, message: str):
+        from pipeline import recordRun
+        self.updateLog.appendLine("Download failed: {}".format(message))
+        recordRun(self.updateLog.appendLine, UpdateVariables(), self.trace,
+                  "cancelled" if message.startswith("Cancelled") else "failed", message)
+        self.updateLog.flush()
+        if not self.closing:
+            InfoMsgBox("Download failed", message, "Download failed").exec()
+
+    def reject(self):
+        # Don't let the dialog (and with it the QThread) be destroyed while the worker is still running: a phase
+        # blocked in a network read may take a while to reach its next cancellation point, so ask it to stop and
+        # close once it has (see workerFinished)
+        if self.worker is not None:
+            if not self.closing:
+                self.closing = True
+                self.btnCancel.setEnabled(False)
+                self.updateLog.appendLine("Stopping the download...")
+                self.worker.requestInterruption()
+            return
+        super().reject()
 
 
 if __name__ == '__main__':
@@ -201,4 +230,6 @@ if __name__ == '__main__':
 
     app = QApplication(sys.argv)
     updateDialog = DownloaderDialog()
+    # So that next time starts quickly (see bytecache.py)
+    refreshInBackground()
     sys.exit(updateDialog.exec_())
\ No newline at end of file
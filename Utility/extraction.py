@@ -0,0 +1,124 @@
+import concurrent.futures
+import os
+import threading
+import time
+import typing
+import zipfile
+
+from sinks import DirectorySink
+
+# Extracts a zip file using a pool of threads, each with its own ZipFile handle
+# Extracting thousands of small files one at a time is dominated by per-file latency (open, write, close),
+# but zlib decompression and file writes release the GIL, so several threads keep both the CPU cores and
+# the disk's command queue busy
+# The directory tree is created up front, so the workers only ever write files and never race on makedirs
+# Members go to a sink (see sinks.py): a directory tree by default, or e.g. the object store
+LogFunc = typing.Optional[typing.Callable[[str], None]]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+# Buffer size when copying a member from the archive to its sink
+copyBufferSize = 1024 * 1024
+
+
+def defaultWorkerCount() -> int:
+    # More threads than cores is worthwhile as much of the time is spent waiting on the disk
+    return min(16, (os.cpu_count() or 1) * 2)
+
+
+class MemberResult:
+    """The outcome of extracting one member, returned in archive order"""
+
+    def __init__(self, name: str, size: int = 0, error: Exception = None):
+        self.name = name
+        self.size = size
+        self.error = error
+
+
+class ParallelExtractor:
+    def __init__(self, zipFilePath: str, sink, workers: int = None):
+        self.zipFilePath = zipFilePath
+        self.sink = sink
+        self.workers = workers or defaultWorkerCount()
+        self.local = threading.local()
+        self.handles = []
+        self.handlesLock = threading.Lock()
+
+    def getHandle(self) -> zipfile.ZipFile:
+        # A ZipFile object is not safe to share between threads, so each worker opens its own
+        handle = getattr(self.local, "handle", None)
+        if handle is None:
+            handle = zipfile.ZipFile(self.zipFilePath, 'r')
+            self.local.handle = handle
+            with self.handlesLock:
+                self.handles.append(handle)
+        return handle
+
+    def closeHandles(self):
+        with self.handlesLock:
+            for handle in self.handles:
+                handle.close()
+            self.handles = []
+
+    def extractMember(self, info: zipfile.ZipInfo) -> MemberResult:
+        if info.is_dir():
+            self.sink.addDirectory(info.filename)
+            return MemberResult(info.filename)
+        writer = None
+        try:
+            writer = self.sink.openFile(info.filename, time.mktime(info.date_time + (0, 0, -1)))
+            with self.getHandle().open(info) as source:
+                while True:
+                    data = source.read(copyBufferSize)
+                    if not data:
+                        break
+                    writer.write(data)
+            writer.close()
+            return MemberResult(info.filename, info.file_size)
+        except Exception as ex:
+            if writer is not None:
+                writer.abort()
+            return MemberResult(info.filename, error=ex)
+
+    def extractAll(self, log: LogFunc = None, progress: ProgressFunc = None) -> typing.List[MemberResult]:
+        with zipfile.ZipFile(self.zipFilePath, 'r') as zip_ref:
+            infoList = zip_ref.infolist()
+        self.sink.prepare(info.filename for info in infoList)
+
+        results = []
+        # Progress is in bytes, against the total uncompressed size in the zip's central directory
+        total = sum(info.file_size for info in infoList)
+        done = 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+                # executor.map() hands back results in archive order, whatever order the workers finish in
+                for result in executor.map(self.extractMember, infoList):
+                    results.append(result)
+                    done += result.size
+                    if log is not None:
+                        log("Extracting: {}".format(result.name))
+                    if progress is not None:
+                        try:
+                            progress(done, total)
+                        except BaseException:
+                            # e.g. the user cancelled: don't start any more members, then pass it on
+                            executor.shutdown(wait=True, cancel_futures=True)
+                            raise
+        finally:
+            self.closeHandles()
+        return results
+
+
+def extractParallel(zipFilePath: str, destDir: str, log: LogFunc = None, progress: ProgressFunc = None,
+                    workers: int = None, sink=None) -> typing.List[MemberResult]:
+    # Extract everything into destDir (or sink, if given),
+    # raising an exception listing every member which failed (if any)
+    if sink is None:
+        sink = DirectorySink(destDir)
+    results = ParallelExtractor(zipFilePath, sink, workers).extractAll(log, progress)
+    failures = [result for result in results if result.error is not None]
+    if failures:
+        details = "\n".join("{}: {}".format(result.name, result.error) for result in failures)
+        raise Exception("Failed to extract {} file(s) from \"{}\":\n{}".format(len(failures), zipFilePath, details))
+    # Only a complete extraction is committed (e.g. the object store only then records the branch)
+    sink.finish()
+    return results
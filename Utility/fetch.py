@@ -0,0 +1,451 @@
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+from connections import ConnectionPool, isProxied
+from tracing import RunTrace
+
+# Downloads are written to "<target>.part", with a small "<target>.part.json" journal alongside recording
+#     url           - what we were downloading
+#     validator     - the ETag (or failing that Last-Modified) the server sent, so we only resume the same content
+#     bytesWritten  - how much of the .part file is known to be good
+# If the connection drops (or the downloader is closed) the next attempt asks the server for just the remaining
+# bytes with a "Range" request, and only renames the .part file to the target once it is complete
+#
+# Separately, the caller can pass the validators (ETag/Last-Modified) from the last complete download
+# and we make the request conditional: if the server answers "304 Not Modified" nothing is downloaded at all
+#
+# The SHA-256 of the download is worked out as it is written (see integrity.py), and returned with the validators
+#
+# A large download from a server which says how long it is and accepts ranges ("Accept-Ranges: bytes") is split
+# into a few byte ranges fetched over parallel connections, as a single connection is often limited by latency
+# rather than by our link. They are written straight into place in a .part file made full size up front, and the
+# journal then records how far each range has got, so a segmented download can be resumed too
+# Anything else (e.g. GitHub's archives, which are sent without a length) is a single stream as before
+LogFunc = typing.Callable[[str], None]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+# Size of each read from the network
+chunkSize = 64 * 1024
+# How often (in bytes) the journal is brought up to date while downloading
+journalInterval = 1024 * 1024
+# Socket timeout for each request, in seconds
+requestTimeout = 60
+# Number of times a dropped connection is retried (resuming each time) before giving up
+retryCount = 3
+# Seconds to wait between retries
+retryDelay = 2
+
+# Largest number of ranges a download is split into (1 for a single stream)
+defaultSegments = 4
+# Smallest range worth its own connection, smaller downloads are split into fewer ranges (or none)
+minimumSegmentSize = 4 * 1024 * 1024
+
+# The errors we treat as "connection dropped, try to resume" rather than as a hard failure
+transientErrors = (urllib.error.URLError, http.client.IncompleteRead, ConnectionError, socket.timeout)
+
+
+def getPartPath(target: str) -> str:
+    return target + ".part"
+
+
+def getJournalPath(target: str) -> str:
+    return target + ".part.json"
+
+
+def loadJournal(target: str) -> typing.Optional[dict]:
+    journalPath = getJournalPath(target)
+    if not os.path.exists(journalPath):
+        return None
+    try:
+        with open(journalPath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # A journal we cannot read is no use to us, just start again
+        return None
+
+
+def saveJournal(target: str, url: str, validator: typing.Optional[str], bytesWritten: int):
+    writeJournal(target, {"url": url, "validator": validator, "bytesWritten": bytesWritten})
+
+
+def writeJournal(target: str, journal: dict):
+    journalPath = getJournalPath(target)
+    tmpPath = journalPath + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(journal, f)
+    # os.replace() is atomic, so we never leave a half-written journal behind
+    os.replace(tmpPath, journalPath)
+
+
+def discardPartial(target: str):
+    for path in (getPartPath(target), getJournalPath(target)):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def getValidator(headers) -> typing.Optional[str]:
+    # A strong ETag is the best way of knowing we are resuming the same file, Last-Modified will do otherwise
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def getResponseValidators(headers) -> dict:
+    # The validators we keep after a complete download, to make the next request for the same url conditional
+    return {"etag": headers.get("ETag"), "lastModified": headers.get("Last-Modified")}
+
+
+def getConditionalHeaders(validators: typing.Optional[dict]) -> dict:
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("lastModified"):
+            headers["If-Modified-Since"] = validators["lastModified"]
+    return headers
+
+
+def getResumeOffset(target: str, url: str) -> typing.Tuple[int, typing.Optional[str]]:
+    # Work out how much of a previous partial download we can keep, returns (offset, validator)
+    journal = loadJournal(target)
+    partPath = getPartPath(target)
+    if journal is None or not os.path.exists(partPath):
+        return 0, None
+    if journal.get("url") != url or not journal.get("validator"):
+        # Different file, or no way of telling whether the server's copy has changed since
+        return 0, None
+    # The journal is only written after the data has been flushed, so it never claims more than is in the file
+    # but the file may contain a few more bytes written after the last journal update, which we throw away
+    offset = min(os.path.getsize(partPath), int(journal.get("bytesWritten", 0)))
+    return offset, journal["validator"]
+
+
+def parseContentRangeStart(contentRange: typing.Optional[str]) -> typing.Optional[int]:
+    # "bytes 1000-1999/5000" -> 1000
+    if not contentRange or not contentRange.startswith("bytes "):
+        return None
+    try:
+        return int(contentRange[6:].split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+def openUrl(url: str, headers: dict = None, pool: ConnectionPool = None):
+    # With a pool (see connections.py) the request goes over one of its keep-alive connections
+    if pool is not None and not isProxied(url):
+        return pool.open(url, headers)
+    req = urllib.request.Request(url, headers=headers or {})
+    return urllib.request.urlopen(req, timeout=requestTimeout)
+
+
+def fetchToFile(url: str, target: str, log: LogFunc, progress: ProgressFunc = None,
+                validators: typing.Optional[dict] = None, pool: ConnectionPool = None,
+                trace: RunTrace = None, segments: int = defaultSegments) -> typing.Optional[dict]:
+    # Download url to target, resuming any earlier partial download of the same url
+    # If validators (as returned by a previous call) are passed the request is conditional
+    # Returns the new validators (plus the "sha256" and "size" of what was downloaded),
+    # or None if the server says the content has not changed since those validators
+    # segments: the most connections to download over at once, if the server allows it
+    for attempt in range(retryCount + 1):
+        try:
+            return fetchOnce(url, target, log, progress, validators, pool, trace or RunTrace(), segments)
+        except urllib.error.HTTPError:
+            # The server answered (404 etc.), retrying won't change its mind
+            raise
+        except transientErrors as ex:
+            if attempt == retryCount:
+                raise
+            log("Connection problem ({}), retrying...".format(ex))
+            time.sleep(retryDelay)
+
+
+def fetchOnce(url: str, target: str, log: LogFunc, progress: ProgressFunc = None,
+              validators: typing.Optional[dict] = None, pool: ConnectionPool = None,
+              trace: RunTrace = None, segments: int = 1) -> typing.Optional[dict]:
+    # trace gets a "request" span (until the response headers arrive) and a "transfer" span (the body)
+    trace = trace or RunTrace()
+    partPath = getPartPath(target)
+    journal = loadJournal(target)
+    if journal is not None and journal.get("segments") is not None:
+        if isResumable(journal, target, url):
+            try:
+                return SegmentedDownload.resume(url, target, log, progress, journal, pool, trace).run()
+            except RangesNotSupported:
+                pass
+        log("Could not resume the partial download, starting again")
+        discardPartial(target)
+    offset, validator = getResumeOffset(target, url)
+    if offset > 0:
+        # A partial download always wins over a conditional request: it was started because something changed
+        headers = {"Range": "bytes={}-".format(offset)}
+        # If-Range makes the server send the whole (new) file instead of a range if it has changed in the meantime
+        headers["If-Range"] = validator
+    else:
+        headers = getConditionalHeaders(validators)
+
+    with trace.span("request"):
+        try:
+            response = openUrl(url, headers, pool)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304 and offset == 0:
+                # urllib treats "304 Not Modified" as an error, for us it means there is nothing to do
+                return None
+            if ex.code != 416 or offset == 0:
+                raise
+            # "Range Not Satisfiable": our partial file no longer matches the server's, start again from scratch
+            log("Server could not resume the partial download, starting again")
+            discardPartial(target)
+            offset = 0
+            response = openUrl(url, pool=pool)
+
+    if offset > 0 and response.status == 206 and \
+            parseContentRangeStart(response.headers.get("Content-Range")) != offset:
+        # Part of the file, but not the part asked for, so it can't go after what we have, or stand for the whole
+        response.close()
+        log("Server sent the wrong part of the download, starting again")
+        discardPartial(target)
+        return fetchOnce(url, target, log, progress, validators, pool, trace, segments)
+
+    with response:
+        if offset > 0 and response.status == 206:
+            log("Resuming download at {} bytes".format(offset))
+            mode = 'r+b'
+        else:
+            if offset > 0:
+                # The server ignored our Range request (or the file changed), so this is a full response
+                log("Server does not support resuming this download, downloading from the start")
+            offset = 0
+            mode = 'wb'
+        validator = getValidator(response.headers)
+        newValidators = getResponseValidators(response.headers)
+
+        # Content-Length is for what is being sent now, i.e. just the remaining bytes when resuming
+        length = int(response.headers.get("Content-Length") or 0)
+        total = offset + length if length else 0
+
+        ranges = getSegmentRanges(response.headers, length, segments) if offset == 0 else []
+        if ranges:
+            try:
+                return SegmentedDownload.start(url, target, log, progress, response, ranges, validator, newValidators,
+                                               pool, trace).run()
+            except RangesNotSupported as ex:
+                log("Server could not send part of the download ({}), downloading it in one go".format(ex))
+                discardPartial(target)
+            response.close()
+            return fetchOnce(url, target, log, progress, validators, pool, trace, 1)
+
+        sha = hashlib.sha256()
+        with trace.span("transfer") as span, open(partPath, mode) as out_file:
+            if offset > 0:
+                # The part we already have needs hashing too, the only time anything is read back
+                hashPrefix(out_file, offset, sha)
+            out_file.seek(offset)
+            out_file.truncate()
+            done = offset
+            lastJournalled = done
+            saveJournal(target, url, validator, done)
+            while True:
+                chunk = response.read(chunkSize)
+                if not chunk:
+                    break
+                out_file.write(chunk)
+                sha.update(chunk)
+                span.add(bytes=len(chunk))
+                done += len(chunk)
+                if done - lastJournalled >= journalInterval:
+                    out_file.flush()
+                    saveJournal(target, url, validator, done)
+                    lastJournalled = done
+                if progress is not None:
+                    progress(done, total)
+            out_file.flush()
+            saveJournal(target, url, validator, done)
+
+    if total and done != total:
+        # The connection closed early without an error, leave the .part file for the next attempt to resume
+        raise http.client.IncompleteRead(b"", total - done)
+
+    os.replace(partPath, target)
+    os.unlink(getJournalPath(target))
+    newValidators["sha256"] = sha.hexdigest()
+    newValidators["size"] = done
+    return newValidators
+
+
+def hashPrefix(file, length: int, sha):
+    file.seek(0)
+    remaining = length
+    while remaining > 0:
+        data = file.read(min(chunkSize, remaining))
+        if not data:
+            break
+        sha.update(data)
+        remaining -= len(data)
+
+
+class RangesNotSupported(Exception):
+    """The server didn't answer a range request with the range asked for"""
+
+
+def getSegmentRanges(headers, length: int, segments: int) -> typing.List[typing.Tuple[int, int]]:
+    # The (start, end) byte ranges (end exclusive) to split a download of length bytes into,
+    # or [] if it isn't worth splitting or the server can't be trusted to send ranges of the same file
+    if segments <= 1 or not length or headers.get("Accept-Ranges", "").lower() != "bytes" or not getValidator(headers):
+        return []
+    count = min(segments, length // minimumSegmentSize)
+    if count <= 1:
+        return []
+    size = -(-length // count)
+    return [(start, min(start + size, length)) for start in range(0, length, size)]
+
+
+def isResumable(journal: dict, target: str, url: str) -> bool:
+    # Whether a segmented download's journal describes the .part file there is for url
+    partPath = getPartPath(target)
+    return journal.get("url") == url and bool(journal.get("validator")) and os.path.exists(partPath) \
+        and os.path.getsize(partPath) == journal.get("length")
+
+
+class SegmentedDownload:
+    """Byte ranges of one url, each fetched over its own connection straight into its place in the .part file"""
+    # segments are [start, end, written]: written is how much of the range is known to be in the file
+    # A range which fails stops the others, and the journal lets the next attempt carry on where each one got to
+
+    def __init__(self, url: str, target: str, log: LogFunc, progress: ProgressFunc, segments: typing.List[list],
+                 length: int, validator: str, newValidators: dict, pool: ConnectionPool, trace: RunTrace):
+        self.url = url
+        self.target = target
+        self.partPath = getPartPath(target)
+        self.log = log
+        self.progress = progress
+        self.segments = segments
+        self.length = length
+        self.validator = validator
+        self.newValidators = newValidators
+        self.pool = pool
+        self.trace = trace
+        self.firstResponse = None
+        self.received = sum(segment[2] for segment in segments)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    @staticmethod
+    def start(url: str, target: str, log: LogFunc, progress: ProgressFunc, response, ranges: typing.List[tuple],
+              validator: str, newValidators: dict, pool: ConnectionPool, trace: RunTrace) -> 'SegmentedDownload':
+        # response is the full response already started, which supplies the first range
+        length = ranges[-1][1]
+        # Full size up front, so every range can be written in place as it arrives
+        with open(getPartPath(target), 'wb') as out_file:
+            out_file.truncate(length)
+        download = SegmentedDownload(url, target, log, progress, [[start, end, 0] for start, end in ranges], length,
+                                     validator, newValidators, pool, trace)
+        download.firstResponse = response
+        download.saveJournal()
+        log("Downloading {} bytes in {} parts at once".format(length, len(ranges)))
+        return download
+
+    @staticmethod
+    def resume(url: str, target: str, log: LogFunc, progress: ProgressFunc, journal: dict, pool: ConnectionPool,
+               trace: RunTrace) -> 'SegmentedDownload':
+        download = SegmentedDownload(url, target, log, progress, journal["segments"], journal["length"],
+                                     journal["validator"], journal.get("validators") or {}, pool, trace)
+        log("Resuming download at {} of {} bytes".format(download.received, download.length))
+        return download
+
+    def saveJournal(self):
+        writeJournal(self.target, {"url": self.url, "validator": self.validator, "validators": self.newValidators,
+                                   "length": self.length, "segments": self.segments})
+
+    def recordWritten(self, segment: list, written: int):
+        with self.lock:
+            segment[2] = written
+            self.saveJournal()
+
+    def addReceived(self, count: int):
+        with self.lock:
+            self.received += count
+            received = self.received
+        if self.progress is not None:
+            self.progress(received, self.length)
+
+    def openSegment(self, start: int, end: int):
+        headers = {"Range": "bytes={}-{}".format(start, end - 1), "If-Range": self.validator}
+        try:
+            response = openUrl(self.url, headers, self.pool)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 416:
+                raise RangesNotSupported("bytes {}-{} not satisfiable".format(start, end - 1))
+            raise
+        if response.status != 206 or parseContentRangeStart(response.headers.get("Content-Range")) != start:
+            # e.g. the whole file, because it has changed since the other ranges were fetched
+            response.close()
+            raise RangesNotSupported("asked for bytes {}-{}, got status {}".format(start, end - 1, response.status))
+        return response
+
+    def fetchSegment(self, segment: list, response=None):
+        start, end, written = segment
+        position = start + written
+        if response is None:
+            response = self.openSegment(position, end)
+        with response, open(self.partPath, 'r+b') as out_file:
+            out_file.seek(position)
+            unflushed = 0
+            while position < end and not self.stopping.is_set():
+                chunk = response.read(min(chunkSize, end - position))
+                if not chunk:
+                    break
+                out_file.write(chunk)
+                position += len(chunk)
+                unflushed += len(chunk)
+                if unflushed >= journalInterval:
+                    out_file.flush()
+                    self.recordWritten(segment, position - start)
+                    unflushed = 0
+                self.addReceived(len(chunk))
+            out_file.flush()
+            self.recordWritten(segment, position - start)
+        if position < end and not self.stopping.is_set():
+            # The connection closed early, the journal lets the retry carry on from here
+            raise http.client.IncompleteRead(b"", end - position)
+
+    def run(self) -> dict:
+        # Returns the validators, with the "sha256" and "size" of the file, as fetchOnce() does
+        pending = [segment for segment in self.segments if segment[2] < segment[1] - segment[0]]
+        receivedBefore = self.received
+        with self.trace.span("transfer") as span:
+            with concurrent.futures.ThreadPoolExecutor(max(1, len(pending))) as executor:
+                # The response already started can only supply the first range
+                futures = [executor.submit(self.fetchSegment, segment,
+                                           self.firstResponse if segment is self.segments[0] else None)
+                           for segment in pending]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # e.g. cancelled, or one range failed: stop the others as well, then pass it on
+                    self.stopping.set()
+                    raise
+            span.add(bytes=self.received - receivedBefore)
+
+        # Every range is in place, so check the whole file and work out its SHA-256: reading it back is the only way,
+        # as the ranges arrived out of order
+        with self.trace.span("verify"):
+            if os.path.getsize(self.partPath) != self.length or \
+                    any(segment[2] != segment[1] - segment[0] for segment in self.segments):
+                raise Exception("Something went wrong: \"{}\" is incomplete".format(self.partPath))
+            sha = hashlib.sha256()
+            with open(self.partPath, 'rb') as in_file:
+                hashPrefix(in_file, self.length, sha)
+        os.replace(self.partPath, self.target)
+        os.unlink(getJournalPath(self.target))
+        return dict(self.newValidators, sha256=sha.hexdigest(), size=self.length)
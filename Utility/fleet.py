@@ -0,0 +1,94 @@
+import datetime
+import json
+import os
+import platform
+import typing
+import uuid
+
+# One USB stick serving several offline PCs, each at its own version
+# Every update (and rollback) writes this PC's record to `Fleet` on the stick:
+#     Fleet/<machine id>.json   - which PC (an id kept on the PC, see UpdateVariables.getMachineIdPath(), and its
+#                                 name), the branch it has installed and the digest of that version (see
+#                                 sync.getManifestDigest()), or no digest when that is not known (e.g. rolled back),
+#                                 and its Python version and platform
+# so the downloader can make a delta package (see delta.py) against each version some PC has, all in one pass,
+# and each PC's updater picks out the one made against its own version, and fetch the Python packages each PC's
+# Python needs (see wheelhouse.py)
+# The id is random rather than the PC's name, which can change and need not be unique
+
+
+class MachineRecord:
+    def __init__(self, machineId: str, name: str, branch: str, digest: typing.Optional[str], updated: str = None,
+                 python: str = None, platform: str = None):
+        self.machineId = machineId
+        self.name = name
+        self.branch = branch
+        self.digest = digest
+        self.updated = updated or datetime.datetime.now().isoformat(timespec="seconds")
+        # e.g. "3.11" and "win_amd64" (see wheelhouse.WheelTarget), None in records from before they were kept
+        self.python = python
+        self.platform = platform
+
+    def toJson(self) -> dict:
+        return {"machine": self.machineId, "name": self.name, "branch": self.branch, "digest": self.digest,
+                "updated": self.updated, "python": self.python, "platform": self.platform}
+
+    @staticmethod
+    def fromJson(data: dict) -> 'MachineRecord':
+        return MachineRecord(data["machine"], data.get("name", ""), data["branch"], data.get("digest"),
+                             data.get("updated"), data.get("python"), data.get("platform"))
+
+    def describe(self) -> str:
+        version = self.digest[:12] if self.digest else "an unknown version"
+        return "\"{}\" has branch \"{}\" at {} (updated {})".format(self.name, self.branch, version, self.updated)
+
+
+def getMachineId(path: str) -> str:
+    # This PC's id, made up the first time it is asked for
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)["machine"]
+    except (OSError, ValueError, KeyError):
+        pass
+    machineId = uuid.uuid4().hex
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"machine": machineId}, f)
+    return machineId
+
+
+def getMachineName() -> str:
+    return platform.node() or "unknown"
+
+
+def getRecordPath(fleetDir: str, machineId: str) -> str:
+    return os.path.join(fleetDir, "{}.json".format(machineId))
+
+
+def loadMachineRecord(fleetDir: str, machineId: str) -> typing.Optional[MachineRecord]:
+    try:
+        with open(getRecordPath(fleetDir, machineId), 'r') as f:
+            return MachineRecord.fromJson(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def saveMachineRecord(fleetDir: str, record: MachineRecord):
+    os.makedirs(fleetDir, exist_ok=True)
+    recordPath = getRecordPath(fleetDir, record.machineId)
+    with open(recordPath + ".tmp", 'w') as f:
+        json.dump(record.toJson(), f)
+    os.replace(recordPath + ".tmp", recordPath)
+
+
+def loadFleet(fleetDir: str) -> typing.List[MachineRecord]:
+    # Every PC this stick has updated, by name
+    if not os.path.isdir(fleetDir):
+        return []
+    records = []
+    for name in os.listdir(fleetDir):
+        if name.endswith(".json"):
+            record = loadMachineRecord(fleetDir, name[:-len(".json")])
+            if record is not None:
+                records.append(record)
+    return sorted(records, key=lambda record: record.name.lower())
@@ -0,0 +1,329 @@
+import os
+import shutil
+import typing
+
+from integrity import IntegrityError, IntegrityManifest, copyVerifiedWithStat
+from stagingjournal import StagingJournal, getJournalPath
+from sync import FileEntry, SyncPlan, SyncStats, buildManifest, getManifestDigest, getSourceDirectories, hashFile, \
+    toNativePath
+
+# Staged install: the new code is built in a staging directory next to `Code` (so on the same volume),
+# checked, and only then swapped in with two renames:
+#     Code -> OldCode-<date-time>,  CodeStaging -> Code
+# so the PC is never left without a working `Code` directory, however the copy goes
+# Rolling back is the same two renames the other way round, so it is instant whatever the size of the code
+#
+# Building the staging directory is journalled (see stagingjournal.py), so an update stopped part way carries on from
+# where it got to the next time
+#
+# Files which have not changed are hard-linked from the current `Code` into the staging directory rather than
+# copied, so the build costs time proportional to what changed (the snapshot and the new `Code` then share
+# those unchanged files, which is fine as the updater only ever replaces files, it never edits them in place)
+#
+# Whether a file has changed is decided by its SHA-256, not its timestamp (GitHub stamps every file in an archive with
+# the time of the commit, so timestamps say nothing about which files a commit touched)
+# The new code's hashes are known from the download, and the installed code's are kept next to `Code` as
+# "Code.manifest.json" (with each file's size and timestamp as installed), so only files touched since the install
+# are ever hashed again
+LogFunc = typing.Callable[[str], None]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+stagingDirName = "CodeStaging"
+snapshotPrefix = "OldCode-"
+manifestSuffix = ".manifest.json"
+
+
+def getStagingDir(codeDirPath: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(codeDirPath)), stagingDirName)
+
+
+def getUniquePath(path: str) -> str:
+    # Snapshot names only go down to the minute, so two updates in the same minute need telling apart
+    candidate = path
+    count = 2
+    while os.path.exists(candidate):
+        candidate = "{}-{}".format(path, count)
+        count += 1
+    return candidate
+
+
+def getInstalledManifestPath(codeDirPath: str) -> str:
+    # Next to the directory rather than in it, so it is never part of the code (works for the staging directory too)
+    return os.path.abspath(codeDirPath) + manifestSuffix
+
+
+def removeInstalledManifest(codeDirPath: str):
+    # Before `Code` is replaced, as the record no longer describes what will be there
+    try:
+        os.unlink(getInstalledManifestPath(codeDirPath))
+    except FileNotFoundError:
+        pass
+
+
+def getInstalledManifest(codeDirPath: str, sourceManifest: typing.Dict[str, FileEntry]) -> typing.Dict[str, FileEntry]:
+    # The files in `Code`, with the hash of each one which could be the same as its new version
+    # (the recorded hash where the file is as it was installed, otherwise worked out again)
+    manifest = buildManifest(codeDirPath)
+    installed = IntegrityManifest.load(getInstalledManifestPath(codeDirPath))
+    recorded = installed.files if installed is not None else {}
+    for relPath, entry in manifest.items():
+        sourceEntry = sourceManifest.get(relPath)
+        if sourceEntry is None or sourceEntry.hash is None or sourceEntry.size != entry.size:
+            continue
+        known = recorded.get(relPath)
+        if known is not None and known.hash is not None and known.size == entry.size and known.mtime == entry.mtime:
+            entry.hash = known.hash
+        else:
+            entry.hash = hashFile(toNativePath(codeDirPath, relPath))
+    return manifest
+
+
+def saveInstalledManifest(directory: str, actual: typing.Dict[str, FileEntry], expected: typing.Dict[str, FileEntry]):
+    # The files as they are in directory (actual, from buildManifest()), with their hashes from expected
+    files = {relPath: FileEntry(entry.size, entry.mtime, expected[relPath].hash) for relPath, entry in actual.items()}
+    IntegrityManifest(files=files).save(getInstalledManifestPath(directory))
+
+
+def linkOrCopy(sourcePath: str, targetPath: str):
+    try:
+        os.link(sourcePath, targetPath)
+    except OSError:
+        # e.g. FAT32, or a different volume
+        shutil.copy2(sourcePath, targetPath)
+
+
+def removeStaging(stagingDir: str):
+    if os.path.exists(stagingDir):
+        shutil.rmtree(stagingDir)
+    removeInstalledManifest(stagingDir)
+
+
+class DirectorySource:
+    """New code in a plain directory tree (`NewCode` on the USB stick), as a source for buildStaging()"""
+    # Other sources (e.g. objectstore.StoreSource) provide the same methods
+    # expected is what was downloaded (see integrity.py): the files must match it, and its hashes save reading
+    # every file to compare contents
+
+    def __init__(self, root: str, hashContents: bool = False, expected: typing.Dict[str, FileEntry] = None):
+        self.root = root
+        self.hashContents = hashContents
+        self.expected = expected
+
+    def getDescription(self) -> str:
+        return "\"{}\"".format(self.root)
+
+    def manifest(self) -> typing.Dict[str, FileEntry]:
+        if self.expected is None:
+            return buildManifest(self.root, self.hashContents)
+        actual = buildManifest(self.root)
+        missing = sorted(set(self.expected) - set(actual))
+        extra = sorted(set(actual) - set(self.expected))
+        wrong = sorted(path for path in self.expected if path in actual and actual[path].size != self.expected[path].size)
+        if missing or extra or wrong:
+            raise IntegrityError("\"{}\" is not what was downloaded: {} missing, {} unexpected, {} wrong size file(s)"
+                                 .format(self.root, len(missing), len(extra), len(wrong)))
+        for relPath, entry in actual.items():
+            entry.hash = self.expected[relPath].hash
+        return actual
+
+    def directories(self) -> typing.Set[str]:
+        return getSourceDirectories(self.root)
+
+    def copyFile(self, relPath: str, targetPath: str):
+        expectedHash = self.expected[relPath].hash if self.expected is not None else None
+        copyVerifiedWithStat(toNativePath(self.root, relPath), targetPath, expectedHash)
+
+
+def planStaging(source, codeDirPath: str, linkUnchanged: bool = True, hashContents: bool = False) -> SyncPlan:
+    # What building the staging directory from source would copy and link
+    # hashContents hashes every file in `Code` rather than trusting the record of what was installed
+    sourceManifest = source.manifest()
+    if not linkUnchanged:
+        targetManifest = {}
+    elif hashContents:
+        targetManifest = buildManifest(codeDirPath, hashContents)
+    else:
+        targetManifest = getInstalledManifest(codeDirPath, sourceManifest)
+    return SyncPlan(sourceManifest, targetManifest)
+
+
+def buildStaging(log: LogFunc, source, codeDirPath: str, progress: ProgressFunc = None,
+                 linkUnchanged: bool = True, hashContents: bool = False) -> typing.Tuple[str, SyncStats]:
+    # Build the complete new tree from source in the staging directory, returns (staging directory, stats)
+    # An earlier attempt at the same new code which did not finish is carried on from where it stopped
+    # (see stagingjournal.py), anything else left behind is not to be trusted and is removed
+    codeDirPath = os.path.abspath(codeDirPath)
+    stagingDir = getStagingDir(codeDirPath)
+    plan = planStaging(source, codeDirPath, linkUnchanged, hashContents)
+    sourceManifest = plan.source
+    journal = StagingJournal(getJournalPath(stagingDir), getManifestDigest(sourceManifest))
+    completed = set()
+    resuming = os.path.isdir(stagingDir) and journal.load()
+    if resuming:
+        if journal.staged:
+            log("\"{}\" was already built by an update which was interrupted".format(stagingDir))
+            verifyStaging(log, stagingDir, sourceManifest)
+            return stagingDir, SyncStats()
+        completed = journal.getCompleted(stagingDir, sourceManifest)
+        completed |= getLinkedCompleted(journal.done, plan.unchanged, codeDirPath, stagingDir, sourceManifest)
+        log("Carrying on building new code in \"{}\", {} file(s) already done by an update which was interrupted"
+            .format(stagingDir, len(completed)))
+    else:
+        removeStaging(stagingDir)
+        # The journal goes next to the staging directory, and on a first install nothing is there yet
+        os.makedirs(os.path.dirname(stagingDir), exist_ok=True)
+        journal.start()
+        log("Building new code in \"{}\"".format(stagingDir))
+    log("{} new, {} changed, {} removed, {} unchanged file(s)".format(
+        len(plan.added), len(plan.changed), len(plan.removed), len(plan.unchanged)))
+
+    for relDir in sorted(source.directories()):
+        os.makedirs(toNativePath(stagingDir, relDir), exist_ok=True)
+
+    stats = SyncStats()
+    stats.filesDeleted = len(plan.removed)
+    # Progress is in bytes copied, against what the plan says needs copying; linking is next to free
+    total = sum(sourceManifest[relPath].size for relPath in plan.added + plan.changed)
+    done = sum(sourceManifest[relPath].size for relPath in plan.added + plan.changed if relPath in completed)
+    with journal:
+        for relPath in plan.unchanged:
+            if relPath not in completed:
+                targetPath = toNativePath(stagingDir, relPath)
+                removePartial(targetPath, resuming)
+                linkOrCopy(toNativePath(codeDirPath, relPath), targetPath)
+                journal.addDone(relPath)
+            stats.filesSkipped += 1
+            stats.bytesSkipped += sourceManifest[relPath].size
+            if progress is not None:
+                progress(done, total)
+        for relPath in plan.added + plan.changed:
+            if relPath in completed:
+                continue
+            targetPath = toNativePath(stagingDir, relPath)
+            removePartial(targetPath, resuming)
+            source.copyFile(relPath, targetPath)
+            journal.addDone(relPath)
+            stats.filesCopied += 1
+            stats.bytesCopied += sourceManifest[relPath].size
+            done += sourceManifest[relPath].size
+            if progress is not None:
+                progress(done, total)
+        log(stats.summary())
+        saveInstalledManifest(stagingDir, verifyStaging(log, stagingDir, sourceManifest), sourceManifest)
+        journal.markStaged()
+    return stagingDir, stats
+
+
+def getStagedDigest(codeDirPath: str) -> typing.Optional[str]:
+    # The digest of the new code in the staging directory (see sync.getManifestDigest()), None if not known
+    journal = StagingJournal(getJournalPath(getStagingDir(codeDirPath)))
+    return journal.digest if journal.load() else None
+
+
+def getLinkedCompleted(done: typing.Set[str], unchanged: typing.List[str], codeDirPath: str, stagingDir: str,
+                       sourceManifest: typing.Dict[str, FileEntry]) -> typing.Set[str]:
+    # The unchanged files recorded as done which are still linked to (or copies of) the file in `Code`
+    # A link keeps the time of the file in `Code`, not the source's, so journal.getCompleted() never counts them
+    completed = set()
+    for relPath in set(done).intersection(unchanged):
+        codePath = toNativePath(codeDirPath, relPath)
+        stagedPath = toNativePath(stagingDir, relPath)
+        try:
+            if os.path.samefile(codePath, stagedPath):
+                completed.add(relPath)
+                continue
+            entry = sourceManifest[relPath]
+            if (entry.hash is not None and os.path.getsize(stagedPath) == entry.size and
+                    hashFile(stagedPath) == entry.hash):
+                completed.add(relPath)
+        except OSError:
+            continue
+    return completed
+
+
+def removePartial(targetPath: str, resuming: bool):
+    # When carrying on, a file may be half written, or be a hard link into `Code` (which must never be written
+    # through), so it is replaced rather than written over
+    if resuming and os.path.lexists(targetPath):
+        os.unlink(targetPath)
+
+
+def verifyStaging(log: LogFunc, stagingDir: str, expected: typing.Dict[str, FileEntry]) -> typing.Dict[str, FileEntry]:
+    # Check the staging directory holds exactly the expected files, at the expected sizes, returns what it holds
+    log("Checking \"{}\"".format(stagingDir))
+    actual = buildManifest(stagingDir)
+    missing = sorted(set(expected) - set(actual))
+    extra = sorted(set(actual) - set(expected))
+    wrong = sorted(path for path in expected if path in actual and actual[path].size != expected[path].size)
+    if missing or extra or wrong:
+        raise Exception("New code in \"{}\" is not as expected: {} missing, {} unexpected, {} wrong size file(s)"
+                        .format(stagingDir, len(missing), len(extra), len(wrong)))
+    return actual
+
+
+def swapInStaging(log: LogFunc, codeDirPath: str, snapshotName: str) -> typing.Optional[str]:
+    # Swap the staging directory in as `Code`, keeping the current `Code` as snapshotName
+    # Returns the snapshot's path (None if there was no `Code` to keep)
+    codeDirPath = os.path.abspath(codeDirPath)
+    stagingDir = getStagingDir(codeDirPath)
+    journal = StagingJournal(getJournalPath(stagingDir))
+    journal.load()
+    snapshotPath = None
+    removeInstalledManifest(codeDirPath)
+    if os.path.exists(codeDirPath):
+        snapshotPath = getUniquePath(os.path.join(os.path.dirname(codeDirPath), snapshotName))
+        # Recorded first, so if we are stopped between the two renames the next update knows where `Code` went
+        journal.markSwapping(snapshotPath)
+        log("Renaming \"{}\" to \"{}\"".format(codeDirPath, snapshotPath))
+        os.rename(codeDirPath, snapshotPath)
+    elif journal.snapshotPath is not None and os.path.exists(journal.snapshotPath):
+        # An update stopped between the two renames, so `Code` has already been kept
+        log("Finishing an update which was interrupted")
+        snapshotPath = journal.snapshotPath
+    log("Renaming \"{}\" to \"{}\"".format(stagingDir, codeDirPath))
+    try:
+        os.rename(stagingDir, codeDirPath)
+    except OSError:
+        # Put the old code straight back, so we are no worse off than before
+        journal.close()
+        if snapshotPath is not None and not os.path.exists(codeDirPath):
+            os.rename(snapshotPath, codeDirPath)
+        raise
+    # Not there after an update built without the record (staged before it was kept), so `Code` is hashed next time
+    if os.path.exists(getInstalledManifestPath(stagingDir)):
+        os.replace(getInstalledManifestPath(stagingDir), getInstalledManifestPath(codeDirPath))
+    journal.remove()
+    return snapshotPath
+
+
+def listSnapshots(codeDirPath: str) -> typing.List[str]:
+    # `OldCode-*` directories next to `Code`, newest first (the names sort by date)
+    parent = os.path.dirname(os.path.abspath(codeDirPath))
+    if not os.path.isdir(parent):
+        return []
+    names = [name for name in os.listdir(parent)
+             if name.startswith(snapshotPrefix) and os.path.isdir(os.path.join(parent, name))]
+    return [os.path.join(parent, name) for name in sorted(names, reverse=True)]
+
+
+def rollback(log: LogFunc, codeDirPath: str, snapshotPath: str, snapshotName: str) -> typing.Optional[str]:
+    # Make snapshotPath the `Code` directory again, keeping the current `Code` as a new snapshot
+    # (so a rollback can itself be rolled back), returns that new snapshot's path
+    codeDirPath = os.path.abspath(codeDirPath)
+    if not os.path.isdir(snapshotPath):
+        raise Exception("\"{}\" does not exist".format(snapshotPath))
+    # The snapshot's files have no record, so the next update hashes them
+    removeInstalledManifest(codeDirPath)
+    currentSnapshotPath = None
+    if os.path.exists(codeDirPath):
+        currentSnapshotPath = getUniquePath(os.path.join(os.path.dirname(codeDirPath), snapshotName))
+        log("Renaming \"{}\" to \"{}\"".format(codeDirPath, currentSnapshotPath))
+        os.rename(codeDirPath, currentSnapshotPath)
+    log("Renaming \"{}\" to \"{}\"".format(snapshotPath, codeDirPath))
+    try:
+        os.rename(snapshotPath, codeDirPath)
+    except OSError:
+        if currentSnapshotPath is not None:
+            os.rename(currentSnapshotPath, codeDirPath)
+        raise
+    return currentSnapshotPath
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import shutil
+import typing
+
+from sync import FileEntry
+
+# A record of exactly what was downloaded, kept next to `NewCode` as "NewCode.manifest.json"
+#     archive - url, ETag/Last-Modified, and the SHA-256 and size of the archive as it came off the network
+#     files   - path (relative to `NewCode`) -> size, timestamp and SHA-256 of each file as it was extracted
+# The hashes are all worked out as the bytes go past (see fetch.py, streamzip.QueuedReader, sinks.FileWriter),
+# never by reading anything back, so it costs no extra pass over the USB stick
+# The updater then checks each file against it as it copies it (which reads it anyway), so a file damaged on the
+# stick is caught before it goes anywhere near `Code`
+copyBufferSize = 1024 * 1024
+
+
+class IntegrityError(Exception):
+    """A file's contents are not what was downloaded"""
+
+
+class IntegrityManifest:
+    def __init__(self, archive: dict = None, files: typing.Dict[str, FileEntry] = None):
+        self.archive = archive or {}
+        self.files = files or {}
+
+    def save(self, path: str):
+        tmpPath = path + ".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump({"archive": self.archive,
+                       "files": {relPath: entry.toJson() for relPath, entry in sorted(self.files.items())}}, f)
+        os.replace(tmpPath, path)
+
+    @staticmethod
+    def load(path: str) -> typing.Optional['IntegrityManifest']:
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return IntegrityManifest(data.get("archive"),
+                                 {relPath: FileEntry.fromJson(entry) for relPath, entry in data["files"].items()})
+
+    def getFiles(self, prefix: str = "") -> typing.Dict[str, FileEntry]:
+        # The entries under the directory prefix, relative to it
+        # (e.g. prefix "Jinn-master" for the folder GitHub puts everything in)
+        if not prefix:
+            return dict(self.files)
+        prefix = prefix.rstrip("/") + "/"
+        return {relPath[len(prefix):]: entry for relPath, entry in self.files.items() if relPath.startswith(prefix)}
+
+
+def copyVerified(sourcePath: str, targetPath: str, expectedHash: str):
+    # Copy a file, checking its SHA-256 on the way through
+    # On a mismatch the copy is removed and IntegrityError raised
+    sha = hashlib.sha256()
+    with open(sourcePath, 'rb') as source, open(targetPath, 'wb') as target:
+        while True:
+            data = source.read(copyBufferSize)
+            if not data:
+                break
+            sha.update(data)
+            target.write(data)
+    if sha.hexdigest() != expectedHash:
+        os.unlink(targetPath)
+        raise IntegrityError("\"{}\" is not the file which was downloaded (SHA-256 {}, expected {})"
+                             .format(sourcePath, sha.hexdigest(), expectedHash))
+
+
+def copyVerifiedWithStat(sourcePath: str, targetPath: str, expectedHash: typing.Optional[str]):
+    # shutil.copy2(), but checked against expectedHash when there is one
+    if expectedHash is None:
+        shutil.copy2(sourcePath, targetPath)
+        return
+    copyVerified(sourcePath, targetPath, expectedHash)
+    shutil.copystat(sourcePath, targetPath)
@@ -0,0 +1,124 @@
+import typing
+
+from pipeline import LogFunc, ProgressFunc, PipelineCancelled, downloadZipFile, extractFromZipFile, streamZipFile, \
+    indexZipFile, storeZipFile, storeBranches, getDeliveryBranches, packageDelta, downloadWheels, stageNewCode, \
+    installStagedCode, installPackages, planUpdate, rollbackCode, tidySnapshots
+from tracing import RunTrace
+from updatevariables import UpdateVariables
+
+# Which pipeline steps make up a download, an update or a rollback, for each combination of options
+# Both front ends run the same list: the dialogs on a PipelineWorker (see workers.py), the command line
+# directly (see cli.py), so they can never drift apart
+# A phase is (name, func), where func(log, getProgress) does the work and getProgress(name) gives a progress
+# function for whatever is being reported on (the phase itself, or e.g. one of several branches)
+GetProgressFunc = typing.Callable[[str], ProgressFunc]
+PhaseFunc = typing.Callable[[LogFunc, GetProgressFunc], None]
+Phase = typing.Tuple[str, PhaseFunc]
+
+
+def getDownloadPhases(updateVariables: UpdateVariables, stream: bool = True, useStore: bool = False,
+                      branches: typing.List[str] = None, bytesPerSecond: int = None,
+                      trace: RunTrace = None, keepArchive: bool = False, delta: bool = False,
+                      packages: bool = False) -> typing.List[Phase]:
+    # The code, then (with packages) the Python packages it needs as wheels on the stick (see wheelhouse.py),
+    # read from wherever the code was put
+    phases = getCodeDownloadPhases(updateVariables, stream, useStore, branches, bytesPerSecond, trace, keepArchive,
+                                   delta)
+    if not packages:
+        return phases
+    # In the same order of precedence as getCodeDownloadPhases()
+    downloaded = branches or [updateVariables.githubBranchName]
+    storePath = None
+    if delta:
+        downloaded = getDeliveryBranches(updateVariables, branches)
+        storePath = updateVariables.getDeliveryCachePath()
+    elif branches or (useStore and not keepArchive):
+        storePath = updateVariables.getStorePath()
+    phases.append(("Packages", lambda log, getProgress: downloadWheels(log, updateVariables, downloaded,
+                                                                      getProgress("Packages"), storePath,
+                                                                      keepArchive and storePath is None)))
+    return phases
+
+
+def getCodeDownloadPhases(updateVariables: UpdateVariables, stream: bool = True, useStore: bool = False,
+                          branches: typing.List[str] = None, bytesPerSecond: int = None,
+                          trace: RunTrace = None, keepArchive: bool = False, delta: bool = False) -> typing.List[Phase]:
+    # branches: download all of these at once into the object store, rather than updateVariables' branch
+    if delta:
+        # download these and every branch an offline PC has to the delivery cache on this PC, then put only the
+        # changes each of those PCs needs on the stick (see delta.py and fleet.py)
+        deliveryBranches = getDeliveryBranches(updateVariables, branches)
+        cachePath = updateVariables.getDeliveryCachePath()
+        return [("Download", lambda log, getProgress: storeBranches(log, deliveryBranches, getProgress, stream,
+                                                                    bytesPerSecond=bytesPerSecond, trace=trace,
+                                                                    storePath=cachePath)),
+                ("Package", lambda log, getProgress: packageDelta(log, updateVariables, deliveryBranches,
+                                                                  getProgress("Package")))]
+    if branches:
+        return [("Download branches",
+                 lambda log, getProgress: storeBranches(log, branches, getProgress, stream,
+                                                        bytesPerSecond=bytesPerSecond, trace=trace))]
+    if keepArchive:
+        # download the zip file and leave it as it is, with an index of what is in it (see archivesource.py)
+        return [("Download", lambda log, getProgress: downloadZipFile(log, updateVariables, getProgress("Download"),
+                                                                      keepArchive=True)),
+                ("Index", lambda log, getProgress: indexZipFile(log, updateVariables, getProgress("Index")))]
+    if useStore:
+        # download into the object store on the stick, alongside any other branches already there
+        name = "Download and store"
+        return [(name, lambda log, getProgress: storeZipFile(log, updateVariables, getProgress(name), stream))]
+    if stream:
+        # download and extract in one go, straight into the `NewCode` directory
+        name = "Download and extract"
+        return [(name, lambda log, getProgress: streamZipFile(log, updateVariables, getProgress(name)))]
+    # download the zip file from github to the `Jinn` directory,
+    # then extract from the zip file to create `Jinn-master` directory in `Jinn` directory
+    return [("Download", lambda log, getProgress: downloadZipFile(log, updateVariables, getProgress("Download"))),
+            ("Extract", lambda log, getProgress: extractFromZipFile(log, updateVariables, getProgress("Extract")))]
+
+
+def getUpdatePhases(updateVariables: UpdateVariables, codeDirPath: str, linkUnchanged: bool = True,
+                    hashContents: bool = False, branch: str = None, archive: str = None,
+                    delta: str = None, packages: bool = False) -> typing.List[Phase]:
+    # Build the new code next to the old code directory, then swap it in and keep the old one
+    # branch: from the object store rather than `NewCode`, archive: straight from that branch's zip on the stick,
+    # delta: by applying that branch's package of changes to the old code
+    # packages: then install the Python packages it needs from the stick (see wheelhouse.py)
+    phases = [("Copy", lambda log, getProgress: stageNewCode(log, updateVariables, codeDirPath, getProgress("Copy"),
+                                                            linkUnchanged, hashContents, branch, archive, delta)),
+              ("Install", lambda log, getProgress: installStagedCode(log, updateVariables, codeDirPath,
+                                                                    branch or archive or delta))]
+    if packages:
+        phases.append(("Packages", lambda log, getProgress: installPackages(log, updateVariables, codeDirPath,
+                                                                           branch or archive or delta)))
+    return phases
+
+
+def getPlanPhases(updateVariables: UpdateVariables, codeDirPath: str, linkUnchanged: bool = True,
+                  hashContents: bool = False, branch: str = None, archive: str = None,
+                  delta: str = None) -> typing.List[Phase]:
+    # A dry run of getUpdatePhases() with the same options: what it would do and how long it should take
+    return [("Plan", lambda log, getProgress: planUpdate(log, updateVariables, codeDirPath, linkUnchanged,
+                                                        hashContents, branch, archive, delta))]
+
+
+def getRollbackPhases(updateVariables: UpdateVariables, codeDirPath: str, snapshotPath: str) -> typing.List[Phase]:
+    return [("Rollback", lambda log, getProgress: rollbackCode(log, updateVariables, codeDirPath, snapshotPath,
+                                                              getProgress("Rollback")))]
+
+
+def getTidyPhases(updateVariables: UpdateVariables, codeDirPath: str) -> typing.List[Phase]:
+    return [("Tidy", lambda log, getProgress: tidySnapshots(log, updateVariables, codeDirPath, getProgress("Tidy")))]
+
+
+def runPhases(phases: typing.List[Phase], log: LogFunc, getProgress: GetProgressFunc, trace: RunTrace = None,
+              isCancelled: typing.Callable[[], bool] = None):
+    # Run the phases one after another on this thread (PipelineWorker.run() is the same, on a QThread)
+    for name, func in phases:
+        if isCancelled is not None and isCancelled():
+            raise PipelineCancelled("Cancelled before \"{}\"".format(name))
+        if trace is not None:
+            with trace.span(name, isPhase=True):
+                func(log, getProgress)
+        else:
+            func(log, getProgress)
@@ -0,0 +1,175 @@
+import concurrent.futures
+import json
+import os
+import stat
+import threading
+import typing
+
+# Finds Jinn installations (a "Jinn\Code" directory containing "home.py") on this PC
+# Walking the whole of C:\ takes minutes, so instead we try, in order:
+#     1. installations found on a previous run (cached on this PC), each re-checked with a single stat
+#     2. the places Jinn is normally installed
+#     3. a depth-limited os.scandir() search of the drive, one thread per top-level directory,
+#        skipping system and hidden directories and stopping as soon as an installation is found
+LogFunc = typing.Optional[typing.Callable[[str], None]]
+
+# The file which marks a directory as a Jinn code directory
+markerFile = "home.py"
+# How deep below the drive root the search goes
+defaultMaxDepth = 6
+# Directory names (lower case) never worth searching
+skipDirNames = {
+    "windows", "$recycle.bin", "$windows.~bt", "$windows.~ws", "system volume information", "recovery",
+    "programdata", "program files", "program files (x86)", "msocache", "perflogs", "intel", "amd", "nvidia",
+    "appdata", "node_modules", "__pycache__", "site-packages", ".git", "proc", "sys", "dev",
+}
+# On Windows, directories with these attributes are skipped as well
+skipAttributes = (stat.FILE_ATTRIBUTE_HIDDEN | stat.FILE_ATTRIBUTE_SYSTEM) if os.name == "nt" else 0
+
+
+def getDefaultDriveRoot() -> str:
+    if os.name == "nt":
+        return os.environ.get("SystemDrive", "C:") + "\\"
+    return "/"
+
+
+def getCachePath() -> str:
+    # The cache belongs to this PC, not to the USB stick (which visits several PCs)
+    base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".jinn")
+    return os.path.join(base, "Jinn", "locator.json")
+
+
+def isJinnCodeDir(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, markerFile))
+
+
+def loadCachedPaths(cachePath: str = None) -> typing.List[str]:
+    # Re-validate each cached path cheaply (one stat each), dropping any that have gone
+    cachePath = cachePath or getCachePath()
+    try:
+        with open(cachePath, 'r') as f:
+            paths = json.load(f).get("paths", [])
+    except (OSError, ValueError, AttributeError):
+        return []
+    return [path for path in paths if isJinnCodeDir(path)]
+
+
+def saveCachedPaths(paths: typing.List[str], cachePath: str = None):
+    cachePath = cachePath or getCachePath()
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with open(cachePath, 'w') as f:
+            json.dump({"paths": paths}, f, indent=2)
+    except OSError:
+        # Not being able to cache just means the next search is slower
+        pass
+
+
+def getLikelyCodeDirs(driveRoot: str) -> typing.List[str]:
+    home = os.path.expanduser("~")
+    candidates = [
+        os.path.join(driveRoot, "Jinn", "Code"),
+        os.path.join(home, "Jinn", "Code"),
+        os.path.join(home, "Documents", "Jinn", "Code"),
+        os.path.join(home, "Desktop", "Jinn", "Code"),
+    ]
+    # Other users' home directories, where the PC is shared
+    usersDir = os.path.join(driveRoot, "Users")
+    if os.path.isdir(usersDir):
+        try:
+            with os.scandir(usersDir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        candidates.append(os.path.join(entry.path, "Jinn", "Code"))
+                        candidates.append(os.path.join(entry.path, "Documents", "Jinn", "Code"))
+        except OSError:
+            pass
+    return candidates
+
+
+def shouldSkip(entry: os.DirEntry) -> bool:
+    name = entry.name.lower()
+    if name in skipDirNames or name.startswith((".", "$")):
+        return True
+    if skipAttributes:
+        try:
+            # On Windows DirEntry.stat() comes from the directory listing, so this costs no extra disk access
+            if entry.stat(follow_symlinks=False).st_file_attributes & skipAttributes:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def scanTree(top: str, maxDepth: int, stopEvent: threading.Event) -> typing.List[str]:
+    # Depth-limited search of one subtree for "...\Jinn\Code" directories containing home.py
+    found = []
+    stack = [(top, 1)]
+    while stack and not stopEvent.is_set():
+        path, depth = stack.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False) or shouldSkip(entry):
+                        continue
+                    if entry.name.lower() == "code" and os.path.basename(path).lower() == "jinn":
+                        if isJinnCodeDir(entry.path):
+                            found.append(entry.path)
+                            stopEvent.set()
+                        # Nothing to find inside a code directory
+                        continue
+                    if depth < maxDepth:
+                        stack.append((entry.path, depth + 1))
+        except OSError:
+            # No permission etc., just leave that directory out
+            continue
+    return found
+
+
+def searchDrive(driveRoot: str, maxDepth: int = defaultMaxDepth, log: LogFunc = None) -> typing.List[str]:
+    topLevel = []
+    try:
+        with os.scandir(driveRoot) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and not shouldSkip(entry):
+                    topLevel.append(entry.path)
+    except OSError:
+        return []
+    if log is not None:
+        log("Searching {} folders under \"{}\"".format(len(topLevel), driveRoot))
+
+    # Each top-level directory is searched on its own thread; the first to find an installation stops the rest
+    stopEvent = threading.Event()
+    found = []
+    with concurrent.futures.ThreadPoolExecutor(min(16, max(1, len(topLevel)))) as executor:
+        futures = [executor.submit(scanTree, path, maxDepth, stopEvent) for path in topLevel]
+        for future in futures:
+            found.extend(future.result())
+    return sorted(found)
+
+
+def locateJinnInstallations(driveRoot: str = None, maxDepth: int = defaultMaxDepth, useCache: bool = True,
+                            log: LogFunc = None) -> typing.List[str]:
+    driveRoot = driveRoot or getDefaultDriveRoot()
+    if useCache:
+        paths = loadCachedPaths()
+        if paths:
+            if log is not None:
+                log("Found previously located Jinn installation(s)")
+            return paths
+
+    paths = [path for path in getLikelyCodeDirs(driveRoot) if isJinnCodeDir(path)]
+    if not paths:
+        if log is not None:
+            log("Jinn is not in any of the usual places, searching \"{}\"".format(driveRoot))
+        paths = searchDrive(driveRoot, maxDepth, log)
+
+    # Remove duplicates (e.g. the same directory reached via home and via C:\Users), keeping the order
+    unique = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        unique.setdefault(os.path.normcase(path), path)
+    paths = list(unique.values())
+    if paths:
+        saveCachedPaths(paths)
+    return paths
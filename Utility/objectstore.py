@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import typing
+
+from integrity import copyVerified
+from sinks import NullWriter, getMemberParts
+from sync import FileEntry
+
+# Content-addressed store for keeping several branches on the USB stick at once
+#     ObjectStore/objects/ab/abcdef...     - each distinct file content once, named by its SHA-256
+#     ObjectStore/branches/<branch>.json   - per branch: path -> hash, size, mtime (plus the archive's validators)
+# Most files are identical between HJinn, LJinn and master, so storing all three costs roughly one branch
+# plus the differences, and the updater materialises whichever branch is wanted from the blobs
+LogFunc = typing.Optional[typing.Callable[[str], None]]
+
+# Members up to this size are hashed in memory and only written if the store doesn't have them yet,
+# larger ones are spooled to a temporary file in the store while hashing
+spoolThreshold = 8 * 1024 * 1024
+
+
+class ObjectStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.objectsDir = os.path.join(root, "objects")
+        self.branchesDir = os.path.join(root, "branches")
+        self.tmpDir = os.path.join(root, "tmp")
+
+    def getObjectPath(self, hash: str) -> str:
+        return os.path.join(self.objectsDir, hash[:2], hash)
+
+    def hasObject(self, hash: str) -> bool:
+        return os.path.exists(self.getObjectPath(hash))
+
+    def commitFile(self, tmpPath: str, hash: str):
+        # Move a complete temporary file into place as an object, unless we already have that content
+        objectPath = self.getObjectPath(hash)
+        if os.path.exists(objectPath):
+            os.unlink(tmpPath)
+            return
+        os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+        os.replace(tmpPath, objectPath)
+
+    def addBytes(self, data: bytes) -> str:
+        hash = hashlib.sha256(data).hexdigest()
+        if not self.hasObject(hash):
+            with self.createTempFile() as f:
+                f.write(data)
+            self.commitFile(f.name, hash)
+        return hash
+
+    def createTempFile(self):
+        # Temporary files live inside the store, so committing them is a rename on the same volume
+        os.makedirs(self.tmpDir, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.tmpDir, delete=False)
+
+    def getBranchPath(self, branch: str) -> str:
+        return os.path.join(self.branchesDir, "{}.json".format(branch))
+
+    def loadBranch(self, branch: str) -> typing.Optional[dict]:
+        try:
+            with open(self.getBranchPath(branch), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def saveBranch(self, branch: str, files: typing.Dict[str, FileEntry], validators: dict = None):
+        os.makedirs(self.branchesDir, exist_ok=True)
+        branchPath = self.getBranchPath(branch)
+        with open(branchPath + ".tmp", 'w') as f:
+            json.dump({"branch": branch, "validators": validators,
+                       "files": {path: entry.toJson() for path, entry in sorted(files.items())}}, f)
+        os.replace(branchPath + ".tmp", branchPath)
+
+    def listBranches(self) -> typing.List[str]:
+        if not os.path.isdir(self.branchesDir):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.branchesDir) if name.endswith(".json"))
+
+    def getBranchManifest(self, branch: str) -> typing.Dict[str, FileEntry]:
+        data = self.loadBranch(branch)
+        if data is None:
+            raise Exception("Branch \"{}\" is not in the store \"{}\"".format(branch, self.root))
+        return {path: FileEntry.fromJson(entry) for path, entry in data["files"].items()}
+
+    def copyObject(self, hash: str, targetPath: str, timestamp: float = None, verify: bool = False):
+        if verify:
+            copyVerified(self.getObjectPath(hash), targetPath, hash)
+        else:
+            shutil.copyfile(self.getObjectPath(hash), targetPath)
+        if timestamp is not None:
+            os.utime(targetPath, (timestamp, timestamp))
+
+    def getReferenced(self) -> typing.Set[str]:
+        # The blobs still in use: every file of every branch
+        referenced = set()
+        for branch in self.listBranches():
+            data = self.loadBranch(branch) or {"files": {}}
+            referenced.update(entry["hash"] for entry in data["files"].values())
+        return referenced
+
+    def removeUnreferenced(self) -> int:
+        # Delete blobs no branch uses any more (and any temporary files left by an interrupted download)
+        referenced = self.getReferenced()
+        removed = 0
+        if os.path.isdir(self.objectsDir):
+            for prefix in os.listdir(self.objectsDir):
+                prefixDir = os.path.join(self.objectsDir, prefix)
+                for name in os.listdir(prefixDir):
+                    if name not in referenced:
+                        os.unlink(os.path.join(prefixDir, name))
+                        removed += 1
+        if os.path.isdir(self.tmpDir):
+            shutil.rmtree(self.tmpDir, ignore_errors=True)
+        return removed
+
+
+def stripTopLevel(name: str) -> typing.Optional[str]:
+    # GitHub archives put everything under "Jinn-<branch>/", which would stop branches sharing paths
+    parts = getMemberParts(name)
+    if len(parts) < 2:
+        return None
+    return "/".join(parts[1:])
+
+
+class StoreWriter:
+    """Hashes a member as it is written, and adds it to the store (if new) when it is complete"""
+
+    def __init__(self, sink: 'StoreSink', relPath: str, timestamp: float):
+        self.sink = sink
+        self.relPath = relPath
+        self.timestamp = timestamp
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.buffer = []
+        self.spoolFile = None
+
+    def write(self, data: bytes):
+        self.sha.update(data)
+        self.size += len(data)
+        if self.spoolFile is not None:
+            self.spoolFile.write(data)
+            return
+        self.buffer.append(data)
+        if self.size > spoolThreshold:
+            self.spoolFile = self.sink.store.createTempFile()
+            for part in self.buffer:
+                self.spoolFile.write(part)
+            self.buffer = []
+
+    def close(self):
+        hash = self.sha.hexdigest()
+        store = self.sink.store
+        if self.spoolFile is not None:
+            self.spoolFile.close()
+            store.commitFile(self.spoolFile.name, hash)
+        elif not store.hasObject(hash):
+            with store.createTempFile() as f:
+                for part in self.buffer:
+                    f.write(part)
+            store.commitFile(f.name, hash)
+        self.buffer = []
+        self.sink.addEntry(self.relPath, FileEntry(self.size, self.timestamp, hash))
+
+    def abort(self):
+        self.buffer = []
+        if self.spoolFile is not None:
+            self.spoolFile.close()
+            os.unlink(self.spoolFile.name)
+
+
+class StoreSink:
+    """An extraction sink (see sinks.py) which puts a branch's files into the object store"""
+
+    def __init__(self, store: ObjectStore, branch: str, validators: dict = None):
+        self.store = store
+        self.branch = branch
+        self.validators = validators
+        self.files = {}
+        self.filesLock = threading.Lock()
+
+    def prepare(self, names: typing.Iterable[str]):
+        pass
+
+    def addDirectory(self, name: str):
+        # Directories are implied by the paths of the files in them
+        pass
+
+    def openFile(self, name: str, timestamp: float = None):
+        relPath = stripTopLevel(name)
+        if relPath is None:
+            return NullWriter()
+        return StoreWriter(self, relPath, timestamp)
+
+    def addEntry(self, relPath: str, entry: FileEntry):
+        with self.filesLock:
+            self.files[relPath] = entry
+
+    def finish(self):
+        # Only now is the branch recorded, so an interrupted download never leaves a half-complete branch
+        self.store.saveBranch(self.branch, self.files, self.validators)
+
+
+class StoreSource:
+    """The files of one branch in the store, as a source for building the staging directory (see install.py)"""
+
+    def __init__(self, store: ObjectStore, branch: str):
+        self.store = store
+        self.branch = branch
+        self.files = store.getBranchManifest(branch)
+
+    def getDescription(self) -> str:
+        return "branch \"{}\" in \"{}\"".format(self.branch, self.store.root)
+
+    def manifest(self) -> typing.Dict[str, FileEntry]:
+        return dict(self.files)
+
+    def directories(self) -> typing.Set[str]:
+        directories = {"."}
+        for relPath in self.files:
+            parts = relPath.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                directories.add("/".join(parts[:i]))
+        return directories
+
+    def copyFile(self, relPath: str, targetPath: str):
+        # Blobs are named by their hash, so checking the copy against it catches any damaged on the stick
+        entry = self.files[relPath]
+        self.store.copyObject(entry.hash, targetPath, entry.mtime, verify=True)
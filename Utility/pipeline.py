@@ -0,0 +1,592 @@
+import concurrent.futures
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import typing
+import urllib.error
+
+from connections import ConnectionPool
+from delta import DeltaSource, DeltaStore, buildPackages
+from extraction import extractParallel
+from fetch import fetchToFile, openUrl, getConditionalHeaders, getResponseValidators
+from fleet import MachineRecord, getMachineId, getMachineName, loadFleet, loadMachineRecord, saveMachineRecord
+from integrity import IntegrityManifest
+from archivesource import ZipSource
+from install import DirectorySource, buildStaging, getStagedDigest, planStaging, swapInStaging, rollback
+from objectstore import ObjectStore, StoreSink, StoreSource
+from planner import UpdatePlan, makePlan
+from progressmodel import PipelineCancelled
+from sinks import DirectorySink, IndexSink
+from snapshots import expandSnapshot, isSnapshotArchive, manageSnapshots
+from streamzip import QueuedReader, StreamingZipExtractor, NotStreamableError
+from sync import FileEntry
+from tracing import RunTrace, Span, appendHistory, loadHistory
+from updatevariables import UpdateVariables
+from wheelhouse import WheelTarget, Wheelhouse, buildWheelhouse, getLocalTarget, installWheels, requirementsFile
+
+# The download/extract/update steps live here rather than in the dialogs so that they never touch a widget
+# They are run on a background thread (see workers.py) and report back via plain callables:
+#     log(text)                 - append a line to whatever log the caller is showing
+#     progress(done, total)     - report how far through the current phase we are, in bytes (total may be 0 if unknown)
+LogFunc = typing.Callable[[str], None]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+
+def setRootDir():
+    # Store the parent of the directory this module is executing from in rootDir
+    # this will be used as the root/parent of where the "Code" directory resides
+    from inspect import currentframe, getframeinfo
+    filename = getframeinfo(currentframe()).filename
+    # get "Code" directory
+    dir = os.path.dirname(os.path.realpath(filename))
+    # set rootDir as *parent* of "Code" directory, i.e. "Jinn" directory
+    global rootDir
+    rootDir = os.path.dirname(dir)
+    # Return output as string
+    UpdateVariables.rootDir = rootDir
+    return str(rootDir)
+
+
+def checkProceed() -> bool:
+    while True:
+        sys.stderr.write("Proceed? [y/n]")
+        sys.stderr.flush()
+        answer = sys.stdin.readline().lower()
+        if answer.startswith("y"):
+            return True
+        elif answer.startswith("n"):
+            return False
+        else:
+            sys.stderr.write("Please type 'y' or 'n', followed by the RETURN/ENTER key\n")
+
+
+def checkNotRunningFromCodeDir(updateVariables: UpdateVariables):
+    cwd = os.getcwd()
+    dirname = os.path.basename(cwd)
+    if dirname.upper() == updateVariables.codeDir.upper():
+        raise Exception("This script must not be run with the current directory being \"{}\""
+                        ", because it needs to replace that directory".format(cwd))
+
+
+def downloadZipFile(log: LogFunc, updateVariables: UpdateVariables, progress: ProgressFunc = None,
+                    keepArchive: bool = False):
+    # keepArchive: the zip is all the USB stick is to carry (see archivesource.py), rather than being extracted
+    zipFilePath = updateVariables.getPath(updateVariables.zipDir)
+    os.makedirs(zipFilePath, exist_ok=True)
+    zipFile = updateVariables.getZipFile()
+    zipFileTarget = os.path.join(zipFilePath, zipFile)
+    zipFileUrl = updateVariables.getZipFileUrl()
+    log("Downloading Zip file from \"{}\" to \"{}\"\n".format(zipFileUrl, zipFileTarget))
+    # The download goes to "<branch>.zip.part" first, so a dropped connection can be resumed next time
+    # rather than leaving a half-written zip behind (see fetch.py)
+    # If "NewCode" (or with keepArchive, the indexed zip) already holds this branch the request is conditional,
+    # and a "304 Not Modified" ends it at once
+    validators = loadArchiveValidators(updateVariables) if keepArchive else loadValidators(updateVariables)
+    updateVariables.archiveValidators = fetchToFile(zipFileUrl, zipFileTarget, log, progress, validators,
+                                                    trace=updateVariables.trace,
+                                                    segments=updateVariables.downloadSegments)
+    if updateVariables.archiveValidators is None:
+        updateVariables.archiveUnchanged = True
+        log("Branch \"{}\" has not changed since it was last downloaded.".format(updateVariables.githubBranchName))
+        return
+    # Whatever index there was describes the zip just replaced
+    if os.path.exists(updateVariables.getArchiveIndexPath()):
+        os.unlink(updateVariables.getArchiveIndexPath())
+    log("Download finished.")
+    if not os.path.exists(zipFileTarget):
+        raise Exception("Something went wrong: expected to create \"{}\"".format(zipFileTarget))
+
+
+def loadArchiveValidators(updateVariables: UpdateVariables) -> typing.Optional[dict]:
+    # The ETag/Last-Modified of the zip kept on the stick, as recorded in its index
+    if not os.path.exists(updateVariables.getArchivePath()):
+        return None
+    index = IntegrityManifest.load(updateVariables.getArchiveIndexPath())
+    return index.archive if index is not None else None
+
+
+def indexZipFile(log: LogFunc, updateVariables: UpdateVariables, progress: ProgressFunc = None):
+    # Record the size, timestamp and SHA-256 of every file in the zip just downloaded, leaving the zip as it is
+    # (archive-only mode, see archivesource.py); the zip is read back once, nothing is written but the index
+    if updateVariables.archiveUnchanged:
+        log("Keeping the archive already on the stick, \"{}\"".format(updateVariables.getArchivePath()))
+        return
+    zipFilePath = updateVariables.getArchivePath()
+    indexPath = updateVariables.getArchiveIndexPath()
+    log("Indexing Zip file \"{}\"".format(zipFilePath))
+    sink = IndexSink(updateVariables.getZipExtractedDir())
+    with updateVariables.trace.span("index") as span:
+        extractParallel(zipFilePath, sink.destDir, progress=progress, sink=sink)
+        addFilesToSpan(span, sink.files)
+    archive = dict(updateVariables.archiveValidators or {}, url=updateVariables.getZipFileUrl())
+    IntegrityManifest(archive, sink.files).save(indexPath)
+    log("SHA-256 of the archive and of {} file(s) saved to \"{}\"".format(len(sink.files), indexPath))
+
+
+def loadValidators(updateVariables: UpdateVariables) -> typing.Optional[dict]:
+    # Only worth a conditional request if the previously extracted code is still there to be reused
+    validatorsPath = updateVariables.getValidatorsPath()
+    extractedDir = updateVariables.getZipExtractedDir()
+    if not os.path.exists(validatorsPath) or not os.path.isdir(extractedDir) or not os.listdir(extractedDir):
+        return None
+    try:
+        with open(validatorsPath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def saveValidators(updateVariables: UpdateVariables):
+    if not updateVariables.archiveValidators:
+        return
+    os.makedirs(updateVariables.getPath(updateVariables.zipDir), exist_ok=True)
+    with open(updateVariables.getValidatorsPath(), 'w') as f:
+        json.dump(updateVariables.archiveValidators, f)
+
+
+def extractFromZipFile(log: LogFunc, updateVariables: UpdateVariables, progress: ProgressFunc = None):
+    if updateVariables.archiveUnchanged:
+        log("Reusing the code already extracted to \"{}\"".format(updateVariables.getZipExtractedDir()))
+        return
+    log("Clearing old extracted code")
+    with updateVariables.trace.span("clear"):
+        updateVariables.clearExtractedFolder()
+    zipFileDir = updateVariables.getPath(updateVariables.zipDir)
+    zipFile = updateVariables.getZipFile()
+    zipFilePath = os.path.join(zipFileDir, zipFile)
+    zipExtractedDirPath = updateVariables.getZipExtractedDir()
+    log("Extracting from Zip file \"{}\" to \"{}\"\n".format(zipFilePath, zipExtractedDirPath))
+    # Members are extracted by a pool of threads (see extraction.py), any failures are reported together at the end
+    sink = DirectorySink(zipExtractedDirPath)
+    with updateVariables.trace.span("extract") as span:
+        extractParallel(zipFilePath, zipExtractedDirPath, log, progress, sink=sink)
+        addFilesToSpan(span, sink.files)
+
+    if not os.path.exists(zipExtractedDirPath):
+        raise Exception("Something went wrong: expected to create \"{}\"".format(zipExtractedDirPath))
+    if os.path.exists(zipFilePath):
+        os.unlink(zipFilePath)
+    # Only now that "NewCode" is complete do we remember the validators, ready for a conditional request next time
+    saveValidators(updateVariables)
+    saveIntegrityManifest(log, updateVariables, sink)
+
+
+def addFilesToSpan(span: Span, files: typing.Dict[str, FileEntry]):
+    span.add(bytes=sum(entry.size for entry in files.values()), files=len(files))
+
+
+def saveIntegrityManifest(log: LogFunc, updateVariables: UpdateVariables, sink: DirectorySink):
+    # The hashes of the archive and of every file in "NewCode", all worked out as they were written (see integrity.py)
+    archive = dict(updateVariables.archiveValidators or {}, url=updateVariables.getZipFileUrl())
+    manifestPath = updateVariables.getManifestPath()
+    IntegrityManifest(archive, sink.files).save(manifestPath)
+    log("SHA-256 of the archive and of {} file(s) saved to \"{}\"".format(len(sink.files), manifestPath))
+
+
+def streamZipFile(log: LogFunc, updateVariables: UpdateVariables, progress: ProgressFunc = None):
+    # Download and extract at the same time, straight into "NewCode", without writing the zip to the USB stick
+    # (see streamzip.py), so every byte is written to the stick once rather than twice
+    zipFileUrl = updateVariables.getZipFileUrl()
+    zipExtractedDirPath = updateVariables.getZipExtractedDir()
+    log("Downloading and extracting Zip file from \"{}\" to \"{}\"\n".format(zipFileUrl, zipExtractedDirPath))
+    validators = loadValidators(updateVariables)
+    try:
+        with updateVariables.trace.span("request"):
+            response = openUrl(zipFileUrl, getConditionalHeaders(validators))
+    except urllib.error.HTTPError as ex:
+        if ex.code != 304:
+            raise
+        updateVariables.archiveUnchanged = True
+        log("Branch \"{}\" has not changed since it was last downloaded.".format(updateVariables.githubBranchName))
+        log("Reusing the code already extracted to \"{}\"".format(zipExtractedDirPath))
+        return
+
+    with response:
+        updateVariables.archiveValidators = getResponseValidators(response.headers)
+        log("Clearing old extracted code")
+        os.makedirs(zipExtractedDirPath, exist_ok=True)
+        with updateVariables.trace.span("clear"):
+            updateVariables.clearExtractedFolder()
+        total = int(response.headers.get("Content-Length") or 0)
+        reader = QueuedReader(response, total, progress)
+        sink = DirectorySink(zipExtractedDirPath)
+        try:
+            memberLog = lambda name: log("Extracting: {}".format(name))
+            # The transfer and the extraction overlap, so they can only be timed together
+            with updateVariables.trace.span("transfer and extract") as span:
+                StreamingZipExtractor(reader, sink, memberLog).extractAll()
+                span.add(bytes=reader.bytesRead, files=len(sink.files))
+        except NotStreamableError as ex:
+            reader.close()
+            log("Cannot extract this archive while downloading it ({}), downloading it first instead".format(ex))
+            updateVariables.clearExtractedFolder()
+            downloadZipFile(log, updateVariables, progress)
+            extractFromZipFile(log, updateVariables, progress)
+            return
+        finally:
+            reader.close()
+
+    log("Download finished.")
+    updateVariables.archiveValidators.update(sha256=reader.getDigest(), size=reader.bytesRead)
+    saveValidators(updateVariables)
+    saveIntegrityManifest(log, updateVariables, sink)
+
+
+def loadStoreValidators(updateVariables: UpdateVariables, storePath: str = None) -> typing.Optional[dict]:
+    data = ObjectStore(storePath or updateVariables.getStorePath()).loadBranch(updateVariables.githubBranchName)
+    return data.get("validators") if data else None
+
+
+def storeZipFile(log: LogFunc, updateVariables: UpdateVariables, progress: ProgressFunc = None, stream: bool = True,
+                 pool: ConnectionPool = None, removeUnreferenced: bool = True, storePath: str = None):
+    # Download the branch into the object store on the stick (see objectstore.py), rather than into `NewCode`
+    # Only file contents the store doesn't already have (from this or any other branch) are written to the stick
+    # With a pool (see connections.py) the download shares its keep-alive connections and bandwidth limit
+    # storePath: a store other than the stick's, e.g. the delivery cache on this PC (see delta.py)
+    store = ObjectStore(storePath or updateVariables.getStorePath())
+    branch = updateVariables.githubBranchName
+    zipFileUrl = updateVariables.getZipFileUrl()
+    log("Downloading branch \"{}\" from \"{}\" to \"{}\"\n".format(branch, zipFileUrl, store.root))
+    validators = loadStoreValidators(updateVariables, storePath)
+    memberLog = lambda name: log("Extracting: {}".format(name))
+
+    sink = None
+    unchanged = False
+    if stream:
+        try:
+            with updateVariables.trace.span("request"):
+                response = openUrl(zipFileUrl, getConditionalHeaders(validators), pool)
+        except urllib.error.HTTPError as ex:
+            if ex.code != 304:
+                raise
+            unchanged = True
+        if not unchanged:
+            with response:
+                sink = StoreSink(store, branch, getResponseValidators(response.headers))
+                reader = QueuedReader(response, int(response.headers.get("Content-Length") or 0), progress)
+                try:
+                    with updateVariables.trace.span("transfer and extract") as span:
+                        StreamingZipExtractor(reader, sink, memberLog).extractAll()
+                        span.add(bytes=reader.bytesRead, files=len(sink.files))
+                except NotStreamableError as ex:
+                    log("Cannot extract this archive while downloading it ({}), downloading it first instead".format(ex))
+                    sink = None
+                finally:
+                    reader.close()
+    if sink is None and not unchanged:
+        zipDir = updateVariables.getPath(updateVariables.zipDir) if storePath is None else storePath
+        zipFileTarget = os.path.join(zipDir, updateVariables.getZipFile())
+        os.makedirs(os.path.dirname(zipFileTarget), exist_ok=True)
+        newValidators = fetchToFile(zipFileUrl, zipFileTarget, log, progress, validators, pool, updateVariables.trace,
+                                    updateVariables.downloadSegments)
+        if newValidators is None:
+            unchanged = True
+        else:
+            sink = StoreSink(store, branch, newValidators)
+            with updateVariables.trace.span("extract") as span:
+                extractParallel(zipFileTarget, None, memberLog, progress, sink=sink)
+                addFilesToSpan(span, sink.files)
+            os.unlink(zipFileTarget)
+
+    if unchanged:
+        updateVariables.archiveUnchanged = True
+        log("Branch \"{}\" has not changed since it was last downloaded.".format(branch))
+        return
+    log("Branch \"{}\" stored: {} files".format(branch, len(sink.files)))
+    if removeUnreferenced:
+        log("{} file contents no longer used removed".format(store.removeUnreferenced()))
+
+
+def storeBranches(log: LogFunc, branches: typing.List[str], getProgress: typing.Callable[[str], ProgressFunc] = None,
+                  stream: bool = True, maxConnections: int = 4, bytesPerSecond: int = None, trace: RunTrace = None,
+                  storePath: str = None):
+    # Download several branches into the object store at once, over a shared pool of keep-alive connections
+    # with an overall bandwidth limit (see connections.py)
+    # Each branch succeeds or fails on its own: one failing doesn't stop the others, and the failures are
+    # reported together at the end
+    # getProgress(branch) gives the progress function for that branch, and each branch's timings go in trace
+    # storePath: a store other than the stick's (see storeZipFile())
+    pool = ConnectionPool(maxConnections, bytesPerSecond)
+    failures = []
+
+    def storeBranch(branch: str):
+        branchLog = lambda text: log(text if text.startswith("Extracting: ") else "{}: {}".format(branch, text))
+        progress = getProgress(branch) if getProgress is not None else None
+        updateVariables = UpdateVariables(branch)
+        try:
+            storeZipFile(branchLog, updateVariables, progress, stream, pool, removeUnreferenced=False,
+                         storePath=storePath)
+        finally:
+            if trace is not None:
+                trace.merge(updateVariables.trace, branch)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(min(len(branches), maxConnections)) as executor:
+            futures = {executor.submit(storeBranch, branch): branch for branch in branches}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as ex:
+                    failures.append((futures[future], ex))
+    finally:
+        pool.close()
+
+    # Only once every download has finished, as until then their new files are not referenced by any branch yet
+    store = ObjectStore(storePath or UpdateVariables().getStorePath())
+    log("{} file contents no longer used removed".format(store.removeUnreferenced()))
+    for branch, ex in failures:
+        if isinstance(ex, PipelineCancelled):
+            raise ex
+    if failures:
+        details = "\n".join("{}: {}".format(branch, ex) for branch, ex in failures)
+        raise Exception("Failed to download {} of {} branch(es):\n{}".format(len(failures), len(branches), details))
+
+
+def getDeliveryBranches(updateVariables: UpdateVariables, branches: typing.List[str] = None) -> typing.List[str]:
+    # The branches asked for (or updateVariables' branch), and every other branch some PC updated from the stick has
+    # (see fleet.py), so one delivery brings every PC up to date
+    wanted = set(branches or [updateVariables.githubBranchName])
+    wanted.update(record.branch for record in loadFleet(updateVariables.getFleetPath()))
+    return sorted(wanted)
+
+
+def packageDelta(log: LogFunc, updateVariables: UpdateVariables, branches: typing.List[str],
+                 progress: ProgressFunc = None):
+    # Put just the changes each offline PC needs since the version it has on the stick (see delta.py),
+    # from the branches as downloaded to the delivery cache on this PC
+    fleet = loadFleet(updateVariables.getFleetPath())
+    deltaStore = DeltaStore(updateVariables.getDeltaPath())
+    log("Packaging the changes to {} for {} known PC(s) in \"{}\"".format(
+        ", ".join("\"{}\"".format(branch) for branch in branches), len(fleet), deltaStore.root))
+    with updateVariables.trace.span("package") as span:
+        stats = buildPackages(log, ObjectStore(updateVariables.getDeliveryCachePath()), branches, deltaStore, fleet,
+                              progress)
+        span.add(bytes=stats.getBytes(), files=stats.patched + stats.whole)
+    log("In all, {} bytes on the USB stick".format(stats.getBytes()))
+
+
+def getWheelTargets(updateVariables: UpdateVariables, branch: str) -> typing.List[WheelTarget]:
+    # The Pythons of the PCs which have branch (see fleet.py), or this PC's if none is known
+    targets = {WheelTarget(record.python, record.platform) for record in loadFleet(updateVariables.getFleetPath())
+               if record.branch == branch and record.python and record.platform}
+    return sorted(targets, key=WheelTarget.getName) or [getLocalTarget()]
+
+
+@contextlib.contextmanager
+def openDownloadedSource(log: LogFunc, updateVariables: UpdateVariables, storePath: str = None,
+                         archive: bool = False) -> typing.Iterator[typing.Any]:
+    # updateVariables' branch, wherever it was just downloaded to: an object store (the stick's or the delivery
+    # cache, see delta.py), its zip file, or `NewCode`
+    if storePath is not None:
+        yield StoreSource(ObjectStore(storePath), updateVariables.githubBranchName)
+        return
+    with openNewCodeSource(log, updateVariables, archive=updateVariables.githubBranchName if archive else None) \
+            as source:
+        yield source
+
+
+def downloadWheels(log: LogFunc, updateVariables: UpdateVariables, branches: typing.List[str],
+                   progress: ProgressFunc = None, storePath: str = None, archive: bool = False):
+    # Bring the wheels on the stick up to date with the requirements of the branches just downloaded
+    # (see wheelhouse.py), for the Python each offline PC has
+    wheelhouse = Wheelhouse(updateVariables.getWheelhousePath())
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for branch in branches:
+            requirementsPath = os.path.join(tmpDir, "{}-{}".format(branch, requirementsFile))
+            with openDownloadedSource(log, UpdateVariables(branch), storePath, archive) as source:
+                if requirementsFile not in source.manifest():
+                    log("Branch \"{}\" lists no Python packages it needs".format(branch))
+                    continue
+                source.copyFile(requirementsFile, requirementsPath)
+            with updateVariables.trace.span("packages") as span:
+                span.add(bytes=buildWheelhouse(log, wheelhouse, branch, requirementsPath,
+                                               getWheelTargets(updateVariables, branch),
+                                               updateVariables.packageIndexUrl, progress))
+    removed = wheelhouse.removeUnreferenced()
+    if removed:
+        log("{} Python package(s) no longer needed removed from \"{}\"".format(removed, wheelhouse.root))
+
+
+def getNewCodeDir(updateVariables: UpdateVariables):
+    # New code is in UpdateVariables.getPath(newCode), unfortunately there is an unknown folder name here from Git
+    # First work out the Git hub zip extracted name
+    gitFolder = getImmediateSubdirectories(updateVariables.getPath(updateVariables.codeDir))[0]
+    return os.path.join(updateVariables.getPath(updateVariables.codeDir), gitFolder)
+
+
+def checkNewCodeSource(updateVariables: UpdateVariables, branch: str = None, archive: str = None,
+                       delta: str = None):
+    # Before an update starts (so a run which could never have started isn't recorded as a failed one),
+    # check the new code openNewCodeSource() would use is on the stick
+    if delta is not None:
+        path = updateVariables.getDeltaPath()
+        missing = not os.path.isdir(path)
+    elif archive is not None:
+        path = updateVariables.getArchivePath(archive)
+        missing = not os.path.exists(path)
+    elif branch is not None:
+        path = updateVariables.getStorePath()
+        missing = ObjectStore(path).loadBranch(branch) is None
+    else:
+        path = updateVariables.getPath(updateVariables.codeDir)
+        missing = not os.path.isdir(path) or not getImmediateSubdirectories(path)
+    if missing:
+        raise Exception("There is no new code in \"{}\", please run the downloader first".format(path))
+
+
+@contextlib.contextmanager
+def openNewCodeSource(log: LogFunc, updateVariables: UpdateVariables, hashContents: bool = False, branch: str = None,
+                      archive: str = None, delta: str = None, codeDirPath: str = None) -> typing.Iterator[typing.Any]:
+    # The new code is in `NewCode`, in the object store on the stick if a branch is given,
+    # in the zip kept on the stick if an archive (branch) is given,
+    # or is a delta package (branch) of the changes to apply to codeDirPath if a delta is given (see delta.py)
+    if delta is not None:
+        # The package made against the version this PC was last recorded as having (see fleet.py)
+        machine = loadMachineRecord(updateVariables.getFleetPath(), getMachineId(updateVariables.getMachineIdPath()))
+        base = machine.digest if machine is not None and machine.branch == delta else None
+        yield DeltaSource(DeltaStore(updateVariables.getDeltaPath()), delta, base, codeDirPath)
+        return
+    if archive is not None:
+        index = IntegrityManifest.load(updateVariables.getArchiveIndexPath(archive))
+        if index is None:
+            raise Exception("There is no index of \"{}\", please download it again"
+                            .format(updateVariables.getArchivePath(archive)))
+        with ZipSource(updateVariables.getArchivePath(archive), index) as source:
+            yield source
+        return
+    if branch is not None:
+        yield StoreSource(ObjectStore(updateVariables.getStorePath()), branch)
+        return
+    newCodeDir = getNewCodeDir(updateVariables)
+    manifest = IntegrityManifest.load(updateVariables.getManifestPath())
+    expected = manifest.getFiles(os.path.basename(newCodeDir)) if manifest is not None else None
+    if expected is None:
+        log("No record of what was downloaded to check the new code against")
+    yield DirectorySource(newCodeDir, hashContents, expected)
+
+
+def stageNewCode(log: LogFunc, updateVariables: UpdateVariables, codeDirPath: str, progress: ProgressFunc = None,
+                 linkUnchanged: bool = True, hashContents: bool = False, branch: str = None, archive: str = None,
+                 delta: str = None):
+    # Build the new code in a staging directory next to `Code` (see install.py), leaving `Code` untouched
+    # With linkUnchanged only new and changed files are copied from the USB stick
+    # Every file copied is checked against the SHA-256 recorded when it was downloaded (see integrity.py)
+    with openNewCodeSource(log, updateVariables, hashContents, branch, archive, delta, codeDirPath) as source:
+        log("Copying new code from {}".format(source.getDescription()))
+        with updateVariables.trace.span("copy") as span:
+            _, stats = buildStaging(log, source, codeDirPath, progress, linkUnchanged, hashContents)
+            span.add(bytes=stats.bytesCopied, files=stats.filesCopied)
+
+
+def planUpdate(log: LogFunc, updateVariables: UpdateVariables, codeDirPath: str, linkUnchanged: bool = True,
+               hashContents: bool = False, branch: str = None, archive: str = None, delta: str = None) -> UpdatePlan:
+    # What stageNewCode() would do with the same options, without writing anything but a brief disk speed test
+    # (see planner.py)
+    with openNewCodeSource(log, updateVariables, hashContents, branch, archive, delta, codeDirPath) as source:
+        log("Planning an update from {}".format(source.getDescription()))
+        with updateVariables.trace.span("plan") as span:
+            plan = makePlan(planStaging(source, codeDirPath, linkUnchanged, hashContents), codeDirPath, linkUnchanged)
+            span.add(bytes=plan.bytesToWrite, files=plan.filesToWrite)
+    log(plan.summary())
+    # What the last real update actually took, to set the estimate against
+    previous = [run for run in loadHistory(updateVariables.getHistoryPath(), "update")
+                if run.get("outcome") == "succeeded"]
+    if previous:
+        log("The previous update ({}) took {:.1f}s".format(previous[-1]["started"], previous[-1]["seconds"]))
+    return plan
+
+
+def getNewCodeBranch(updateVariables: UpdateVariables) -> typing.Optional[str]:
+    # The branch in `NewCode`, from the "Jinn-<branch>" folder GitHub puts everything in
+    try:
+        gitFolder = os.path.basename(getNewCodeDir(updateVariables))
+    except (OSError, IndexError):
+        return None
+    return gitFolder.split("-", 1)[1] if "-" in gitFolder else None
+
+
+def recordMachine(log: LogFunc, updateVariables: UpdateVariables, branch: str, digest: typing.Optional[str]):
+    # Write this PC's record to the stick, for the downloader to make its next delta package against (see fleet.py)
+    fleetPath = updateVariables.getFleetPath()
+    target = getLocalTarget()
+    try:
+        record = MachineRecord(getMachineId(updateVariables.getMachineIdPath()), getMachineName(), branch, digest,
+                               python=target.python, platform=target.platform)
+        saveMachineRecord(fleetPath, record)
+    except OSError as ex:
+        # Never worth failing an update over, the next delivery for this PC just carries every file
+        log("Could not record this PC's version in \"{}\": {}".format(fleetPath, ex))
+        return
+    log("Recorded on the USB stick that {}".format(record.describe()))
+
+
+def installStagedCode(log: LogFunc, updateVariables: UpdateVariables, codeDirPath: str, branch: str = None):
+    # Swap the staged code in with two renames, keeping the old `Code` as `OldCode-<date-time>`
+    # branch: the branch being installed, None for the one in `NewCode`
+    digest = getStagedDigest(codeDirPath)
+    with updateVariables.trace.span("rename"):
+        snapshotPath = swapInStaging(log, codeDirPath, updateVariables.getOldCodeDirWithDateTime())
+    if snapshotPath is not None:
+        log("Previous code kept as \"{}\"".format(snapshotPath))
+    branch = branch or getNewCodeBranch(updateVariables)
+    if branch is not None:
+        recordMachine(log, updateVariables, branch, digest)
+
+
+def rollbackCode(log: LogFunc, updateVariables: UpdateVariables, codeDirPath: str, snapshotPath: str,
+                 progress: ProgressFunc = None):
+    # Put an `OldCode-<date-time>` snapshot back as `Code`, renames only
+    # (unless the snapshot has been compressed, when it has to be extracted first)
+    if isSnapshotArchive(snapshotPath):
+        with updateVariables.trace.span("extract"):
+            snapshotPath = expandSnapshot(log, snapshotPath, progress)
+    with updateVariables.trace.span("rename"):
+        currentSnapshotPath = rollback(log, codeDirPath, snapshotPath, updateVariables.getOldCodeDirWithDateTime())
+    if currentSnapshotPath is not None:
+        log("Code being replaced kept as \"{}\"".format(currentSnapshotPath))
+    # Which version is back in `Code` isn't known, so the next delta package for this PC carries every file
+    try:
+        machine = loadMachineRecord(updateVariables.getFleetPath(), getMachineId(updateVariables.getMachineIdPath()))
+    except OSError:
+        machine = None
+    if machine is not None:
+        recordMachine(log, updateVariables, machine.branch, None)
+
+
+def installPackages(log: LogFunc, updateVariables: UpdateVariables, codeDirPath: str, branch: str = None):
+    # Install the Python packages the new code needs from the wheelhouse on the stick (see wheelhouse.py)
+    # branch: the branch installed, None for the one in `NewCode`
+    requirementsPath = os.path.join(codeDirPath, requirementsFile)
+    branch = branch or getNewCodeBranch(updateVariables)
+    if not os.path.exists(requirementsPath) or branch is None:
+        log("The new code lists no Python packages it needs")
+        return
+    with updateVariables.trace.span("packages"):
+        installWheels(log, Wheelhouse(updateVariables.getWheelhousePath()), branch, requirementsPath)
+
+
+def recordRun(log: LogFunc, updateVariables: UpdateVariables, trace: RunTrace, outcome: str, error: str = None):
+    # Finish the run's trace, add it to the history on the stick (see tracing.py), and log a summary
+    trace.finish(outcome, error)
+    historyPath = updateVariables.getHistoryPath()
+    previous = [run for run in loadHistory(historyPath, trace.kind) if run.get("outcome") == "succeeded"]
+    log(trace.summary())
+    if previous:
+        log("The previous {} ({}) took {:.1f}s".format(trace.kind, previous[-1]["started"], previous[-1]["seconds"]))
+    try:
+        appendHistory(historyPath, trace)
+    except OSError as ex:
+        # Never worth failing a run over
+        log("Could not record this run's timings in \"{}\": {}".format(historyPath, ex))
+
+
+def tidySnapshots(log: LogFunc, updateVariables: UpdateVariables, codeDirPath: str, progress: ProgressFunc = None):
+    # Apply the retention policy to the `OldCode-<date-time>` snapshots, hard link and compress the ones kept
+    manageSnapshots(log, codeDirPath, updateVariables.snapshotKeepCount, updateVariables.snapshotKeepDays,
+                    progress=progress)
+
+
+def getImmediateSubdirectories(dir):
+    return [name for name in os.listdir(dir) if os.path.isdir(os.path.join(dir, name))]
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import time
+
+from sync import SyncPlan
+
+# A dry run of an update: what it would add, change and delete in `Code`, how much it would write, whether there is
+# room for it, and roughly how long it would take, without copying anything
+# Only file metadata is read (sizes and timestamps: the directory entries of `NewCode`, the store's branch record,
+# or an archive's index and central directory), so it takes well under a second, then the disk `Code` is on is
+# timed briefly to turn that into a duration
+# The estimate is for writing to the PC's disk, which is most of an update; reading a slow USB stick can add to it
+
+# The speed test: one file of this size for throughput, and this many tiny files for the cost of each file
+probeSize = 4 * 1024 * 1024
+probeFileCount = 50
+probeDirName = "CodePlanProbe"
+
+
+class DiskSpeed:
+    def __init__(self, bytesPerSecond: float, secondsPerFile: float, canLink: bool):
+        self.bytesPerSecond = bytesPerSecond
+        self.secondsPerFile = secondsPerFile
+        # Whether unchanged files can be hard linked rather than copied (not on FAT32, see install.linkOrCopy())
+        self.canLink = canLink
+
+
+def measureDiskSpeed(directory: str) -> DiskSpeed:
+    # Time writing to directory's disk, each write flushed right through to it as building the staging directory is
+    # (eventually) too, so the OS's write cache doesn't make it look faster than it is
+    probeDir = tempfile.mkdtemp(prefix=probeDirName, dir=directory)
+    try:
+        data = os.urandom(probeSize)
+        path = os.path.join(probeDir, "probe.bin")
+        start = time.perf_counter()
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        bytesPerSecond = probeSize / max(time.perf_counter() - start, 1e-6)
+
+        start = time.perf_counter()
+        for i in range(probeFileCount):
+            with open(os.path.join(probeDir, "probe{}.py".format(i)), 'wb') as f:
+                f.write(b"#\n")
+        secondsPerFile = (time.perf_counter() - start) / probeFileCount
+
+        try:
+            os.link(path, os.path.join(probeDir, "link.bin"))
+            canLink = True
+        except OSError:
+            canLink = False
+    finally:
+        shutil.rmtree(probeDir, ignore_errors=True)
+    return DiskSpeed(bytesPerSecond, secondsPerFile, canLink)
+
+
+class UpdatePlan:
+    """What an update from source to `Code` would do, see makePlan()"""
+
+    def __init__(self, plan: SyncPlan, linkUnchanged: bool, speed: DiskSpeed, freeBytes: int):
+        self.added = len(plan.added)
+        self.changed = len(plan.changed)
+        self.removed = len(plan.removed)
+        self.unchanged = len(plan.unchanged)
+        self.bytesAdded = sum(plan.source[path].size for path in plan.added)
+        self.bytesChanged = sum(plan.source[path].size for path in plan.changed)
+        self.bytesRemoved = sum(plan.target[path].size for path in plan.removed)
+        self.bytesUnchanged = sum(plan.source[path].size for path in plan.unchanged)
+        # New and changed files are copied, unchanged ones linked if the disk allows it (else copied as well)
+        # Without linkUnchanged everything counts as added, as nothing is compared
+        self.filesToWrite = self.added + self.changed
+        self.bytesToWrite = self.bytesAdded + self.bytesChanged
+        if not speed.canLink:
+            self.filesToWrite += self.unchanged
+            self.bytesToWrite += self.bytesUnchanged
+        self.linkUnchanged = linkUnchanged
+        self.speed = speed
+        # `Code` is kept as a snapshot, so the new code needs room of its own
+        self.freeBytes = freeBytes
+
+    def getEstimatedSeconds(self) -> float:
+        return self.bytesToWrite / self.speed.bytesPerSecond + self.filesToWrite * self.speed.secondsPerFile
+
+    def hasRoom(self) -> bool:
+        return self.freeBytes >= self.bytesToWrite
+
+    def summary(self) -> str:
+        lines = ["{} new file(s) ({:.1f} MB), {} changed ({:.1f} MB), {} to delete ({:.1f} MB), "
+                 "{} unchanged ({:.1f} MB)".format(self.added, self.bytesAdded / 1e6, self.changed,
+                                                   self.bytesChanged / 1e6, self.removed, self.bytesRemoved / 1e6,
+                                                   self.unchanged, self.bytesUnchanged / 1e6)]
+        if not self.linkUnchanged:
+            lines.append("Every file will be copied, as only copying changed files is turned off")
+        elif not self.speed.canLink and self.unchanged:
+            lines.append("This disk can't hard link files, so unchanged files will be copied as well")
+        lines.append("{} file(s), {:.1f} MB to write, {:.1f} MB free".format(
+            self.filesToWrite, self.bytesToWrite / 1e6, self.freeBytes / 1e6))
+        if not self.hasRoom():
+            lines.append("Not enough free space: {:.1f} MB more is needed".format(
+                (self.bytesToWrite - self.freeBytes) / 1e6))
+        lines.append("Should take about {:.1f}s (the disk writes {:.1f} MB/s, {:.1f}ms per file)".format(
+            self.getEstimatedSeconds(), self.speed.bytesPerSecond / 1e6, self.speed.secondsPerFile * 1000))
+        return "\n".join(lines)
+
+
+def getExistingParent(path: str) -> str:
+    # The staging directory goes next to `Code`, which might not exist yet (or even its parent)
+    path = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def makePlan(plan: SyncPlan, codeDirPath: str, linkUnchanged: bool = True) -> UpdatePlan:
+    # plan is from install.planStaging()
+    directory = getExistingParent(codeDirPath)
+    return UpdatePlan(plan, linkUnchanged, measureDiskSpeed(directory), shutil.disk_usage(directory).free)
@@ -0,0 +1,104 @@
+import time
+import typing
+
+# Turns the progress(done, total) calls every step makes (see pipeline.py) into what is shown: how far through,
+# how fast and how long is left, for the progress bars in the dialogs (see widgets.ProgressPanel) and the progress
+# line of `cli.py`
+# Every step counts in bytes: downloaded against the Content-Length, extracted against the zip's total uncompressed
+# size, copied against what the update plan says needs copying (see install.buildStaging()), so one model does for all
+# Steps report after every chunk or file, far more often than anyone can read, so ProgressThrottle drops most of the
+# calls where they are made, before they cost a signal across threads or a repaint
+
+# Seconds between the progress reports passed on for each phase (the first and last always are)
+reportInterval = 0.1
+# Throughput is measured over at least this many seconds, then smoothed, with this weight on the newest measurement
+rateSampleTime = 0.5
+rateSmoothing = 0.3
+
+
+class PipelineCancelled(Exception):
+    """Raised inside a running phase (by its progress function) when the user has asked for it to stop"""
+    # Here rather than in pipeline.py, so the front ends can stop a phase without importing the whole pipeline
+
+
+class ProgressThrottle:
+    """Decides which of a phase's progress reports are worth passing on to be shown"""
+    # One throttle can serve several things reporting at once (e.g. several branches downloading), by name
+
+    def __init__(self, interval: float = reportInterval):
+        self.interval = interval
+        # name -> (time, total) of the last report passed on
+        self.last = {}
+
+    def isDue(self, name: str, done: int, total: int) -> bool:
+        now = time.monotonic()
+        last = self.last.get(name)
+        # Always pass on the end, and a new total (e.g. the real size once a download starts)
+        if last is not None and now - last[0] < self.interval and total == last[1] and done != total:
+            return False
+        self.last[name] = (now, total)
+        return True
+
+
+def formatBytes(count: float) -> str:
+    # In decimal units, as the run timings are (see tracing.py)
+    for unit in ["bytes", "KB", "MB"]:
+        if count < 1000:
+            return "{:.0f} {}".format(count, unit) if unit == "bytes" else "{:.1f} {}".format(count, unit)
+        count /= 1000
+    return "{:.2f} GB".format(count)
+
+
+def formatDuration(seconds: float) -> str:
+    # 0:05, 12:30, 1:02:03
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds) if hours else "{}:{:02}".format(minutes, seconds)
+
+
+class ProgressMeter:
+    """How far through one phase (or one branch) is, its smoothed throughput and the time left"""
+
+    def __init__(self):
+        self.done = 0
+        self.total = 0
+        # Bytes per second, None until first measured
+        self.rate: typing.Optional[float] = None
+        self.sampleTime: typing.Optional[float] = None
+        self.sampleDone = 0
+
+    def update(self, done: int, total: int, now: float = None):
+        now = time.monotonic() if now is None else now
+        if self.sampleTime is None or done < self.sampleDone:
+            # First report, or starting again (e.g. a download falling back to a single connection)
+            self.sampleTime = now
+            self.sampleDone = done
+            self.rate = None
+        elapsed = now - self.sampleTime
+        if elapsed >= rateSampleTime:
+            rate = (done - self.sampleDone) / elapsed
+            self.rate = rate if self.rate is None else rateSmoothing * rate + (1 - rateSmoothing) * self.rate
+            self.sampleTime = now
+            self.sampleDone = done
+        self.done = done
+        self.total = total
+
+    def getFraction(self) -> typing.Optional[float]:
+        # None when the total isn't known
+        return min(self.done / self.total, 1.0) if self.total else None
+
+    def getSecondsLeft(self) -> typing.Optional[float]:
+        if not self.total or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def describe(self) -> str:
+        # e.g. "12.3 MB of 45.6 MB, 3.4 MB/s, 0:10 left"
+        parts = ["{} of {}".format(formatBytes(self.done), formatBytes(self.total)) if self.total
+                 else formatBytes(self.done)]
+        if self.rate is not None and self.done != self.total:
+            parts.append("{}/s".format(formatBytes(self.rate)))
+            secondsLeft = self.getSecondsLeft()
+            if secondsLeft is not None:
+                parts.append("{} left".format(formatDuration(secondsLeft)))
+        return ", ".join(parts)
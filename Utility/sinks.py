@@ -0,0 +1,160 @@
+import hashlib
+import ntpath
+import os
+import threading
+import typing
+
+from sync import FileEntry
+
+# Where the extractors (streamzip.py, extraction.py) put the members they extract
+# A sink hands out a writer per file:
+#     writer = sink.openFile(name, timestamp)
+#     writer.write(data) ...
+#     writer.close()      - the file is complete and correct
+#     writer.abort()      - something went wrong, throw away what was written
+# so the same extraction code can write a plain directory tree, or into the object store (see objectstore.py)
+# Either way each file's SHA-256 is worked out as it is written, for the integrity manifest (see integrity.py)
+
+
+def getMemberParts(name: str) -> typing.List[str]:
+    # The parts of a member's path which are safe to extract, as zipfile.ZipFile.extract() does: drive letters
+    # ("C:") and "", "." and ".." dropped, so nothing is ever written outside where it is extracted to
+    # (ntpath, so a drive letter is dropped whatever the platform: the stick is used on Windows)
+    parts = [ntpath.splitdrive(part)[1] for part in name.replace("\\", "/").split("/")]
+    return [part for part in parts if part not in ("", ".", "..")]
+
+
+def safeMemberPath(destDir: str, name: str) -> typing.Optional[str]:
+    # Where a member goes in destDir, None if nowhere (e.g. a member named "..")
+    parts = getMemberParts(name)
+    if not parts:
+        return None
+    return os.path.join(destDir, *parts)
+
+
+class FileWriter:
+    def __init__(self, path: str, timestamp: float = None,
+                 onClose: typing.Callable[[FileEntry], None] = None):
+        self.path = path
+        self.timestamp = timestamp
+        self.onClose = onClose
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.file = open(path, 'wb')
+
+    def write(self, data: bytes):
+        self.sha.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        if self.timestamp is not None:
+            # Keep the archive's timestamp, like git does, so unchanged files look unchanged to later steps
+            os.utime(self.path, (self.timestamp, self.timestamp))
+        if self.onClose is not None:
+            self.onClose(FileEntry(self.size, self.timestamp, self.sha.hexdigest()))
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class NullWriter:
+    # For members which have nowhere to go (e.g. a name which is all ".."), but still need reading past
+    def write(self, data: bytes):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class DirectorySink:
+    """Extracts into a directory tree, like zipfile.ZipFile.extract()"""
+    # files records what was written: path relative to destDir -> FileEntry (with its SHA-256)
+
+    def __init__(self, destDir: str):
+        self.destDir = destDir
+        self.directoriesLock = threading.Lock()
+        self.directories = set()
+        self.files = {}
+        self.filesLock = threading.Lock()
+
+    def makeDirectory(self, path: str):
+        with self.directoriesLock:
+            if path in self.directories:
+                return
+            self.directories.add(path)
+        os.makedirs(path, exist_ok=True)
+
+    def prepare(self, names: typing.Iterable[str]):
+        # Create the whole directory tree up front when the member names are known in advance,
+        # so parallel writers never race on makedirs()
+        directories = set()
+        for name in names:
+            path = safeMemberPath(self.destDir, name)
+            if path is not None:
+                directories.add(path if name.endswith("/") else os.path.dirname(path))
+        # Sorted, so parents come before their children and each makedirs() only creates one level
+        for directory in sorted(directories):
+            self.makeDirectory(directory)
+
+    def addDirectory(self, name: str):
+        path = safeMemberPath(self.destDir, name)
+        if path is not None:
+            self.makeDirectory(path)
+
+    def openFile(self, name: str, timestamp: float = None):
+        path = safeMemberPath(self.destDir, name)
+        if path is None:
+            return NullWriter()
+        self.makeDirectory(os.path.dirname(path))
+        relPath = os.path.relpath(path, self.destDir).replace(os.sep, "/")
+        return FileWriter(path, timestamp, lambda entry: self.addEntry(relPath, entry))
+
+    def addEntry(self, relPath: str, entry: FileEntry):
+        with self.filesLock:
+            self.files[relPath] = entry
+
+    def finish(self):
+        pass
+
+
+class HashWriter:
+    """Works out a member's SHA-256 and size without writing it anywhere"""
+
+    def __init__(self, timestamp: float = None, onClose: typing.Callable[[FileEntry], None] = None):
+        self.timestamp = timestamp
+        self.onClose = onClose
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.sha.update(data)
+        self.size += len(data)
+
+    def close(self):
+        if self.onClose is not None:
+            self.onClose(FileEntry(self.size, self.timestamp, self.sha.hexdigest()))
+
+    def abort(self):
+        pass
+
+
+class IndexSink(DirectorySink):
+    """Records what extracting into destDir would produce (see DirectorySink.files), without writing anything"""
+    # For an archive kept as it is on the USB stick, and only extracted on the work PC (see archivesource.py)
+
+    def makeDirectory(self, path: str):
+        pass
+
+    def openFile(self, name: str, timestamp: float = None):
+        path = safeMemberPath(self.destDir, name)
+        if path is None:
+            return NullWriter()
+        relPath = os.path.relpath(path, self.destDir).replace(os.sep, "/")
+        return HashWriter(timestamp, lambda entry: self.addEntry(relPath, entry))
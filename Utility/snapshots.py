@@ -0,0 +1,199 @@
+import datetime
+import filecmp
+import os
+import shutil
+import time
+import typing
+import zipfile
+
+from extraction import extractParallel
+from install import getUniquePath, listSnapshots, snapshotPrefix
+from sync import buildManifest, toNativePath, mtimeTolerance
+
+# Looking after the `OldCode-<date-time>` snapshots each update leaves next to `Code`
+#  - dedupe: a file which did not change between two consecutive snapshots (or the newest snapshot and `Code`)
+#    is hard-linked, so is only stored once (the same reasoning as for the staging directory, see install.py)
+#  - retention: keep the newest `keepCount` snapshots, and any younger than `keepDays`, delete the rest
+#  - compression: all but the newest snapshot are packed into `OldCode-<date-time>.zip`
+# The newest snapshot is always kept as a plain directory, so rolling back to it stays two renames (see install.py)
+# Older ones are extracted again first, which takes a while but is rarely needed
+# Everything here is slow but unimportant, so the updater runs it on a low priority thread after an update
+LogFunc = typing.Callable[[str], None]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+archiveSuffix = ".zip"
+
+
+def isSnapshotArchive(path: str) -> bool:
+    return path.endswith(archiveSuffix)
+
+
+def getSnapshotName(path: str) -> str:
+    name = os.path.basename(path)
+    return name[:-len(archiveSuffix)] if isSnapshotArchive(name) else name
+
+
+def getSnapshotTime(path: str) -> datetime.datetime:
+    # The name says when it was made (see UpdateVariables.getOldCodeDirWithDateTime()), possibly with "-2" etc.
+    # on the end, fall back on the modification time for anything named differently
+    stamp = getSnapshotName(path)[len(snapshotPrefix):][:len("YYYY-MM-DD_HH-MM")]
+    try:
+        return datetime.datetime.strptime(stamp, "%Y-%m-%d_%H-%M")
+    except ValueError:
+        return datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def listSnapshotArchives(codeDirPath: str) -> typing.List[str]:
+    parent = os.path.dirname(os.path.abspath(codeDirPath))
+    if not os.path.isdir(parent):
+        return []
+    return [os.path.join(parent, name) for name in os.listdir(parent)
+            if name.startswith(snapshotPrefix) and isSnapshotArchive(name)
+            and os.path.isfile(os.path.join(parent, name))]
+
+
+def listAllSnapshots(codeDirPath: str) -> typing.List[str]:
+    # Snapshot directories and archives together, newest first
+    snapshots = listSnapshots(codeDirPath) + listSnapshotArchives(codeDirPath)
+    return sorted(snapshots, key=getSnapshotName, reverse=True)
+
+
+def linkIdenticalFiles(log: LogFunc, olderPath: str, newerPath: str, progress: ProgressFunc = None) -> int:
+    # Replace each file in olderPath which is identical to the same file in newerPath with a hard link to it
+    # Returns the number of bytes freed
+    older = buildManifest(olderPath)
+    newer = buildManifest(newerPath)
+    candidates = sorted(path for path in older if path in newer and older[path].size == newer[path].size
+                        and abs(older[path].mtime - newer[path].mtime) <= mtimeTolerance)
+    freed = 0
+    # Progress is in bytes compared
+    total = sum(older[relPath].size for relPath in candidates)
+    done = 0
+    for relPath in candidates:
+        olderFile = toNativePath(olderPath, relPath)
+        newerFile = toNativePath(newerPath, relPath)
+        if not os.path.samefile(olderFile, newerFile) and filecmp.cmp(olderFile, newerFile, shallow=False):
+            # Link under a temporary name first, so the older snapshot always has the file one way or the other
+            tmpFile = olderFile + ".link"
+            try:
+                os.link(newerFile, tmpFile)
+            except OSError:
+                # e.g. FAT32, which has no hard links, so nothing to be gained on this volume
+                log("Cannot hard link files in \"{}\"".format(os.path.dirname(olderPath)))
+                return freed
+            os.replace(tmpFile, olderFile)
+            freed += older[relPath].size
+        done += older[relPath].size
+        if progress is not None:
+            progress(done, total)
+    return freed
+
+
+def dedupeSnapshots(log: LogFunc, codeDirPath: str, progress: ProgressFunc = None,
+                    snapshots: typing.List[str] = None) -> int:
+    # Hard link the unchanged files of each pair of consecutive snapshot directories, the newest against `Code`
+    # snapshots defaults to all the snapshot directories, returns bytes freed
+    if snapshots is None:
+        snapshots = listSnapshots(codeDirPath)
+    chain = sorted(snapshots, key=getSnapshotName)
+    if os.path.isdir(codeDirPath):
+        chain.append(codeDirPath)
+    freed = 0
+    for olderPath, newerPath in zip(chain, chain[1:]):
+        freed += linkIdenticalFiles(log, olderPath, newerPath, progress)
+    if freed:
+        log("{} bytes freed by hard linking unchanged files between snapshots".format(freed))
+    return freed
+
+
+def removeSnapshot(log: LogFunc, path: str):
+    log("Removing old snapshot \"{}\"".format(path))
+    if isSnapshotArchive(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path)
+
+
+def applyRetention(log: LogFunc, codeDirPath: str, keepCount: int, keepDays: typing.Optional[float]) -> typing.List[str]:
+    # Keep the newest keepCount snapshots, plus any made in the last keepDays days (if given), remove the rest
+    # The newest snapshot is always kept, whatever the settings
+    snapshots = listAllSnapshots(codeDirPath)
+    cutoff = None
+    if keepDays is not None:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=keepDays)
+    removed = []
+    for index, path in enumerate(snapshots):
+        if index < max(keepCount, 1):
+            continue
+        if cutoff is not None and getSnapshotTime(path) >= cutoff:
+            continue
+        removeSnapshot(log, path)
+        removed.append(path)
+    return removed
+
+
+def compressSnapshot(log: LogFunc, snapshotPath: str, progress: ProgressFunc = None) -> str:
+    # Pack a snapshot directory into an archive next to it, then remove the directory, returns the archive's path
+    archivePath = snapshotPath + archiveSuffix
+    count = 2
+    while os.path.exists(archivePath):
+        archivePath = "{}-{}{}".format(snapshotPath, count, archiveSuffix)
+        count += 1
+    log("Compressing \"{}\" to \"{}\"".format(snapshotPath, archivePath))
+    manifest = buildManifest(snapshotPath)
+    tmpPath = archivePath + ".tmp"
+    try:
+        with zipfile.ZipFile(tmpPath, 'w', zipfile.ZIP_DEFLATED, strict_timestamps=False) as zip_ref:
+            # Directories too, so empty ones come back on extraction
+            for dirPath, _, _ in os.walk(snapshotPath):
+                if dirPath != snapshotPath:
+                    zip_ref.write(dirPath, os.path.relpath(dirPath, snapshotPath))
+            # Progress is in bytes compressed
+            total = sum(entry.size for entry in manifest.values())
+            done = 0
+            for relPath in sorted(manifest):
+                zip_ref.write(toNativePath(snapshotPath, relPath), relPath)
+                done += manifest[relPath].size
+                if progress is not None:
+                    progress(done, total)
+        os.replace(tmpPath, archivePath)
+    except BaseException:
+        # e.g. cancelled, leave the snapshot directory exactly as it was
+        if os.path.exists(tmpPath):
+            os.unlink(tmpPath)
+        raise
+    shutil.rmtree(snapshotPath)
+    return archivePath
+
+
+def expandSnapshot(log: LogFunc, archivePath: str, progress: ProgressFunc = None) -> str:
+    # Extract a compressed snapshot back into a directory next to it (so rollback can rename it into place),
+    # then remove the archive, returns the directory's path
+    snapshotPath = getUniquePath(os.path.join(os.path.dirname(archivePath), getSnapshotName(archivePath)))
+    log("Extracting \"{}\" to \"{}\"".format(archivePath, snapshotPath))
+    # Not named `OldCode-...` until it is complete, so a half-extracted snapshot is never offered for rollback
+    tmpPath = os.path.join(os.path.dirname(snapshotPath), "Extracting-" + os.path.basename(snapshotPath))
+    if os.path.exists(tmpPath):
+        shutil.rmtree(tmpPath)
+    extractParallel(archivePath, tmpPath, progress=progress)
+    os.rename(tmpPath, snapshotPath)
+    os.unlink(archivePath)
+    return snapshotPath
+
+
+def manageSnapshots(log: LogFunc, codeDirPath: str, keepCount: int, keepDays: typing.Optional[float],
+                    compress: bool = True, progress: ProgressFunc = None):
+    # Retention first (no point deduping or compressing something about to be deleted), then dedupe, then compress
+    startTime = time.time()
+    removed = applyRetention(log, codeDirPath, keepCount, keepDays)
+    snapshots = listSnapshots(codeDirPath)
+    # listSnapshots() is newest first, and the newest stays a directory so rollback to it stays instant
+    # (no point deduping the ones about to be compressed)
+    dedupeSnapshots(log, codeDirPath, progress, snapshots[:1] if compress else snapshots)
+    compressed = 0
+    if compress:
+        for snapshotPath in snapshots[1:]:
+            compressSnapshot(log, snapshotPath, progress)
+            compressed += 1
+    log("Old snapshots tidied in {:.1f}s: {} removed, {} compressed".format(time.time() - startTime, len(removed),
+                                                                            compressed))
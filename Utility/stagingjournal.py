@@ -0,0 +1,121 @@
+import json
+import os
+import typing
+
+from sync import FileEntry, mtimeTolerance, toNativePath
+
+# A write-ahead journal of an update (see install.py), so one interrupted part way (the PC shut down, the stick pulled
+# out, Cancel pressed) carries on from where it stopped the next time, rather than starting again:
+#     CodeStaging.journal   - next to `CodeStaging`, one JSON record per line, only ever appended to
+#         {"digest": ...}          - which new code is being built (a digest of its manifest), always the first line
+#         {"done": "<path>"}       - a file complete in the staging directory
+#         {"staged": true}         - the whole staging directory built and checked
+#         {"swapping": "<path>"}   - about to swap it in, keeping `Code` as this snapshot
+# and deleted once the new code is in place
+# Lines are flushed as they are written, but only forced to disk every syncInterval files: a file whose line is lost
+# is just done again, and one whose line survived is checked (size and time) before it is skipped
+# A journal for different new code (e.g. downloaded again since) is no use, and the update starts again
+journalSuffix = ".journal"
+syncInterval = 200
+
+
+def getJournalPath(stagingDir: str) -> str:
+    return stagingDir + journalSuffix
+
+
+def isFileComplete(path: str, entry: FileEntry) -> bool:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_size == entry.size and (entry.mtime is None or abs(st.st_mtime - entry.mtime) <= mtimeTolerance)
+
+
+class StagingJournal:
+    def __init__(self, path: str, digest: str = None):
+        self.path = path
+        self.digest = digest
+        self.done = set()
+        self.staged = False
+        # Where `Code` was being kept when the swap was interrupted, if it was
+        self.snapshotPath: typing.Optional[str] = None
+        self.file = None
+        self.unsynced = 0
+
+    def load(self) -> bool:
+        # Whether there is a journal for this new code (any new code, if no digest was given)
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding="utf-8") as f:
+            lines = f.readlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # e.g. the last line, cut off part way through writing it
+                continue
+        if not records or "digest" not in records[0] or (self.digest is not None and
+                                                       records[0]["digest"] != self.digest):
+            return False
+        self.digest = records[0]["digest"]
+        for record in records[1:]:
+            if "done" in record:
+                self.done.add(record["done"])
+            elif "staged" in record:
+                self.staged = True
+            elif "swapping" in record:
+                self.snapshotPath = record["swapping"]
+        return True
+
+    def getCompleted(self, stagingDir: str, manifest: typing.Dict[str, FileEntry]) -> typing.Set[str]:
+        # The files recorded as done which are still as they should be
+        return {relPath for relPath in self.done
+                if relPath in manifest and isFileComplete(toNativePath(stagingDir, relPath), manifest[relPath])}
+
+    def start(self):
+        # A new journal, for a new staging directory
+        with open(self.path, 'w', encoding="utf-8") as f:
+            f.write(json.dumps({"digest": self.digest}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done = set()
+        self.staged = False
+        self.snapshotPath = None
+
+    def append(self, record: dict, sync: bool = False):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding="utf-8")
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if sync or self.unsynced >= syncInterval:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def addDone(self, relPath: str):
+        self.append({"done": relPath})
+
+    def markStaged(self):
+        self.append({"staged": True}, sync=True)
+        self.staged = True
+
+    def markSwapping(self, snapshotPath: str):
+        self.append({"swapping": snapshotPath}, sync=True)
+        self.snapshotPath = snapshotPath
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,128 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+# How long each tool takes to start, from launching Python to the window first being painted, checked against a budget:
+#     python startuptime.py                        (every tool, exit status 1 if any is over its budget)
+#     python startuptime.py updater --budget 1.5
+#     python startuptime.py --no-cache             (as if there were no `__pycache__`, to see what it saves)
+# Run it from the USB stick itself, as that is what makes starting slow
+# Each start is a new Python process, just as double-clicking the .bat file is, with the modules' own import times
+# (python -X importtime) listed for the slowest start so the cause of a slow one can be seen
+# The GUI is painted offscreen, so no window appears
+directory = os.path.dirname(os.path.realpath(__file__))
+
+# What each tool does before the user sees anything
+tools = {
+    "downloader": "import downloader\n"
+                  "app = downloader.QApplication([])\n"
+                  "dialog = downloader.DownloaderDialog()\n"
+                  "dialog.show()\n"
+                  "app.processEvents()\n",
+    "updater": "import updater\n"
+               "app = updater.QApplication([])\n"
+               "dialog = updater.UpdaterDialog()\n"
+               "dialog.show()\n"
+               "app.processEvents()\n",
+    "cli": "import cli\n"
+           "cli.parseArgs(['download'])\n",
+}
+# In seconds
+defaultBudget = 2.0
+slowestImportsShown = 10
+
+
+def timeStart(tool: str, noCache: bool) -> typing.Tuple[float, str]:
+    # Returns (seconds, the -X importtime report)
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    cacheDir = None
+    if noCache:
+        # Somewhere new and empty for the .pyc files, so everything is compiled again
+        cacheDir = tempfile.mkdtemp(prefix="jinn-pycache-")
+        env["PYTHONPYCACHEPREFIX"] = cacheDir
+    try:
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", tools[tool]], cwd=directory, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        seconds = time.perf_counter() - start
+    finally:
+        if cacheDir is not None:
+            shutil.rmtree(cacheDir, ignore_errors=True)
+    if result.returncode != 0:
+        lastLine = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ""
+        raise RuntimeError("{} did not start: {}".format(tool, lastLine))
+    return seconds, result.stderr
+
+
+def getSlowestImports(report: str, count: int) -> typing.List[typing.Tuple[int, str]]:
+    # (cumulative microseconds, module) for the top level imports which took longest
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # Only what the tool imports itself, not what those imports import in turn (which are indented further)
+        if parts[2].startswith("  "):
+            continue
+        imports.append((int(parts[1]), parts[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def getImportedModules(report: str) -> typing.Set[str]:
+    # Every module imported during the start, top level or not
+    modules = set()
+    for line in report.splitlines():
+        parts = line[len("import time:"):].split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            modules.add(parts[2].strip())
+    return modules
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Check how long the Jinn tools take to start")
+    # Checked here rather than with choices, which argparse also applies to the empty default
+    parser.add_argument("tool", nargs="*", help="tool to time: {} (default all)".format(", ".join(sorted(tools))))
+    parser.add_argument("--budget", type=float, default=defaultBudget,
+                        help="seconds allowed for each start (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="starts of each tool, the median is used")
+    parser.add_argument("--no-cache", action="store_true", help="ignore `__pycache__`, compiling every module")
+    args = parser.parse_args(argv)
+    for tool in args.tool:
+        if tool not in tools:
+            parser.error("unknown tool \"{}\"".format(tool))
+    return args
+
+
+def main(argv=None) -> int:
+    args = parseArgs(argv)
+    overBudget = []
+    for tool in args.tool or sorted(tools):
+        try:
+            starts = [timeStart(tool, args.no_cache) for _ in range(args.repeat)]
+        except RuntimeError as ex:
+            print(ex, file=sys.stderr)
+            overBudget.append(tool)
+            continue
+        median = statistics.median(seconds for seconds, report in starts)
+        slowest, report = max(starts)
+        verdict = "over budget" if median > args.budget else "ok"
+        print("{:<12}{:>7.3f}s median, {:.3f}s slowest ({:.1f}s budget) {}".format(
+            tool, median, slowest, args.budget, verdict))
+        for microseconds, module in getSlowestImports(report, slowestImportsShown):
+            print("    {:>8.1f}ms  {}".format(microseconds / 1000, module))
+        if median > args.budget:
+            overBudget.append(tool)
+    return 1 if overBudget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
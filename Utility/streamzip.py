@@ -0,0 +1,297 @@
+import hashlib
+import queue
+import struct
+import threading
+import time
+import typing
+import zlib
+
+from sinks import NullWriter
+
+# Extracts a zip archive as it arrives over the network, without ever writing the zip itself to disk
+# A zip file can be read front to back: every member is preceded by a "local file header" giving its name,
+# compression method and (usually) its sizes, and the central directory at the end only repeats that information
+# So we parse local headers as they arrive, decompress each member straight into its file, and only keep
+# the (small) central directory in memory at the end, to check that we saw every member it lists
+#
+# GitHub archives are deflated, which we can always stream because the deflate data marks its own end
+# A *stored* member with its sizes deferred to a trailing "data descriptor" cannot be streamed: we raise
+# NotStreamableError for that and the caller falls back to downloading the zip first
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+localHeaderSignature = 0x04034b50
+centralHeaderSignature = 0x02014b50
+dataDescriptorSignature = 0x08074b50
+localHeaderStruct = struct.Struct("<IHHHHHIIIHH")
+centralHeaderStruct = struct.Struct("<IHHHHHHIIIHHHHHII")
+
+flagDataDescriptor = 0x08
+flagUtf8 = 0x800
+methodStored = 0
+methodDeflated = 8
+
+# Size of each read from the network
+chunkSize = 64 * 1024
+# How many chunks the network reader may get ahead of the extractor, i.e. at most this * chunkSize in memory
+queueDepth = 32
+
+
+class NotStreamableError(Exception):
+    """The archive uses a layout which cannot be extracted without seeing the whole file first"""
+
+
+class BadStreamError(Exception):
+    """The archive being streamed is corrupt or truncated"""
+
+
+class QueuedReader:
+    """Reads a stream on a background thread, so the network transfer overlaps with decompressing and writing"""
+    # Only queueDepth chunks are ever buffered, so a slow disk holds up the network rather than using up memory
+    # The whole stream's SHA-256 is worked out on the same thread, for the integrity manifest (see integrity.py)
+
+    def __init__(self, stream, total: int = 0, progress: ProgressFunc = None):
+        self.stream = stream
+        self.total = total
+        self.progress = progress
+        self.bytesRead = 0
+        self.sha = hashlib.sha256()
+        self.queue = queue.Queue(queueDepth)
+        self.error = None
+        self.stopped = False
+        self.buffer = b""
+        self.position = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self.readAll, daemon=True)
+        self.thread.start()
+
+    def readAll(self):
+        try:
+            while not self.stopped:
+                chunk = self.stream.read(chunkSize)
+                self.sha.update(chunk)
+                self.putChunk(chunk)
+                if not chunk:
+                    return
+        except Exception as ex:
+            self.error = ex
+            self.putChunk(b"")
+
+    def putChunk(self, chunk: bytes):
+        # Wait for room in the queue, but give up if the extractor has gone away
+        while not self.stopped:
+            try:
+                self.queue.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def nextChunk(self) -> bytes:
+        if self.eof:
+            return b""
+        chunk = self.queue.get()
+        if not chunk:
+            self.eof = True
+            if self.error is not None:
+                raise self.error
+            return b""
+        self.bytesRead += len(chunk)
+        if self.progress is not None:
+            self.progress(self.bytesRead, self.total)
+        return chunk
+
+    def read(self, size: int) -> bytes:
+        # Read exactly size bytes (or fewer only at the end of the stream)
+        # We keep a position into the buffer rather than slicing the rest of it off on every small header read
+        if len(self.buffer) - self.position < size:
+            parts = [self.buffer[self.position:]]
+            available = len(parts[0])
+            while available < size:
+                chunk = self.nextChunk()
+                if not chunk:
+                    break
+                parts.append(chunk)
+                available += len(chunk)
+            self.buffer, self.position = b"".join(parts), 0
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readSome(self) -> bytes:
+        # Whatever is buffered, or the next chunk
+        if self.position < len(self.buffer):
+            data = self.buffer[self.position:]
+            self.buffer, self.position = b"", 0
+            return data
+        return self.nextChunk()
+
+    def unread(self, data: bytes):
+        if data:
+            self.buffer, self.position = data + self.buffer[self.position:], 0
+
+    def getDigest(self) -> str:
+        # Only the whole stream's hash once the extractor has read to the end
+        return self.sha.hexdigest()
+
+    def close(self):
+        self.stopped = True
+
+
+def zipTimeToTimestamp(dosTime: int, dosDate: int) -> float:
+    dateTime = ((dosDate >> 9) + 1980, (dosDate >> 5) & 0xF, dosDate & 0x1F,
+                dosTime >> 11, (dosTime >> 5) & 0x3F, (dosTime & 0x1F) * 2, 0, 0, -1)
+    try:
+        return time.mktime(dateTime)
+    except (OverflowError, ValueError):
+        return time.time()
+
+
+def parseZip64Sizes(extra: bytes, compressedSize: int, uncompressedSize: int) -> typing.Tuple[int, int]:
+    # Sizes of 0xFFFFFFFF mean "see the zip64 extra field" (id 1), which holds just the ones that overflowed
+    offset = 0
+    while offset + 4 <= len(extra):
+        headerId, dataSize = struct.unpack_from("<HH", extra, offset)
+        if headerId == 0x0001:
+            values = list(struct.unpack_from("<{}Q".format(dataSize // 8), extra, offset + 4))
+            if uncompressedSize == 0xFFFFFFFF and values:
+                uncompressedSize = values.pop(0)
+            if compressedSize == 0xFFFFFFFF and values:
+                compressedSize = values.pop(0)
+            break
+        offset += 4 + dataSize
+    return compressedSize, uncompressedSize
+
+
+def hasZip64Extra(extra: bytes) -> bool:
+    offset = 0
+    while offset + 4 <= len(extra):
+        headerId, dataSize = struct.unpack_from("<HH", extra, offset)
+        if headerId == 0x0001:
+            return True
+        offset += 4 + dataSize
+    return False
+
+
+class StreamingZipExtractor:
+    """Extracts members from a QueuedReader into a sink (see sinks.py), as they arrive"""
+
+    def __init__(self, reader: QueuedReader, sink, memberCallback: typing.Callable[[str], None] = None):
+        self.reader = reader
+        self.sink = sink
+        self.memberCallback = memberCallback
+        self.extractedNames = []
+
+    def extractAll(self):
+        while True:
+            signatureBytes = self.reader.read(4)
+            if len(signatureBytes) < 4:
+                raise BadStreamError("Archive ended before its central directory")
+            signature, = struct.unpack("<I", signatureBytes)
+            if signature == localHeaderSignature:
+                self.extractMember(signatureBytes)
+            elif signature == centralHeaderSignature:
+                self.reader.unread(signatureBytes)
+                self.checkCentralDirectory()
+                self.sink.finish()
+                return
+            else:
+                raise BadStreamError("Unexpected data in archive (signature {:#x})".format(signature))
+
+    def extractMember(self, signatureBytes: bytes):
+        header = signatureBytes + self.reader.read(localHeaderStruct.size - 4)
+        if len(header) < localHeaderStruct.size:
+            raise BadStreamError("Archive ended inside a member header")
+        (_, _, flags, method, dosTime, dosDate, crc, compressedSize, uncompressedSize,
+         nameLength, extraLength) = localHeaderStruct.unpack(header)
+        nameBytes = self.reader.read(nameLength)
+        extra = self.reader.read(extraLength)
+        name = nameBytes.decode("utf-8" if flags & flagUtf8 else "cp437")
+        compressedSize, uncompressedSize = parseZip64Sizes(extra, compressedSize, uncompressedSize)
+        hasDescriptor = bool(flags & flagDataDescriptor)
+
+        if method not in (methodStored, methodDeflated):
+            raise NotStreamableError("\"{}\" uses unsupported compression method {}".format(name, method))
+        if method == methodStored and hasDescriptor:
+            raise NotStreamableError("\"{}\" is stored without its size in the header".format(name))
+
+        if self.memberCallback is not None:
+            self.memberCallback(name)
+        self.extractedNames.append(name)
+        if name.endswith("/"):
+            self.sink.addDirectory(name)
+            writer = NullWriter()
+        else:
+            writer = self.sink.openFile(name, zipTimeToTimestamp(dosTime, dosDate))
+
+        try:
+            if method == methodStored:
+                actualCrc = self.copyStored(compressedSize, writer)
+            else:
+                actualCrc = self.copyDeflated(writer)
+            if hasDescriptor:
+                crc = self.readDataDescriptor(hasZip64Extra(extra))
+            if actualCrc != crc:
+                raise BadStreamError("CRC check failed for \"{}\"".format(name))
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+    def copyStored(self, size: int, writer) -> int:
+        crc = 0
+        remaining = size
+        while remaining > 0:
+            data = self.reader.readSome()
+            if not data:
+                raise BadStreamError("Archive ended inside a member")
+            if len(data) > remaining:
+                self.reader.unread(data[remaining:])
+                data = data[:remaining]
+            remaining -= len(data)
+            crc = zlib.crc32(data, crc)
+            writer.write(data)
+        return crc
+
+    def copyDeflated(self, writer) -> int:
+        # The deflate stream knows where it ends, so we don't need the compressed size
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        crc = 0
+        while not decompressor.eof:
+            data = self.reader.readSome()
+            if not data:
+                raise BadStreamError("Archive ended inside a member")
+            output = decompressor.decompress(data)
+            crc = zlib.crc32(output, crc)
+            writer.write(output)
+        # Whatever the decompressor didn't need belongs to the next header
+        self.reader.unread(decompressor.unused_data)
+        return crc
+
+    def readDataDescriptor(self, isZip64: bool) -> int:
+        # [signature], crc, compressed size, uncompressed size - the sizes are 8 bytes each in zip64 archives
+        # We only need the crc, having found the end of the data from the deflate stream itself
+        data = self.reader.read(4)
+        if struct.unpack("<I", data)[0] == dataDescriptorSignature:
+            data = self.reader.read(4)
+        crc, = struct.unpack("<I", data)
+        self.reader.read(16 if isZip64 else 8)
+        return crc
+
+    def checkCentralDirectory(self):
+        # The central directory is small (roughly 100 bytes per member), so just collect it in memory
+        names = []
+        while True:
+            header = self.reader.read(centralHeaderStruct.size)
+            if len(header) < 4 or struct.unpack_from("<I", header)[0] != centralHeaderSignature:
+                break
+            if len(header) < centralHeaderStruct.size:
+                raise BadStreamError("Archive ended inside its central directory")
+            fields = centralHeaderStruct.unpack(header)
+            flags, nameLength, extraLength, commentLength = fields[3], fields[10], fields[11], fields[12]
+            nameBytes = self.reader.read(nameLength)
+            self.reader.read(extraLength + commentLength)
+            names.append(nameBytes.decode("utf-8" if flags & flagUtf8 else "cp437"))
+        # Drain the end-of-central-directory record (and anything after it)
+        while self.reader.readSome():
+            pass
+        if sorted(names) != sorted(self.extractedNames):
+            raise BadStreamError("Archive's central directory does not match the members extracted")
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import typing
+
+# Comparing one directory tree with another, to find what has changed (see install.py, which builds the new tree)
+# Both trees are described by a "manifest": relative path (always with "/" separators) -> FileEntry
+# A file is unchanged if its size and content hash match, or (where a hash is not known on both sides) its size and
+# modification time, so for a small upstream change the work done depends on the size of the change, not the size
+# of the repo
+
+# FAT/exFAT USB sticks only store modification times to the nearest 2 seconds
+mtimeTolerance = 2.0
+hashBufferSize = 1024 * 1024
+
+
+class FileEntry:
+    def __init__(self, size: int, mtime: float, hash: str = None):
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+
+    def toJson(self) -> dict:
+        return {"size": self.size, "mtime": self.mtime, "hash": self.hash}
+
+    @staticmethod
+    def fromJson(data: dict) -> 'FileEntry':
+        return FileEntry(data["size"], data["mtime"], data.get("hash"))
+
+
+class SyncStats:
+    def __init__(self):
+        self.filesCopied = 0
+        self.bytesCopied = 0
+        self.filesDeleted = 0
+        self.filesSkipped = 0
+        self.bytesSkipped = 0
+
+    def summary(self) -> str:
+        return "{} file(s) copied ({} bytes), {} deleted, {} unchanged file(s) skipped ({} bytes)".format(
+            self.filesCopied, self.bytesCopied, self.filesDeleted, self.filesSkipped, self.bytesSkipped)
+
+
+def hashFile(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(hashBufferSize)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def buildManifest(root: str, hashContents: bool = False) -> typing.Dict[str, FileEntry]:
+    manifest = {}
+    if not os.path.isdir(root):
+        return manifest
+    stack = [("", root)]
+    while stack:
+        relDir, absDir = stack.pop()
+        with os.scandir(absDir) as entries:
+            for entry in entries:
+                relPath = relDir + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((relPath + "/", entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    manifest[relPath] = FileEntry(st.st_size, st.st_mtime,
+                                                  hashFile(entry.path) if hashContents else None)
+    return manifest
+
+
+def getManifestDigest(manifest: typing.Dict[str, FileEntry]) -> str:
+    # Identifies a version of the code: the same files with the same contents (or times, where not hashed)
+    sha = hashlib.sha256()
+    for relPath in sorted(manifest):
+        entry = manifest[relPath]
+        sha.update("{}\0{}\0{}\n".format(relPath, entry.size, entry.hash or entry.mtime).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def isSameFile(source: FileEntry, target: FileEntry) -> bool:
+    if source.size != target.size:
+        return False
+    if source.hash is not None and target.hash is not None:
+        return source.hash == target.hash
+    return abs(source.mtime - target.mtime) <= mtimeTolerance
+
+
+class SyncPlan:
+    """What needs doing to make the target tree match the source tree"""
+
+    def __init__(self, source: typing.Dict[str, FileEntry], target: typing.Dict[str, FileEntry]):
+        self.source = source
+        self.target = target
+        self.added = sorted(path for path in source if path not in target)
+        self.changed = sorted(path for path in source if path in target and not isSameFile(source[path], target[path]))
+        self.removed = sorted(path for path in target if path not in source)
+        self.unchanged = sorted(path for path in source if path in target and isSameFile(source[path], target[path]))
+
+
+def toNativePath(root: str, relPath: str) -> str:
+    return os.path.join(root, *relPath.split("/"))
+
+
+def getSourceDirectories(sourceDir: str) -> typing.Set[str]:
+    directories = set()
+    for dirPath, _, _ in os.walk(sourceDir):
+        directories.add(os.path.relpath(dirPath, sourceDir).replace(os.sep, "/"))
+    return directories
+
@@ -0,0 +1,72 @@
+import hashlib
+import http.server
+import os
+import random
+import sys
+import threading
+
+import pytest
+
+# The modules import each other by name, as they do when run from `Utility`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import ArchiveHandler
+
+
+def makeArchive(size: int, seed: int = 1) -> bytes:
+    # Incompressible, so every byte has to come over the connection
+    return random.Random(seed).randbytes(size)
+
+
+def setArchive(archive: bytes):
+    # What benchmark.ArchiveHandler (and the handlers here based on it) serve
+    ArchiveHandler.archive = archive
+    ArchiveHandler.etag = "\"{}\"".format(hashlib.sha1(archive).hexdigest())
+
+
+class RecordingHandler(ArchiveHandler):
+    """ArchiveHandler, keeping count of connections and of the Range headers asked for"""
+    connections = 0
+    ranges = []
+    lock = threading.Lock()
+
+    def setup(self):
+        with RecordingHandler.lock:
+            RecordingHandler.connections += 1
+        super().setup()
+
+    def parse_request(self) -> bool:
+        # Before any handler based on this one gets to answer the request
+        if not super().parse_request():
+            return False
+        with RecordingHandler.lock:
+            RecordingHandler.ranges.append(self.headers.get("Range"))
+        return True
+
+
+def serve(handler) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def startServer():
+    # startServer(handler) -> the url of the archive, served until the test ends
+    servers = []
+    RecordingHandler.connections = 0
+    RecordingHandler.ranges = []
+    ArchiveHandler.limiter = None
+    ArchiveHandler.connectionBytesPerSecond = None
+    ArchiveHandler.latency = 0.0
+
+    def start(handler=RecordingHandler) -> str:
+        server = serve(handler)
+        servers.append(server)
+        return "http://127.0.0.1:{}/archive.zip".format(server.server_port)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
@@ -0,0 +1,86 @@
+import io
+import time
+import zipfile
+
+import pytest
+
+import pipeline
+from conftest import RecordingHandler, makeArchive
+from objectstore import ObjectStore
+from pipeline import storeBranches
+from updatevariables import UpdateVariables
+
+# Several branches downloaded at once over the pooled keep-alive connections of connections.py, from a local
+# server which redirects archive urls as GitHub does (github.com -> codeload.github.com)
+
+
+class BranchHandler(RecordingHandler):
+    """Serves /codeload/<branch>.zip, with /archive/<branch>.zip redirecting to it"""
+    archives = {}
+
+    def do_GET(self):
+        name = self.path.rsplit("/", 1)[-1]
+        if self.path.startswith("/archive/"):
+            self.send_response(302)
+            self.send_header("Location", "/codeload/" + name)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        archive = BranchHandler.archives[name]
+        self.send_response(200)
+        self.send_header("ETag", "\"{}-{}\"".format(name, len(archive)))
+        self.send_header("Content-Length", str(len(archive)))
+        self.end_headers()
+        self.wfile.write(archive)
+
+
+def makeBranchArchive(branch: str, size: int) -> bytes:
+    # As GitHub's: everything in a "Jinn-<branch>" folder, here one incompressible file and one of its own
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr("Jinn-{}/resources/blob.bin".format(branch), makeArchive(size, seed=len(branch)))
+        archive.writestr("Jinn-{}/branch.txt".format(branch), branch)
+    return data.getvalue()
+
+
+@pytest.fixture
+def branchServer(startServer, monkeypatch):
+    # Points every UpdateVariables storeBranches() makes at the local server, returns serve(branches, size)
+    def serve(branches, size: int):
+        BranchHandler.archives = {"{}.zip".format(branch): makeBranchArchive(branch, size) for branch in branches}
+        url = startServer(BranchHandler)
+
+        class LocalVariables(UpdateVariables):
+            def __init__(self, branch: str = None):
+                super().__init__(branch)
+                self.zipFileUrl = url.rsplit("/", 1)[0] + "/archive"
+        monkeypatch.setattr(pipeline, "UpdateVariables", LocalVariables)
+        return sum(len(archive) for archive in BranchHandler.archives.values())
+    return serve
+
+
+def testBranchesShareKeepAliveConnections(branchServer, tmp_path):
+    branches = ["HJinn", "LJinn", "master", "extra"]
+    branchServer(branches, 64 * 1024)
+    storePath = str(tmp_path / "ObjectStore")
+    log = []
+    storeBranches(log.append, branches, maxConnections=2, storePath=storePath)
+    # A redirect and a download for each branch, and never more than two connections
+    assert len(RecordingHandler.ranges) == 2 * len(branches)
+    assert RecordingHandler.connections <= 2
+    store = ObjectStore(storePath)
+    assert store.listBranches() == sorted(branches)
+    for branch in branches:
+        assert set(store.getBranchManifest(branch)) == {"resources/blob.bin", "branch.txt"}
+
+
+def testBandwidthLimitIsSharedByEveryBranch(branchServer, tmp_path):
+    branches = ["HJinn", "LJinn"]
+    total = branchServer(branches, 384 * 1024)
+    bytesPerSecond = 256 * 1024
+    start = time.monotonic()
+    storeBranches(lambda text: None, branches, bytesPerSecond=bytesPerSecond, storePath=str(tmp_path / "ObjectStore"))
+    elapsed = time.monotonic() - start
+    # The limiter allows up to a second's worth straight away, everything after that at the limit
+    assert elapsed >= (total - bytesPerSecond) / bytesPerSecond * 0.95
+    assert ObjectStore(str(tmp_path / "ObjectStore")).listBranches() == sorted(branches)
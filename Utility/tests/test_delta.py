@@ -0,0 +1,105 @@
+import pathlib
+import random
+
+import pytest
+
+from delta import DeltaSource, DeltaStore, buildPackages
+from fleet import MachineRecord
+from install import buildStaging, swapInStaging
+from integrity import IntegrityError
+from objectstore import ObjectStore
+from sync import buildManifest, getManifestDigest, toNativePath
+
+# Delta packages (delta.py, bindiff.py) made between two temporary trees in a delivery cache, and applied to `Code`
+
+
+def makeTrees() -> tuple:
+    # (old files, new files): one file edited, one the same, one added and one deleted
+    data = random.Random(1).randbytes(64 * 1024)
+    old = {"big.bin": data, "same.py": b"print('same')\n", "gone.py": b"print('gone')\n"}
+    new = {"big.bin": data[:1000] + b"edited" + data[1006:], "same.py": old["same.py"], "sub/new.py": b"print(1)\n"}
+    return old, new
+
+
+def writeTree(root: pathlib.Path, files: dict):
+    for relPath, data in files.items():
+        path = pathlib.Path(toNativePath(str(root), relPath))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def addVersion(cache: ObjectStore, root: pathlib.Path, files: dict, branch: str = None) -> dict:
+    # Put a tree in the cache as the latest download of branch (or as a version, by its digest), returns its manifest
+    writeTree(root, files)
+    manifest = buildManifest(str(root), hashContents=True)
+    for relPath, data in files.items():
+        cache.addBytes(data)
+    cache.saveBranch(branch or getManifestDigest(manifest), manifest)
+    return manifest
+
+
+def applyPackage(source: DeltaSource, codeDir: pathlib.Path):
+    buildStaging(lambda text: None, source, str(codeDir))
+    swapInStaging(lambda text: None, str(codeDir), "OldCode-test")
+
+
+def assertMatches(codeDir: pathlib.Path, target: dict):
+    actual = buildManifest(str(codeDir), hashContents=True)
+    assert {relPath: (entry.size, entry.hash) for relPath, entry in actual.items()} == \
+           {relPath: (entry.size, entry.hash) for relPath, entry in target.items()}
+
+
+@pytest.fixture
+def delivery(tmp_path) -> tuple:
+    # (cache, stick's delta store, old manifest, new manifest, `Code` with the old files)
+    old, new = makeTrees()
+    cache = ObjectStore(str(tmp_path / "DeliveryCache"))
+    oldManifest = addVersion(cache, tmp_path / "old", old)
+    newManifest = addVersion(cache, tmp_path / "new", new, "master")
+    writeTree(tmp_path / "Code", old)
+    return cache, DeltaStore(str(tmp_path / "CodeDelta")), oldManifest, newManifest, tmp_path / "Code"
+
+
+def testPackageAgainstTheBaseGivesTheTarget(delivery):
+    cache, deltaStore, oldManifest, newManifest, codeDir = delivery
+    base = getManifestDigest(oldManifest)
+    stats = buildPackages(lambda text: None, cache, ["master"], deltaStore, [MachineRecord("pc", "PC", "master", base)])
+    assert (stats.unchanged, stats.patched, stats.whole, stats.deleted) == (1, 1, 1, 1)
+    assert stats.patchBytes < newManifest["big.bin"].size * 0.1
+    assert deltaStore.listPackages() == [("master", base)]
+    # Only the patch and the new file are carried
+    assert len(deltaStore.getReferenced()) == 2
+
+    source = DeltaSource(deltaStore, "master", base, str(codeDir))
+    assert source.package["base"] == base
+    applyPackage(source, codeDir)
+    assertMatches(codeDir, newManifest)
+
+
+def testUnknownBaseTakesThePackageWithEveryFileWhole(delivery):
+    cache, deltaStore, oldManifest, newManifest, codeDir = delivery
+    # A PC whose version the cache doesn't have gets the package made against nothing
+    unknown = "0" * 64
+    stats = buildPackages(lambda text: None, cache, ["master"], deltaStore,
+                          [MachineRecord("pc", "PC", "master", unknown)])
+    assert (stats.patched, stats.whole) == (0, len(newManifest))
+    assert deltaStore.listPackages() == [("master", None)]
+
+    source = DeltaSource(deltaStore, "master", unknown, str(codeDir))
+    assert source.package["base"] is None
+    applyPackage(source, codeDir)
+    assertMatches(codeDir, newManifest)
+
+
+def testPatchIsNotAppliedToTheWrongBase(delivery):
+    cache, deltaStore, oldManifest, newManifest, codeDir = delivery
+    base = getManifestDigest(oldManifest)
+    buildPackages(lambda text: None, cache, ["master"], deltaStore, [MachineRecord("pc", "PC", "master", base)])
+    # Changed since it was recorded, so the patch was made against something else
+    bigPath = codeDir / "big.bin"
+    bigPath.write_bytes(bigPath.read_bytes()[::-1])
+    before = {relPath: entry.hash for relPath, entry in buildManifest(str(codeDir), hashContents=True).items()}
+    with pytest.raises(IntegrityError, match="not the version this package was made against"):
+        applyPackage(DeltaSource(deltaStore, "master", base, str(codeDir)), codeDir)
+    # `Code` is left as it was, for a full download to update instead
+    assert {relPath: entry.hash for relPath, entry in buildManifest(str(codeDir), hashContents=True).items()} == before
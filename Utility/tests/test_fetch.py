@@ -0,0 +1,155 @@
+import hashlib
+import http.client
+import os
+
+import pytest
+
+import fetch
+from benchmark import ArchiveHandler
+from conftest import RecordingHandler, makeArchive, setArchive
+from fetch import fetchOnce, fetchToFile, getJournalPath, getPartPath
+
+# Resuming a single-stream download (fetch.py) against a local server which accepts Range requests
+# The archives are smaller than two segments (fetch.minimumSegmentSize), so they are never split
+archiveSize = 3 * 1024 * 1024
+# Where the connection drops: the journal is brought up to date with what arrived, so resuming starts here
+truncatedSize = archiveSize // 2
+
+
+class TruncatingHandler(RecordingHandler):
+    """Drops the connection part way through the next full response"""
+    truncateAt = None
+
+    def do_GET(self):
+        truncateAt = TruncatingHandler.truncateAt
+        if truncateAt is None or self.headers.get("Range"):
+            super().do_GET()
+            return
+        TruncatingHandler.truncateAt = None
+        archive = ArchiveHandler.archive
+        self.send_response(200)
+        self.send_header("ETag", ArchiveHandler.etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(archive)))
+        self.end_headers()
+        self.wfile.write(archive[:truncateAt])
+        self.close_connection = True
+
+
+class IgnoringRangeHandler(TruncatingHandler):
+    """Always sends the whole archive, as a server which doesn't do ranges does"""
+
+    def do_GET(self):
+        if "Range" in self.headers:
+            del self.headers["Range"]
+        super().do_GET()
+
+
+class WrongRangeHandler(TruncatingHandler):
+    """Answers a Range request with a 206, but from the start of the archive"""
+
+    def do_GET(self):
+        if not self.headers.get("Range"):
+            super().do_GET()
+            return
+        archive = ArchiveHandler.archive
+        self.send_response(206)
+        self.send_header("ETag", ArchiveHandler.etag)
+        self.send_header("Content-Range", "bytes 0-{}/{}".format(len(archive) - 1, len(archive)))
+        self.send_header("Content-Length", str(len(archive)))
+        self.end_headers()
+        self.wfile.write(archive)
+
+
+@pytest.fixture(autouse=True)
+def noRetryDelay(monkeypatch):
+    monkeypatch.setattr(fetch, "retryDelay", 0)
+    TruncatingHandler.truncateAt = None
+
+
+def readFile(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def assertDownloaded(target: str, result: dict, archive: bytes):
+    assert readFile(target) == archive
+    assert result["sha256"] == hashlib.sha256(archive).hexdigest()
+    assert result["size"] == len(archive)
+    assert not os.path.exists(getPartPath(target))
+    assert not os.path.exists(getJournalPath(target))
+
+
+def startTruncated(startServer, tmp_path, handler) -> str:
+    # A download which dropped part way, leaving the .part file and its journal, returns the url
+    url = startServer(handler)
+    TruncatingHandler.truncateAt = truncatedSize
+    with pytest.raises(http.client.IncompleteRead):
+        fetchOnce(url, str(tmp_path / "archive.zip"), lambda text: None)
+    assert os.path.exists(getPartPath(str(tmp_path / "archive.zip")))
+    return url
+
+
+def testResumesAfterTheConnectionDrops(startServer, tmp_path):
+    archive = makeArchive(archiveSize)
+    setArchive(archive)
+    url = startServer(TruncatingHandler)
+    TruncatingHandler.truncateAt = truncatedSize
+    target = str(tmp_path / "archive.zip")
+    log = []
+    result = fetchToFile(url, target, log.append, segments=1)
+    assertDownloaded(target, result, archive)
+    assert "Resuming download at {} bytes".format(truncatedSize) in log
+    assert RecordingHandler.ranges == [None, "bytes={}-".format(truncatedSize)]
+
+
+def testStartsAgainWhenTheServerIgnoresRange(startServer, tmp_path):
+    archive = makeArchive(archiveSize)
+    setArchive(archive)
+    url = startTruncated(startServer, tmp_path, IgnoringRangeHandler)
+    target = str(tmp_path / "archive.zip")
+    log = []
+    result = fetchToFile(url, target, log.append, segments=1)
+    assertDownloaded(target, result, archive)
+    assert "Server does not support resuming this download, downloading from the start" in log
+
+
+def testStartsAgainWhenTheServerSendsTheWrongRange(startServer, tmp_path):
+    archive = makeArchive(archiveSize)
+    setArchive(archive)
+    url = startTruncated(startServer, tmp_path, WrongRangeHandler)
+    target = str(tmp_path / "archive.zip")
+    log = []
+    result = fetchToFile(url, target, log.append, segments=1)
+    assertDownloaded(target, result, archive)
+    assert "Server sent the wrong part of the download, starting again" in log
+    assert RecordingHandler.ranges[-1] is None
+
+
+def testStartsAgainWhenTheArchiveChanged(startServer, tmp_path):
+    setArchive(makeArchive(archiveSize))
+    url = startTruncated(startServer, tmp_path, TruncatingHandler)
+    # A new ETag, so If-Range gets the whole new archive rather than the rest of the old one
+    archive = makeArchive(archiveSize, seed=2)
+    setArchive(archive)
+    target = str(tmp_path / "archive.zip")
+    log = []
+    result = fetchToFile(url, target, log.append, segments=1)
+    assertDownloaded(target, result, archive)
+    assert result["etag"] == ArchiveHandler.etag
+    assert RecordingHandler.ranges[-1] == "bytes={}-".format(truncatedSize)
+
+
+def testNothingDownloadedWhenNotModified(startServer, tmp_path):
+    archive = makeArchive(256 * 1024)
+    setArchive(archive)
+    url = startServer()
+    target = str(tmp_path / "archive.zip")
+    validators = fetchToFile(url, target, lambda text: None)
+    assertDownloaded(target, validators, archive)
+    assert fetchToFile(url, target, lambda text: None, validators=validators) is None
+    assert readFile(target) == archive
+    # Once it has changed the same validators get the new archive
+    archive = makeArchive(256 * 1024, seed=2)
+    setArchive(archive)
+    assertDownloaded(target, fetchToFile(url, target, lambda text: None, validators=validators), archive)
@@ -0,0 +1,174 @@
+import os
+import pathlib
+
+import pytest
+
+import install
+from install import DirectorySource, buildStaging, getInstalledManifestPath, getStagingDir, rollback, swapInStaging
+from integrity import IntegrityManifest
+from stagingjournal import getJournalPath
+from sync import buildManifest, hashFile
+
+# The staged install (install.py) over a temporary `Code` directory
+# GitHub stamps every file in an archive with the time of the commit, so the new code's times never match `Code`'s
+commitTime = 1600000000
+installTime = 1700000000
+
+
+class Interrupted(Exception):
+    pass
+
+
+def writeTree(root: pathlib.Path, files: dict, mtime: int):
+    for relPath, text in files.items():
+        path = root / relPath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+        os.utime(str(path), (mtime, mtime))
+
+
+def readTree(root: pathlib.Path) -> dict:
+    return {relPath: (root / relPath).read_text() for relPath in buildManifest(str(root))}
+
+
+@pytest.fixture
+def trees(tmp_path) -> tuple:
+    # (`Code`, the new code): eight files the same, one changed and one new
+    oldFiles = {"f{}.py".format(number): "print({})\n".format(number) for number in range(9)}
+    oldFiles["resources/data.txt"] = "old data\n"
+    newFiles = dict(oldFiles)
+    newFiles["f8.py"] = "print('eight')\n"
+    newFiles["resources/new.txt"] = "new\n"
+    writeTree(tmp_path / "Code", oldFiles, installTime)
+    writeTree(tmp_path / "NewCode", newFiles, commitTime)
+    return tmp_path / "Code", tmp_path / "NewCode"
+
+
+def interruptAfter(monkeypatch, name: str, count: int):
+    # Stop the build the count+1'th time install.<name> is called, as if the PC were shut down
+    original = getattr(install, name)
+    calls = []
+
+    def interrupted(*args):
+        if len(calls) == count:
+            raise Interrupted()
+        calls.append(args)
+        original(*args)
+    monkeypatch.setattr(install, name, interrupted)
+
+
+def testResumesAfterBeingInterruptedWhileLinking(trees, monkeypatch):
+    codeDir, newCodeDir = trees
+    source = DirectorySource(str(newCodeDir), hashContents=True)
+    interruptAfter(monkeypatch, "linkOrCopy", 3)
+    with pytest.raises(Interrupted):
+        buildStaging(lambda text: None, source, str(codeDir))
+    monkeypatch.undo()
+    stagingDir = getStagingDir(str(codeDir))
+    assert os.path.exists(getJournalPath(stagingDir))
+
+    # The links already made are kept, even though their times are `Code`'s and not the new code's
+    log = []
+    buildStaging(log.append, source, str(codeDir))
+    assert "Carrying on building new code in \"{}\", 3 file(s) already done by an update which was interrupted".format(
+        stagingDir) in log
+    assert readTree(pathlib.Path(stagingDir)) == readTree(newCodeDir)
+    assert os.path.samefile(str(codeDir / "f0.py"), os.path.join(stagingDir, "f0.py"))
+    assert readTree(codeDir)["f8.py"] == "print(8)\n"
+
+
+def testResumesAfterBeingInterruptedWhileCopying(trees, monkeypatch):
+    codeDir, newCodeDir = trees
+    source = DirectorySource(str(newCodeDir), hashContents=True)
+
+    def copyPartly(self, relPath: str, targetPath: str):
+        with open(targetPath, 'w') as f:
+            f.write("pri")
+        raise Interrupted()
+    monkeypatch.setattr(DirectorySource, "copyFile", copyPartly)
+    with pytest.raises(Interrupted):
+        buildStaging(lambda text: None, source, str(codeDir))
+    monkeypatch.undo()
+
+    # Every link was made before the copying started, the half written file is written again
+    log = []
+    buildStaging(log.append, source, str(codeDir))
+    assert any("9 file(s) already done" in text for text in log)
+    stagingDir = pathlib.Path(getStagingDir(str(codeDir)))
+    assert readTree(stagingDir) == readTree(newCodeDir)
+    assert readTree(codeDir)["f8.py"] == "print(8)\n"
+
+
+def installNewCode(codeDir: pathlib.Path, newCodeDir: pathlib.Path) -> str:
+    # Build and swap in the new code, returns the old code's snapshot
+    buildStaging(lambda text: None, DirectorySource(str(newCodeDir), hashContents=True), str(codeDir))
+    return swapInStaging(lambda text: None, str(codeDir), "OldCode-test")
+
+
+def testUnchangedFilesAreLinkedAndChangedOnesCopied(trees):
+    codeDir, newCodeDir = trees
+    stagingDir, stats = buildStaging(lambda text: None, DirectorySource(str(newCodeDir), hashContents=True),
+                                     str(codeDir))
+    assert (stats.filesSkipped, stats.filesCopied) == (9, 2)
+    assert not os.path.samefile(str(codeDir / "f8.py"), os.path.join(stagingDir, "f8.py"))
+    for relPath in buildManifest(stagingDir):
+        if relPath not in ("f8.py", "resources/new.txt"):
+            assert os.path.samefile(str(codeDir / relPath), os.path.join(stagingDir, relPath))
+    assert readTree(pathlib.Path(stagingDir)) == readTree(newCodeDir)
+
+
+def testSwapRecordsTheInstalledFiles(trees):
+    codeDir, newCodeDir = trees
+    oldFiles = readTree(codeDir)
+    snapshotPath = installNewCode(codeDir, newCodeDir)
+    assert readTree(codeDir) == readTree(newCodeDir)
+    assert readTree(pathlib.Path(snapshotPath)) == oldFiles
+    stagingDir = getStagingDir(str(codeDir))
+    assert not os.path.exists(stagingDir)
+    assert not os.path.exists(getJournalPath(stagingDir))
+    assert not os.path.exists(getInstalledManifestPath(stagingDir))
+    # Each file as installed, with its hash, so the next update need not read them again
+    installed = IntegrityManifest.load(getInstalledManifestPath(str(codeDir)))
+    actual = buildManifest(str(codeDir))
+    assert sorted(installed.files) == sorted(actual)
+    for relPath, entry in installed.files.items():
+        assert (entry.size, entry.mtime) == (actual[relPath].size, actual[relPath].mtime)
+        assert entry.hash == hashFile(str(codeDir / relPath))
+
+
+def testFailedSwapPutsCodeBack(trees, monkeypatch):
+    codeDir, newCodeDir = trees
+    oldManifest = buildManifest(str(codeDir), hashContents=True)
+    buildStaging(lambda text: None, DirectorySource(str(newCodeDir), hashContents=True), str(codeDir))
+    rename = os.rename
+    stagingDir = getStagingDir(str(codeDir))
+
+    def failingRename(source: str, target: str):
+        # `Code` has been moved aside, and now the new code can't be moved in (e.g. a file in it is open)
+        if source == stagingDir:
+            raise PermissionError("in use")
+        rename(source, target)
+    monkeypatch.setattr(os, "rename", failingRename)
+    with pytest.raises(PermissionError):
+        swapInStaging(lambda text: None, str(codeDir), "OldCode-test")
+    monkeypatch.undo()
+    restored = buildManifest(str(codeDir), hashContents=True)
+    assert sorted(restored) == sorted(oldManifest)
+    assert all(restored[relPath].hash == oldManifest[relPath].hash for relPath in oldManifest)
+    assert not (codeDir.parent / "OldCode-test").exists()
+    # The new code is still staged, so the next attempt only has to swap it in
+    log = []
+    buildStaging(log.append, DirectorySource(str(newCodeDir), hashContents=True), str(codeDir))
+    assert "\"{}\" was already built by an update which was interrupted".format(stagingDir) in log
+
+
+def testRollbackRestoresTheSnapshot(trees):
+    codeDir, newCodeDir = trees
+    oldFiles = readTree(codeDir)
+    snapshotPath = installNewCode(codeDir, newCodeDir)
+    newSnapshotPath = rollback(lambda text: None, str(codeDir), snapshotPath, "OldCode-rolledback")
+    assert readTree(codeDir) == oldFiles
+    assert readTree(pathlib.Path(newSnapshotPath)) == readTree(newCodeDir)
+    assert not os.path.exists(snapshotPath)
+    # The restored files were never recorded, so the next update hashes them
+    assert not os.path.exists(getInstalledManifestPath(str(codeDir)))
@@ -0,0 +1,78 @@
+import hashlib
+import os
+
+import pytest
+
+import fetch
+from conftest import RecordingHandler, makeArchive, setArchive
+from fetch import fetchToFile, getJournalPath, getPartPath
+
+# Segmented downloads (fetch.SegmentedDownload) against a local server which accepts Range requests
+archiveSize = 2 * 1024 * 1024
+segmentSize = 256 * 1024
+
+
+class IgnoringRangeHandler(RecordingHandler):
+    """Says it accepts ranges, but always sends the whole archive"""
+
+    def do_GET(self):
+        if "Range" in self.headers:
+            del self.headers["Range"]
+        super().do_GET()
+
+
+class NoRangesHandler(RecordingHandler):
+    """Doesn't say it accepts ranges"""
+
+    def send_header(self, keyword: str, value: str):
+        if keyword != "Accept-Ranges":
+            super().send_header(keyword, value)
+
+
+@pytest.fixture(autouse=True)
+def smallSegments(monkeypatch):
+    # So a small archive is still worth splitting
+    monkeypatch.setattr(fetch, "minimumSegmentSize", segmentSize)
+
+
+def download(url: str, tmp_path, log: list, archive: bytes) -> dict:
+    target = str(tmp_path / "archive.zip")
+    result = fetchToFile(url, target, log.append, segments=4)
+    with open(target, 'rb') as f:
+        assert f.read() == archive
+    assert result["sha256"] == hashlib.sha256(archive).hexdigest()
+    assert result["size"] == len(archive)
+    assert not os.path.exists(getPartPath(target))
+    assert not os.path.exists(getJournalPath(target))
+    return result
+
+
+def testSegmentsJoinToTheSameFile(startServer, tmp_path):
+    archive = makeArchive(archiveSize)
+    setArchive(archive)
+    log = []
+    download(startServer(), tmp_path, log, archive)
+    assert "Downloading {} bytes in 4 parts at once".format(archiveSize) in log
+    # The first range comes from the response already started, the rest are asked for
+    size = archiveSize // 4
+    assert RecordingHandler.ranges[0] is None
+    assert set(RecordingHandler.ranges[1:]) == {"bytes={}-{}".format(start, start + size - 1)
+                                                for start in range(size, archiveSize, size)}
+    assert len(RecordingHandler.ranges) == 4
+
+
+def testFallsBackWhenTheServerIgnoresRange(startServer, tmp_path):
+    archive = makeArchive(archiveSize)
+    setArchive(archive)
+    log = []
+    download(startServer(IgnoringRangeHandler), tmp_path, log, archive)
+    assert any(text.startswith("Server could not send part of the download") for text in log)
+
+
+def testOneStreamWhenTheServerDoesNotAcceptRanges(startServer, tmp_path):
+    archive = makeArchive(archiveSize)
+    setArchive(archive)
+    log = []
+    download(startServer(NoRangesHandler), tmp_path, log, archive)
+    assert not any("parts at once" in text for text in log)
+    assert RecordingHandler.ranges == [None]
@@ -0,0 +1,32 @@
+import os
+import zipfile
+
+from archivesource import getMemberPath
+from extraction import extractParallel
+from objectstore import stripTopLevel
+from sinks import getMemberParts
+
+# Members named to escape the directory they are extracted to, as zipfile.ZipFile.extract() guards against
+unsafeNames = ["C:/x", "../x", "C:\\Windows\\x", "Jinn-master/../../y", "./Jinn-master/D:z"]
+
+
+def testUnsafePartsAreDropped():
+    assert [getMemberParts(name) for name in unsafeNames] == [["x"], ["x"], ["Windows", "x"], ["Jinn-master", "y"],
+                                                               ["Jinn-master", "z"]]
+    assert getMemberPath("C:/x") == "x"
+    assert getMemberPath("../..") is None
+    assert stripTopLevel("C:/Jinn-master/x") == "x"
+    assert stripTopLevel("../x") is None
+
+
+def testNothingIsExtractedOutsideTheDestination(tmp_path):
+    zipFilePath = str(tmp_path / "archive.zip")
+    with zipfile.ZipFile(zipFilePath, 'w') as archive:
+        for name in unsafeNames:
+            archive.writestr(zipfile.ZipInfo(name), name)
+    destDir = tmp_path / "NewCode"
+    extractParallel(zipFilePath, str(destDir))
+    extracted = sorted(os.path.relpath(os.path.join(dirPath, name), str(tmp_path)).replace(os.sep, "/")
+                       for dirPath, _, names in os.walk(str(tmp_path)) for name in names)
+    assert extracted == ["NewCode/Jinn-master/y", "NewCode/Jinn-master/z", "NewCode/Windows/x", "NewCode/x",
+                         "archive.zip"]
@@ -0,0 +1,26 @@
+import statistics
+
+import pytest
+
+from startuptime import defaultBudget, getImportedModules, timeStart
+
+# Each tool started as a new Python process, as double-clicking its .bat file does (see startuptime.py)
+# Only what is needed before the user sees anything may be imported: the pipeline waits until there is something
+# to run, and the shortcut support (win32com) until a shortcut is made
+starts = 3
+neverAtStart = {
+    "cli": {"pipeline", "jobs", "PyQt5", "win32com"},
+    "downloader": {"pipeline", "jobs", "win32com"},
+    "updater": {"pipeline", "jobs", "objectstore", "archivesource", "delta", "win32com"},
+}
+
+
+@pytest.mark.parametrize("tool", sorted(neverAtStart))
+def testStartsWithinBudget(tool):
+    if tool != "cli":
+        pytest.importorskip("PyQt5.QtWidgets")
+    results = [timeStart(tool, noCache=False) for _ in range(starts)]
+    median = statistics.median(seconds for seconds, report in results)
+    assert median <= defaultBudget, "{} took {:.3f}s to start".format(tool, median)
+    imported = {module.split(".")[0] for module in getImportedModules(results[0][1])}
+    assert not imported & neverAtStart[tool]
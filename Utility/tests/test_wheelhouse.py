@@ -0,0 +1,126 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import zipfile
+
+import pytest
+
+from jobs import getDownloadPhases, getUpdatePhases
+from updatevariables import UpdateVariables
+from wheelhouse import Wheelhouse, buildWheelhouse, getLocalTarget, getWheelKey, installWheels
+
+# The wheelhouse (wheelhouse.py) built by the real pip against a local stand-in for the package index:
+# a PEP 503 "simple" index in a directory, as a file:// url, so nothing goes near PyPI
+
+
+def makeWheel(directory: pathlib.Path, name: str, version: str, requires: list = ()) -> str:
+    # A pure Python wheel with just enough metadata for pip, returns its file name
+    filename = "{}-{}-py3-none-any.whl".format(name, version)
+    distInfo = "{}-{}.dist-info".format(name, version)
+    files = {
+        "{}/__init__.py".format(name): "VERSION = \"{}\"\n".format(version),
+        "{}/METADATA".format(distInfo): "Metadata-Version: 2.1\nName: {}\nVersion: {}\n{}".format(
+            name, version, "".join("Requires-Dist: {}\n".format(requirement) for requirement in requires)),
+        "{}/WHEEL".format(distInfo): "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    record = "".join("{},,\n".format(path) for path in files) + "{}/RECORD,,\n".format(distInfo)
+    with zipfile.ZipFile(str(directory / filename), 'w') as wheel:
+        for path, text in files.items():
+            wheel.writestr(path, text)
+        wheel.writestr("{}/RECORD".format(distInfo), record)
+    return filename
+
+
+def makeIndex(root: pathlib.Path, wheels: dict) -> str:
+    # wheels: name -> [(version, requires)], returns the index url
+    (root / "files").mkdir(parents=True, exist_ok=True)
+    for name, versions in wheels.items():
+        links = []
+        for version, requires in versions:
+            filename = makeWheel(root / "files", name, version, requires)
+            sha256 = hashlib.sha256((root / "files" / filename).read_bytes()).hexdigest()
+            links.append("<a href=\"../../files/{0}#sha256={1}\">{0}</a>".format(filename, sha256))
+        (root / "simple" / name).mkdir(parents=True, exist_ok=True)
+        (root / "simple" / name / "index.html").write_text("<html><body>{}</body></html>".format("\n".join(links)))
+    return (root / "simple").as_uri() + "/"
+
+
+def writeRequirements(path: pathlib.Path, *requirements: str) -> str:
+    path.write_text("".join(requirement + "\n" for requirement in requirements))
+    return str(path)
+
+
+def listWheels(wheelhouse: Wheelhouse) -> list:
+    return sorted(name for name in os.listdir(wheelhouse.root) if name.endswith(".whl"))
+
+
+@pytest.fixture
+def index(tmp_path) -> str:
+    return makeIndex(tmp_path / "index", {"pkga": [("1.0", ["pkgb"])], "pkgb": [("1.0", []), ("2.0", [])],
+                                          "pkgc": [("0.1", [])]})
+
+
+def testResolvesOnceAndFetchesOnlyNewWheels(index, tmp_path):
+    wheelhouse = Wheelhouse(str(tmp_path / "Wheelhouse"))
+    targets = [getLocalTarget()]
+    requirements = writeRequirements(tmp_path / "requirements.txt", "pkga", "pkgb<2")
+    log = []
+    assert buildWheelhouse(log.append, wheelhouse, "HJinn", requirements, targets, index) > 0
+    assert listWheels(wheelhouse) == ["pkga-1.0-py3-none-any.whl", "pkgb-1.0-py3-none-any.whl"]
+    assert "2 package(s), 0 already on the USB stick" in log
+
+    # The same requirements again: not even resolved, so the index isn't needed at all
+    log = []
+    assert buildWheelhouse(log.append, wheelhouse, "HJinn", requirements, targets, "file:///nowhere/") == 0
+    assert any(text.endswith("are unchanged") for text in log)
+
+    # A new requirement and a new version: only those are downloaded, and the old version goes
+    requirements = writeRequirements(tmp_path / "requirements.txt", "pkga", "pkgb", "pkgc")
+    log = []
+    buildWheelhouse(log.append, wheelhouse, "HJinn", requirements, targets, index)
+    assert "3 package(s), 1 already on the USB stick" in log
+    assert wheelhouse.removeUnreferenced() == 1
+    assert listWheels(wheelhouse) == ["pkga-1.0-py3-none-any.whl", "pkgb-2.0-py3-none-any.whl",
+                                      "pkgc-0.1-py3-none-any.whl"]
+    reloaded = Wheelhouse(wheelhouse.root)
+    assert reloaded.loadResolution("HJinn", targets[0])["wheels"] == sorted(
+        getWheelKey(name) for name in listWheels(wheelhouse))
+    assert all(reloaded.hasWheel(key) for key in reloaded.cache)
+
+
+def testMissingPackageReportsPipsError(index, tmp_path):
+    wheelhouse = Wheelhouse(str(tmp_path / "Wheelhouse"))
+    requirements = writeRequirements(tmp_path / "requirements.txt", "pkga", "nosuchpackage")
+    with pytest.raises(Exception, match="nosuchpackage"):
+        buildWheelhouse(lambda text: None, wheelhouse, "HJinn", requirements, [getLocalTarget()], index)
+    assert listWheels(wheelhouse) == []
+
+
+def testInstallsFromTheStickAlone(index, tmp_path, monkeypatch):
+    wheelhouse = Wheelhouse(str(tmp_path / "Wheelhouse"))
+    requirements = writeRequirements(tmp_path / "requirements.txt", "pkga", "pkgb<2")
+    buildWheelhouse(lambda text: None, wheelhouse, "HJinn", requirements, [getLocalTarget()], index)
+    # On the offline PC there is no index at all, only the wheels on the stick
+    shutil.rmtree(str(tmp_path / "index"))
+    # Into a directory of its own rather than the Python running the tests
+    target = tmp_path / "site-packages"
+    monkeypatch.setenv("PIP_TARGET", str(target))
+    log = []
+    installWheels(log.append, wheelhouse, "HJinn", requirements)
+    assert "Installing Python packages: pkga 1.0, pkgb 1.0" in log
+    assert (target / "pkga" / "__init__.py").read_text() == "VERSION = \"1.0\"\n"
+    assert (target / "pkgb" / "__init__.py").read_text() == "VERSION = \"1.0\"\n"
+
+    # Requirements the wheels on the stick don't satisfy are pip's error, with nothing looked for elsewhere
+    requirements = writeRequirements(tmp_path / "requirements.txt", "pkga", "pkgb>=2")
+    with pytest.raises(Exception, match="pip could not install"):
+        installWheels(lambda text: None, wheelhouse, "HJinn", requirements)
+
+
+def testPackagesOnlyWhenAskedFor(tmp_path):
+    # They need pip and the package index, so a plain download of the code never depends on them
+    updateVariables = UpdateVariables("HJinn")
+    assert "Packages" not in [name for name, func in getDownloadPhases(updateVariables)]
+    assert "Packages" in [name for name, func in getDownloadPhases(updateVariables, packages=True)]
+    assert "Packages" not in [name for name, func in getUpdatePhases(updateVariables, str(tmp_path / "Code"))]
@@ -0,0 +1,147 @@
+import contextlib
+import datetime
+import json
+import os
+import platform
+import threading
+import time
+import typing
+
+# Lightweight timings for each download or update, to tell whether the network, decompression, the USB stick
+# or the GUI is what makes a slow run slow
+# A RunTrace collects "spans": a name, the wall time it took, and (where it makes sense) bytes and files handled
+#     with trace.span("transfer") as span:
+#         ...
+#         span.add(bytes=len(chunk))
+# The worker adds a span for each of its phases (see workers.py), and the pipeline functions add finer ones
+# inside them (request, transfer, extract, clear, copy, rename)
+# At the end of each run the dialog appends the trace as one line of JSON to "RunHistory.jsonl" on the stick,
+# so slow runs can be compared with earlier ones, and shows a summary in its log
+historyFile = "RunHistory.jsonl"
+
+
+class Span:
+    def __init__(self, name: str, isPhase: bool = False):
+        self.name = name
+        self.isPhase = isPhase
+        self.started = time.time()
+        self.seconds = 0.0
+        self.bytes = 0
+        self.files = 0
+        self.ok = True
+
+    def add(self, bytes: int = 0, files: int = 0):
+        self.bytes += bytes
+        self.files += files
+
+    def getMegabytesPerSecond(self) -> typing.Optional[float]:
+        if not self.bytes or self.seconds <= 0:
+            return None
+        return self.bytes / self.seconds / 1e6
+
+    def toJson(self) -> dict:
+        data = {"name": self.name, "seconds": round(self.seconds, 3)}
+        if self.isPhase:
+            data["phase"] = True
+        if self.bytes:
+            data["bytes"] = self.bytes
+            data["mbPerSecond"] = round(self.getMegabytesPerSecond(), 3)
+        if self.files:
+            data["files"] = self.files
+        if not self.ok:
+            data["ok"] = False
+        return data
+
+    def describe(self) -> str:
+        parts = ["{:.1f}s".format(self.seconds)]
+        if self.bytes:
+            parts.append("{:.1f} MB at {:.2f} MB/s".format(self.bytes / 1e6, self.getMegabytesPerSecond()))
+        if self.files:
+            parts.append("{} files".format(self.files))
+        return "{}: {}".format(self.name, ", ".join(parts))
+
+
+class RunTrace:
+    def __init__(self, kind: str = "", branch: str = None):
+        self.kind = kind
+        self.branch = branch
+        self.started = time.time()
+        self.finished = None
+        self.outcome = None
+        self.error = None
+        self.spans = []
+        self.spansLock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, isPhase: bool = False) -> typing.Iterator[Span]:
+        # Spans may be recorded from several threads at once (e.g. several branches downloading together)
+        span = Span(name, isPhase)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.ok = False
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            with self.spansLock:
+                self.spans.append(span)
+
+    def merge(self, other: 'RunTrace', prefix: str):
+        # Take another trace's spans, e.g. one per branch when several are downloaded at once
+        with other.spansLock:
+            spans = list(other.spans)
+        for span in spans:
+            span.name = "{} {}".format(prefix, span.name)
+        with self.spansLock:
+            self.spans.extend(spans)
+
+    def finish(self, outcome: str, error: str = None):
+        # outcome is "succeeded", "failed" or "cancelled"
+        self.finished = time.time()
+        self.outcome = outcome
+        self.error = error
+
+    def getSeconds(self) -> float:
+        return (self.finished or time.time()) - self.started
+
+    def toJson(self) -> dict:
+        return {
+            "kind": self.kind,
+            "branch": self.branch,
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "seconds": round(self.getSeconds(), 3),
+            "outcome": self.outcome,
+            "error": self.error,
+            "computer": platform.node(),
+            "spans": [span.toJson() for span in sorted(self.spans, key=lambda span: span.started)],
+        }
+
+    def summary(self) -> str:
+        # In the order they started, so each phase is followed by the details within it
+        spans = sorted(self.spans, key=lambda span: span.started)
+        lines = ["Took {:.1f}s in total".format(self.getSeconds())]
+        lines.extend(("    " if span.isPhase else "        ") + span.describe() for span in spans)
+        return "\n".join(lines)
+
+
+def appendHistory(path: str, trace: RunTrace):
+    # One line per run, only ever appended to, so an interrupted write can at worst spoil its own line
+    with open(path, 'a') as f:
+        f.write(json.dumps(trace.toJson()) + "\n")
+
+
+def loadHistory(path: str, kind: str = None) -> typing.List[dict]:
+    # Earlier runs (of the given kind, if any), oldest first; lines which can't be read are skipped
+    runs = []
+    if not os.path.exists(path):
+        return runs
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if kind is None or run.get("kind") == kind:
+                runs.append(run)
+    return runs
@@ -1,21 +1,28 @@
 import os
-import shutil
 import sys
-import pathlib
 
-from PyQt5.QtGui import QTextCursor, QIcon
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QFrame, QSizePolicy, QListWidget
+from PyQt5.QtGui import QIcon
+from PyQt5.QtCore import Qt, QThread
+from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QFrame, QSizePolicy, QListWidget, \
+    QCheckBox
 from dialogs import JDialog, InfoMsgBox
-from widgets import JPushButton, JCancelButton, JTextEdit, DirectorySelector
+from widgets import JPushButton, JCancelButton, JTextEdit, JLogView, DirectorySelector, LabelledComboBox, \
+    ProgressPanel
 from updatevariables import UpdateVariables
-from createshortcut import createShortcut
+from tracing import RunTrace
+from workers import PipelineWorker
+from bytecache import refreshInBackground
 
 class UpdaterDialog(JDialog):
     def __init__(self):
         super().__init__()
 
         self.setInitialSize(800, 800)
+        self.worker = None
+        self.trace = None
+        self.tidyWorker = None
+        # Set once Cancel has been pressed while a worker is running: the dialog closes when they have all stopped
+        self.closing = False
         self.initUi()
         self.setActions()
 
@@ -32,23 +39,49 @@ class UpdaterDialog(JDialog):
         self.advancedOptionsFrame = QFrame()
         self.advancedOptionsFrame.setHidden(True)
 
-        self.updateLog = JTextEdit("Use this on your work PC. Press 'Update' to copy the Jinn code on this USB stick to "
+        self.updateLog = JLogView("Use this on your work PC. Press 'Update' to copy the Jinn code on this USB stick to "
                                  "this PC. The old code will be saved incase it is needed.")
-        self.updateLog.setReadOnly(True)
 
         self.btnAdvancedOptions = JPushButton("Show advanced options")
         self.btnLocateJinn = JPushButton("Locate Jinn installation")
         self.btnUpdate = JPushButton("Update")
+        # A dry run: what the update would copy and delete, the space it needs and how long it should take
+        self.btnPlan = JPushButton("Plan update")
         self.btnCreateShortcut = JPushButton("Create desktop shortcut")
+        self.btnRollback = JPushButton("Rollback to previous version")
         self.btnCancel = JCancelButton("Cancel")
 
         self.codeDir = DirectorySelector(caption="Select Code directory")
         self.codeDir.leDirname.setText("C:/Jinn/Code")
 
+        # Where the new code comes from (see listSources())
+        self.comboSource = LabelledComboBox("Install from:")
+        self.comboSource.cb.addItem("Downloaded code (NewCode)", (None, None))
+        self.sourcesListed = False
+
+        # The new code is always built next to `Code` and swapped in at the end (see install.py)
+        # Incremental update only copies the files which have changed since the last update
+        self.chkIncremental = QCheckBox("Only copy changed files")
+        self.chkIncremental.setChecked(True)
+        self.chkCompareContents = QCheckBox("Compare file contents (slower)")
+        # Delete, hard link and compress old `OldCode-<date-time>` snapshots once the update is done (see snapshots.py)
+        self.chkTidySnapshots = QCheckBox("Tidy old versions afterwards")
+        self.chkTidySnapshots.setChecked(True)
+        # Install the Python packages the new code needs from the stick (see wheelhouse.py), if they were downloaded
+        self.chkPackages = QCheckBox("Install Python packages")
+        self.optionsLayout = QHBoxLayout()
+        self.optionsLayout.addWidget(self.chkIncremental)
+        self.optionsLayout.addWidget(self.chkCompareContents)
+        self.optionsLayout.addWidget(self.chkTidySnapshots)
+        self.optionsLayout.addWidget(self.chkPackages)
 
         self.advancedOptionsLayout.addWidget(self.codeDir)
+        self.advancedOptionsLayout.addWidget(self.comboSource)
+        self.advancedOptionsLayout.addLayout(self.optionsLayout)
+        self.advancedButtonLayout.addWidget(self.btnPlan)
         self.advancedButtonLayout.addWidget(self.btnCreateShortcut)
         self.advancedButtonLayout.addWidget(self.btnLocateJinn)
+        self.advancedButtonLayout.addWidget(self.btnRollback)
         self.advancedOptionsLayout.addLayout(self.advancedButtonLayout)
         self.advancedOptionsFrame.setLayout(self.advancedOptionsLayout)
 
@@ -62,25 +95,60 @@ class UpdaterDialog(JDialog):
 
         self.windowLayout.addLayout(self.middleLayout)
         self.windowLayout.addStretch()
+        # A progress bar for each phase (see progressmodel.py)
+        self.progressPanel = ProgressPanel()
+        self.windowLayout.addWidget(self.progressPanel)
         self.windowLayout.addWidget(self.updateLog)
         self.windowLayout.addLayout(self.buttonBtm)
 
     def setActions(self):
         self.btnLocateJinn.clicked.connect(self.locateCodeFolder)
         self.btnUpdate.clicked.connect(self.updateCode)
+        self.btnPlan.clicked.connect(self.planUpdate)
+        self.btnRollback.clicked.connect(self.rollbackCode)
         self.btnCreateShortcut.clicked.connect(self.createShortcut)
         self.btnCancel.clicked.connect(self.reject)
         self.btnAdvancedOptions.clicked.connect(self.showAdvancedOptions)
 
     def showAdvancedOptions(self):
         if self.advancedOptionsFrame.isHidden():
+            self.listSources()
             self.advancedOptionsFrame.show()
             self.btnAdvancedOptions.setText("Hide advanced options")
         else:
             self.advancedOptionsFrame.hide()
             self.btnAdvancedOptions.setText("Show advanced options")
 
+    def listSources(self):
+        # `NewCode` on the stick, a branch kept in the stick's shared store, a zip file kept on the stick
+        # (see archivesource.py), or a package of changes to `Code` (see delta.py), each item's data is (kind, branch)
+        # Only looked for once the choice is shown or an update started, so those modules aren't imported at start up
+        if self.sourcesListed:
+            return
+        self.sourcesListed = True
+        from archivesource import listArchives
+        from delta import DeltaStore
+        from objectstore import ObjectStore
+        updateVariables = UpdateVariables()
+        for branch in ObjectStore(updateVariables.getStorePath()).listBranches():
+            self.comboSource.cb.addItem("Branch \"{}\" from the shared store".format(branch), ("store", branch))
+        archives = listArchives(updateVariables.getPath(updateVariables.zipDir))
+        for branch in archives:
+            self.comboSource.cb.addItem("Branch \"{}\" from its zip file".format(branch), ("archive", branch))
+        for branch in DeltaStore(updateVariables.getDeltaPath()).listPackageBranches():
+            self.comboSource.cb.addItem("Branch \"{}\" as changes to this PC's code".format(branch), ("delta", branch))
+        # With nothing in `NewCode` (the stick was filled in archive-only mode), a zip file is the one to use
+        newCodeDir = updateVariables.getZipExtractedDir()
+        if archives and (not os.path.isdir(newCodeDir) or not os.listdir(newCodeDir)):
+            self.comboSource.cb.setCurrentIndex(self.comboSource.cb.findData(("archive", archives[0])))
+
+    def getSource(self) -> tuple:
+        self.listSources()
+        return self.comboSource.cb.currentData()
+
     def createShortcut(self):
+        # Only needed here, and pulls in the Windows COM modules, so not imported until asked for
+        from createshortcut import createShortcut
         path = self.codeDir.leDirname.text()
         try:
             print("Attempting shortcut to path variable 'python3'")
@@ -90,70 +158,252 @@ class UpdaterDialog(JDialog):
             createShortcut(path, 'python')
 
     def locateCodeFolder(self):
-        root = "C:\\"
-        pattern = '..\Jinn\Code\home.py'
-        # Want to find all Jinn\Code paths
-        # Performs a walk through operating system paths and looks for the match "Jinn\Code"
-        # Potential for failure if user has multiple Jinns for some reason
-        try:
-            possibleDirs = []
-            for path, dirs, files in os.walk(os.path.abspath(root)):
-                if pathlib.PurePath(path).match('*/Jinn/Code'):
-                    possibleDirs.append(path)
-
-            print(possibleDirs)
-        except Exception as ex:
-            raise ex
-
+        # Want to find all Jinn\Code paths, see locator.py
+        # The search can still take a while if Jinn is somewhere unusual, so it runs on the worker thread
+        # Rarely needed, so only imported when asked for (as is the shortcut support) to keep start up quick
+        from locator import locateJinnInstallations
+        self.locatedDirs = []
+        self.worker = PipelineWorker(self)
+        worker = self.worker
+        worker.addPhase("Locate", lambda: self.locatedDirs.extend(locateJinnInstallations(log=worker.log)))
+        worker.logMessage.connect(self.updateLog.appendLine)
+        worker.succeeded.connect(self.locateFinished)
+        worker.failed.connect(self.updateFailed)
+        worker.finished.connect(self.workerFinished)
+
+        self.setRunning(True)
+        worker.start()
+
+    def locateFinished(self):
+        if self.closing:
+            return
+        possibleDirs = self.locatedDirs
+        if not possibleDirs:
+            self.updateLog.appendLine("No Jinn installation could be found, please select the Code directory yourself")
+            return
         if len(possibleDirs) > 1:
             multipleJinnDialog = MultipleJinnDialog(possibleDirs)
             with multipleJinnDialog.delayedDeleteOnClose():
                 multipleJinnDialog.exec()
                 path = multipleJinnDialog.getPath()
+            if path is None:
+                return
         else:
             path = possibleDirs[0]
 
+        self.updateLog.appendLine("Using Jinn installation \"{}\"".format(path))
         self.codeDir.leDirname.setText(str(path))
 
     def updateCode(self):
+        # Each step is timed, and the timings kept in the run history on the stick (see tracing.py)
+        # The pipeline is only imported once there is something for it to do, to keep start up quick
+        from jobs import getUpdatePhases
+        kind, branch = self.getSource()
+        if not self.checkSource(kind, branch):
+            return
+        self.trace = RunTrace("update", branch)
         updateVariables = UpdateVariables()
-        # Rename old code directory and then move new code and rename it
+        updateVariables.trace = self.trace
+        # Build the new code next to the old code directory, then swap it in and keep the old one
         codeDirPath = self.codeDir.leDirname.text()
-        codeDirPath = os.path.abspath(codeDirPath)
-        oldCodeFolder = updateVariables.getOldCodeDirWithDateTime()
-
-        jinnDirPath = os.path.join(codeDirPath, "..")
-
-        codeDirAlreadyExists = os.path.exists(codeDirPath)
-        if codeDirAlreadyExists:
-            updateJTextEdit(self.updateLog,
-                            "Rename existing \"{}\" directory to \"{}\", and ".format(codeDirPath,
-                                                                                      oldCodeFolder))
-        updateJTextEdit(self.updateLog, "Rename \"{}\" to \"{}\"\n".format(codeDirPath, updateVariables.codeDir))
-        # rename existing `Code` directory to `OldCode`
-        if codeDirAlreadyExists:
-            oldCodeDirPath = os.path.join(jinnDirPath, oldCodeFolder)
-            updateJTextEdit(self.updateLog, "Renaming \"{}\" to \"{}\"\n".format(codeDirPath, oldCodeDirPath))
-            os.rename(codeDirPath, oldCodeDirPath)
-            # rename directory from extracted zip file to `Code`
-            updateJTextEdit(self.updateLog, "Renaming \"{}\" to \"{}\"\n".format(codeDirPath, codeDirPath))
-        # Old code folder is renamed. Now we need to move the newCode and rename it
-        # New code is in UpdateVariables.getPath(newCode), unfortunately there is an unknown folder name here from Git
-        # First work out the Git hub zip extracted name
-        gitFolder = getImmediateSubdirectories(updateVariables.getPath(updateVariables.codeDir))[0]
-        print(gitFolder)
-        newCode = os.path.join(updateVariables.getPath(updateVariables.codeDir), gitFolder)
+        # Tidying the old versions can wait until next time
+        self.stopTidySnapshots()
+        self.progressPanel.clear()
+
+        # The (slow) copy and the renames happen on a background thread so the window keeps repainting
+        self.worker = PipelineWorker(self)
+        worker = self.worker
+        worker.trace = self.trace
+        # The same steps as `cli.py update` (see jobs.py)
+        worker.addPhases(getUpdatePhases(updateVariables, codeDirPath, self.chkIncremental.isChecked(),
+                                         self.chkCompareContents.isChecked(), branch if kind == "store" else None,
+                                         branch if kind == "archive" else None, branch if kind == "delta" else None,
+                                         self.chkPackages.isChecked()))
+        worker.logMessage.connect(self.updateLog.appendLine)
+        worker.progressChanged.connect(self.progressPanel.updateProgress)
+        worker.succeeded.connect(self.updateFinished)
+        worker.failed.connect(self.updateFailed)
+        worker.finished.connect(self.workerFinished)
+
+        self.setRunning(True)
+        worker.start()
+
+    def planUpdate(self):
+        # Reads file sizes and times only (and briefly times the disk), but `Code` may be on a slow network drive
+        from jobs import getPlanPhases
+        kind, branch = self.getSource()
+        if not self.checkSource(kind, branch):
+            return
+        self.trace = RunTrace("plan", branch)
+        updateVariables = UpdateVariables()
+        updateVariables.trace = self.trace
+        self.worker = PipelineWorker(self)
+        worker = self.worker
+        worker.trace = self.trace
+        # The same steps as `cli.py update --dry-run` (see jobs.py)
+        worker.addPhases(getPlanPhases(updateVariables, self.codeDir.leDirname.text(), self.chkIncremental.isChecked(),
+                                       self.chkCompareContents.isChecked(), branch if kind == "store" else None,
+                                       branch if kind == "archive" else None, branch if kind == "delta" else None))
+        worker.logMessage.connect(self.updateLog.appendLine)
+        worker.succeeded.connect(self.planFinished)
+        worker.failed.connect(self.updateFailed)
+        worker.finished.connect(self.workerFinished)
+
+        self.setRunning(True)
+        worker.start()
+
+    def checkSource(self, kind: str, branch: str) -> bool:
+        # Only a run which gets going is recorded in the run history, not one which could never have started
+        from pipeline import checkNewCodeSource
         try:
-            os.chdir(newCode)
-            shutil.copytree(newCode, codeDirPath)
-            dialog = InfoMsgBox("Update Finished", "Update finished with no faults. Code has been updated to the USB "
-                                                   "copy", "Finished")
-            dialog.exec()
-        except Exception as e:
-            raise e
+            checkNewCodeSource(UpdateVariables(), branch if kind == "store" else None,
+                               branch if kind == "archive" else None, branch if kind == "delta" else None)
+        except Exception as ex:
+            self.updateLog.appendLine("Update failed: {}".format(ex))
+            self.updateLog.flush()
+            InfoMsgBox("Update failed", str(ex), "Update failed").exec()
+            return False
+        return True
+
+    def planFinished(self):
+        # The plan itself is in the log
+        from pipeline import recordRun
+        recordRun(self.updateLog.appendLine, UpdateVariables(), self.trace, "succeeded")
+        self.trace = None
+
+    def setRunning(self, running: bool):
+        self.btnUpdate.setEnabled(not running)
+        self.btnPlan.setEnabled(not running)
+        self.btnLocateJinn.setEnabled(not running)
+        # Not while old versions are being tidied either, as the one wanted might be being compressed
+        self.btnRollback.setEnabled(not running and self.tidyWorker is None)
+        self.codeDir.setEnabled(not running)
+        self.comboSource.setEnabled(not running)
+        self.chkIncremental.setEnabled(not running)
+        self.chkCompareContents.setEnabled(not running)
+        self.chkTidySnapshots.setEnabled(not running)
+        self.chkPackages.setEnabled(not running)
+
+    def workerFinished(self):
+        # Make sure the log is up to date before any "finished"/"failed" message box
+        self.updateLog.flush()
+        self.setRunning(False)
+        self.worker.deleteLater()
+        self.worker = None
+        if self.closing:
+            self.reject()
+
+    def updateFinished(self):
+        from pipeline import recordRun
+        self.progressPanel.setFinished()
+        recordRun(self.updateLog.appendLine, UpdateVariables(), self.trace, "succeeded")
+        self.trace = None
+        self.updateLog.flush()
+        if self.closing:
+            return
+        if self.chkTidySnapshots.isChecked():
+            self.startTidySnapshots()
+        dialog = InfoMsgBox("Update Finished", "Update finished with no faults. Code has been updated to the USB "
+                                               "copy", "Finished")
+        dialog.exec()
+
+    def updateFailed(self, message: str):
+        from pipeline import recordRun
+        self.updateLog.appendLine("Update failed: {}".format(message))
+        if self.trace is not None:
+            recordRun(self.updateLog.appendLine, UpdateVariables(), self.trace,
+                      "cancelled" if message.startswith("Cancelled") else "failed", message)
+            self.trace = None
+        self.updateLog.flush()
+        if not self.closing:
+            InfoMsgBox("Update failed", message, "Update failed").exec()
+
+    def startTidySnapshots(self):
+        # Slow but unimportant, so it runs at the lowest priority to leave the PC usable, and may be cancelled
+        from jobs import getTidyPhases
+        codeDirPath = self.codeDir.leDirname.text()
+        self.tidyWorker = PipelineWorker(self)
+        worker = self.tidyWorker
+        worker.addPhases(getTidyPhases(UpdateVariables(), codeDirPath))
+        worker.logMessage.connect(self.updateLog.appendLine)
+        worker.progressChanged.connect(self.progressPanel.updateProgress)
+        worker.failed.connect(lambda message: self.updateLog.appendLine("Tidying old versions stopped: {}".format(message)))
+        worker.finished.connect(self.tidyFinished)
+        self.btnRollback.setEnabled(False)
+        worker.start(QThread.LowestPriority)
+
+    def stopTidySnapshots(self):
+        if self.tidyWorker is not None:
+            self.tidyWorker.stop()
+
+    def tidyFinished(self):
+        self.tidyWorker.deleteLater()
+        self.tidyWorker = None
+        if self.closing:
+            self.reject()
+        elif self.worker is None:
+            self.btnRollback.setEnabled(True)
+
+    def reject(self):
+        # Don't let the dialog (and with it the QThreads) be destroyed while a worker is still running: a phase in
+        # the middle of a large copy may take a while to reach its next cancellation point, so ask them to stop and
+        # close once they have (see workerFinished and tidyFinished)
+        workers = [worker for worker in (self.worker, self.tidyWorker) if worker is not None]
+        if workers:
+            if not self.closing:
+                self.closing = True
+                self.btnCancel.setEnabled(False)
+                self.updateLog.appendLine("Stopping...")
+                for worker in workers:
+                    worker.requestInterruption()
+            return
+        super().reject()
+
+    def rollbackCode(self):
+        # Usually renames only, but a compressed old version has to be extracted first, so use the worker thread
+        from jobs import getRollbackPhases
+        from snapshots import listAllSnapshots
+        codeDirPath = self.codeDir.leDirname.text()
+        snapshots = listAllSnapshots(codeDirPath)
+        if not snapshots:
+            self.updateLog.appendLine("There is no previous version next to \"{}\" to roll back to".format(codeDirPath))
+            return
+        snapshotDialog = MultipleJinnDialog(snapshots, text="Please select the previous version to go back to. "
+                                                            "The current code will be kept as well.")
+        with snapshotDialog.delayedDeleteOnClose():
+            snapshotDialog.exec()
+            snapshotPath = snapshotDialog.getPath()
+        if snapshotPath is None:
+            return
+        self.trace = RunTrace("rollback")
+        self.progressPanel.clear()
+        updateVariables = UpdateVariables()
+        updateVariables.trace = self.trace
+        self.worker = PipelineWorker(self)
+        worker = self.worker
+        worker.trace = self.trace
+        worker.addPhases(getRollbackPhases(updateVariables, codeDirPath, snapshotPath))
+        worker.logMessage.connect(self.updateLog.appendLine)
+        worker.progressChanged.connect(self.progressPanel.updateProgress)
+        worker.succeeded.connect(lambda: self.rollbackFinished(snapshotPath))
+        worker.failed.connect(self.updateFailed)
+        worker.finished.connect(self.workerFinished)
+
+        self.setRunning(True)
+        worker.start()
+
+    def rollbackFinished(self, snapshotPath: str):
+        from pipeline import recordRun
+        self.progressPanel.setFinished()
+        recordRun(self.updateLog.appendLine, UpdateVariables(), self.trace, "succeeded")
+        self.trace = None
+        self.updateLog.flush()
+        if self.closing:
+            return
+        InfoMsgBox("Rollback Finished", "\"{}\" is now the Jinn code again".format(snapshotPath), "Finished").exec()
 
 class MultipleJinnDialog(JDialog):
-    def __init__(self, paths=list, parent=None):
+    def __init__(self, paths=list, parent=None, text: str = None):
         super().__init__(parent)
         self.path =  None
 
@@ -163,13 +413,16 @@ class MultipleJinnDialog(JDialog):
         self.layout.setContentsMargins(20, 20, 20, 20)
         self.layout.setSpacing(15)
 
-        self.informativeText = JTextEdit("More than one Jinn installation has been found on this PC. Please select the one you wish to use", self)
+        if text is None:
+            text = "More than one Jinn installation has been found on this PC. Please select the one you wish to use"
+        self.informativeText = JTextEdit(text, self)
         self.informativeText.setProperty("class", "backgroundColorTransparent")
         self.informativeText.setReadOnly(True)
         self.informativeText.setSizePolicy(QSizePolicy.Preferred,
                                            QSizePolicy.MinimumExpanding)
         self.pathList = QListWidget()
         self.pathList.addItems(paths)
+        self.pathList.setCurrentRow(0)
 
         self.btnOK = JPushButton("Ok", self)
         self.btnCancel = JCancelButton("Cancel", self)
@@ -195,18 +448,11 @@ class MultipleJinnDialog(JDialog):
     def getPath(self):
         return self.path
 
-def updateJTextEdit(jTextEdit: JTextEdit, newText):
-    Text = jTextEdit.toPlainText() + "\n" + newText
-    jTextEdit.moveCursor(QTextCursor.End)
-    jTextEdit.setText(Text)
-    jTextEdit.moveCursor(QTextCursor.End)
-
-def getImmediateSubdirectories(dir):
-    return [name for name in os.listdir(dir) if os.path.isdir(os.path.join(dir, name))]
-
 if __name__ == '__main__':
     # -*- coding: utf-8 -*-
 
     app = QApplication(sys.argv)
     updateDialog = UpdaterDialog()
+    # So that next time starts quickly (see bytecache.py)
+    refreshInBackground()
     sys.exit(updateDialog.exec_())
\ No newline at end of file
@@ -3,16 +3,45 @@ import datetime
 import os
 import shutil
 
+from tracing import RunTrace, historyFile
+
 class UpdateVariables:
     def __init__(self, branch: str=None):
     # Used to store variables required by the update process
         self.rootDir = self.setRootDir()
         self.codeDir = "NewCode/"
         self.oldCodeDir = "OldCode"
+        # How many `OldCode-<date-time>` snapshots to keep: the newest few, plus any younger than this (see snapshots.py)
+        self.snapshotKeepCount = 3
+        self.snapshotKeepDays = 30
         self.zipDir = "CodeArchive"
+        # Content-addressed store holding several branches at once (see objectstore.py)
+        self.storeDir = "ObjectStore"
+        # Only the changes since the version each offline PC has (see delta.py)
+        self.deltaDir = "CodeDelta"
+        # What each offline PC updated from this stick has installed (see fleet.py)
+        self.fleetDir = "Fleet"
+        # The Python packages the code needs, as wheels (see wheelhouse.py)
+        self.wheelhouseDir = "Wheelhouse"
+        # Where pip finds them on the internet PC, None for its own default (PyPI, or as pip is configured)
+        self.packageIndexUrl = None
+        # On the PC itself, not the stick
+        self.localDir = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"), "Jinn-USB")
+        # On the internet PC: the versions delivered, to make the changes against
+        self.deliveryCacheDir = os.path.join(self.localDir, "DeliveryCache")
+        # On each offline PC: the id it is known by in `Fleet`
+        self.machineIdFile = os.path.join(self.localDir, "machine.json")
         self.zipFileUrl = "https://github.com/hezmondo/Jinn/archive"
+        # Most connections a download is split over, where the server allows it (see fetch.py)
+        self.downloadSegments = 4
         self.githubBranchName = branch
         self.advancedLogging = False
+        # Set by the download step: the ETag/Last-Modified of the archive just downloaded,
+        # or archiveUnchanged if the server said the branch has not changed since the code in "NewCode" was extracted
+        self.archiveValidators = None
+        self.archiveUnchanged = False
+        # Timings of this run (see tracing.py), the dialogs replace it with one they record in the run history
+        self.trace = RunTrace()
 
     def getPath(self, directory):
         return os.path.join(rootDir, directory)
@@ -37,6 +66,45 @@ class UpdateVariables:
     def getZipFileUrl(self):
         return "{}/{}".format(self.zipFileUrl, self.getZipFile())
 
+    def getStorePath(self):
+        return self.getPath(self.storeDir)
+
+    def getDeltaPath(self):
+        return self.getPath(self.deltaDir)
+
+    def getDeliveryCachePath(self):
+        return self.deliveryCacheDir
+
+    def getFleetPath(self):
+        return self.getPath(self.fleetDir)
+
+    def getWheelhousePath(self):
+        return self.getPath(self.wheelhouseDir)
+
+    def getMachineIdPath(self):
+        return self.machineIdFile
+
+    def getValidatorsFile(self):
+        # Stored in the zip directory, records the ETag/Last-Modified of the archive currently extracted to "NewCode"
+        return "{}.validators.json".format(self.githubBranchName)
+
+    def getValidatorsPath(self):
+        return os.path.join(self.getPath(self.zipDir), self.getValidatorsFile())
+
+
+    def getArchivePath(self, branch: str = None):
+        # The downloaded zip file, which is all the USB stick carries in archive-only mode (see archivesource.py)
+        return os.path.join(self.getPath(self.zipDir), "{}.zip".format(branch or self.githubBranchName))
+
+    def getArchiveIndexPath(self, branch: str = None):
+        return os.path.join(self.getPath(self.zipDir), "{}.index.json".format(branch or self.githubBranchName))
+
+    def getHistoryPath(self):
+        return self.getPath(historyFile)
+
+    def getManifestPath(self):
+        # Next to "NewCode", records the hashes of the archive and every file extracted from it (see integrity.py)
+        return self.getPath("{}.manifest.json".format(self.codeDir.rstrip("/")))
 
     def getZipExtractedDir(self):
         # Rather than use the branch name we are using "Code" to prevent issues for Ben
@@ -47,6 +115,10 @@ class UpdateVariables:
     def clearExtractedFolder(self):
         # To prevent any mishaps we clear the "NewCode" folder before each extraction
         directory = self.getZipExtractedDir()
+        # Whatever branch's validators (and manifest) we had no longer describe what is in "NewCode"
+        self.clearValidators()
+        if os.path.exists(self.getManifestPath()):
+            os.unlink(self.getManifestPath())
         for file in os.listdir(directory):
             filePath = os.path.join(directory, file)
             try:
@@ -57,6 +129,14 @@ class UpdateVariables:
             except Exception as ex:
                 raise ex
 
+    def clearValidators(self):
+        zipDir = self.getPath(self.zipDir)
+        if not os.path.isdir(zipDir):
+            return
+        for file in os.listdir(zipDir):
+            if file.endswith(".validators.json"):
+                os.unlink(os.path.join(zipDir, file))
+
     def getOldCodeDirWithDateTime(self):
         # make legal filename cross-platform; don't bother with seconds
         return "{}-{}".format(self.oldCodeDir, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M"))
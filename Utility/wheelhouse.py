@@ -0,0 +1,271 @@
+import datetime
+import importlib.metadata
+import json
+import os
+import re
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import typing
+import urllib.parse
+
+from sync import hashFile
+
+# The Python packages Jinn needs (its `requirements.txt`), carried on the USB stick as wheels, so a new requirement
+# doesn't break the offline PC:
+#     Wheelhouse/<wheel files>     - as their names say, name-version-tags.whl
+#     Wheelhouse/wheels.json       - the cache: for each wheel, by name, version and tag, its file and SHA-256
+#     Wheelhouse/resolved.json     - for each branch and target (a Python version and platform), the wheels its
+#                                    requirements resolved to, and the SHA-256 of the requirements they came from
+# On the internet PC pip works out which wheels the requirements need for each target, without installing anything
+# (`pip install --dry-run --report`), and only wheels the cache doesn't have are added to it. Requirements which are
+# the same as last time aren't resolved again at all
+# The targets are the Python versions and platforms the offline PCs have (see fleet.py), or this PC's own
+# On the offline PC pip installs from the wheelhouse alone (`--no-index`), and only when some package the
+# requirements resolved to is not installed at that version
+LogFunc = typing.Callable[[str], None]
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+requirementsFile = "requirements.txt"
+cacheFile = "wheels.json"
+resolvedFile = "resolved.json"
+
+
+class WheelTarget:
+    """A Python version and platform to resolve the requirements for, e.g. 3.11 and win_amd64"""
+
+    def __init__(self, python: str, platform: str):
+        self.python = python
+        self.platform = platform
+
+    def getName(self) -> str:
+        return "{}-{}".format(self.python, self.platform)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, WheelTarget) and self.getName() == other.getName()
+
+    def __hash__(self) -> int:
+        return hash(self.getName())
+
+
+def getLocalTarget() -> WheelTarget:
+    # This PC's: "3.11" and, as it appears in wheel tags, "win_amd64"
+    return WheelTarget("{}.{}".format(*sys.version_info[:2]), re.sub(r"[-.]", "_", sysconfig.get_platform()))
+
+
+def normaliseName(name: str) -> str:
+    # As package indexes compare names (PEP 503)
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parseWheelName(filename: str) -> typing.Tuple[str, str, str]:
+    # name-version(-build)-python-abi-platform.whl, returns (name, version, tag)
+    parts = filename[:-len(".whl")].split("-")
+    if not filename.endswith(".whl") or len(parts) not in (5, 6):
+        raise ValueError("\"{}\" is not a wheel".format(filename))
+    return normaliseName(parts[0]), parts[1], "-".join(parts[-3:])
+
+
+def getWheelKey(filename: str) -> str:
+    return "{} {} {}".format(*parseWheelName(filename))
+
+
+def loadJson(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveJson(path: str, data: dict):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+class Wheelhouse:
+    def __init__(self, root: str):
+        self.root = root
+        self.cachePath = os.path.join(root, cacheFile)
+        self.resolvedPath = os.path.join(root, resolvedFile)
+        self.cache = loadJson(self.cachePath)
+        self.resolved = loadJson(self.resolvedPath)
+
+    def hasWheel(self, key: str, sha256: str = None) -> bool:
+        # In the cache, still on the stick, and (if given) the same file
+        entry = self.cache.get(key)
+        if entry is None or (sha256 is not None and entry["sha256"] != sha256):
+            return False
+        try:
+            return os.path.getsize(os.path.join(self.root, entry["file"])) == entry["size"]
+        except OSError:
+            return False
+
+    def addWheel(self, tmpPath: str, filename: str, sha256: str):
+        os.replace(tmpPath, os.path.join(self.root, filename))
+        self.cache[getWheelKey(filename)] = {"file": filename, "sha256": sha256,
+                                             "size": os.path.getsize(os.path.join(self.root, filename))}
+        saveJson(self.cachePath, self.cache)
+
+    def getResolutionName(self, branch: str, target: WheelTarget) -> str:
+        return "{} {}".format(branch, target.getName())
+
+    def loadResolution(self, branch: str, target: WheelTarget) -> typing.Optional[dict]:
+        return self.resolved.get(self.getResolutionName(branch, target))
+
+    def saveResolution(self, branch: str, target: WheelTarget, requirementsHash: str, keys: typing.List[str]):
+        self.resolved[self.getResolutionName(branch, target)] = {
+            "requirements": requirementsHash, "wheels": sorted(keys),
+            "resolved": datetime.datetime.now().isoformat(timespec="seconds")}
+        saveJson(self.resolvedPath, self.resolved)
+
+    def isResolved(self, branch: str, target: WheelTarget, requirementsHash: str) -> bool:
+        # Resolved from these same requirements before, with every wheel still here
+        resolution = self.loadResolution(branch, target)
+        return (resolution is not None and resolution["requirements"] == requirementsHash and
+                all(self.hasWheel(key) for key in resolution["wheels"]))
+
+    def removeUnreferenced(self) -> int:
+        # Wheels no resolution uses any more, returns how many were removed
+        referenced = {key for resolution in self.resolved.values() for key in resolution["wheels"]}
+        removed = 0
+        for key in [key for key in self.cache if key not in referenced]:
+            path = os.path.join(self.root, self.cache.pop(key)["file"])
+            if os.path.exists(path):
+                os.unlink(path)
+                removed += 1
+        saveJson(self.cachePath, self.cache)
+        return removed
+
+
+class ResolvedWheel:
+    def __init__(self, url: str, sha256: typing.Optional[str]):
+        self.url = url
+        self.sha256 = sha256
+        self.filename = urllib.parse.unquote(urllib.parse.urlsplit(url).path.rsplit("/", 1)[-1])
+        self.key = getWheelKey(self.filename)
+
+
+def runPip(args: typing.List[str]) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "-m", "pip", "--disable-pip-version-check"] + args,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def getPipError(result: subprocess.CompletedProcess) -> str:
+    lines = [line for line in (result.stderr or result.stdout).splitlines() if line.strip()]
+    return "\n".join(lines[-5:])
+
+
+def resolveRequirements(requirementsPath: str, target: WheelTarget, findLinks: str = None,
+                        indexUrl: str = None) -> typing.List[ResolvedWheel]:
+    # The wheels the requirements need on target, from the index (PyPI unless indexUrl), installing nothing
+    # Wheels only (--only-binary), as the offline PC may not be able to build anything
+    with tempfile.TemporaryDirectory() as tmpDir:
+        reportPath = os.path.join(tmpDir, "report.json")
+        # pip only takes another platform with --target, though with --dry-run nothing is written there
+        args = ["install", "--dry-run", "--ignore-installed", "--quiet", "--report", reportPath,
+                "--target", os.path.join(tmpDir, "target"), "--only-binary=:all:", "--python-version", target.python,
+                "--platform", target.platform, "-r", requirementsPath]
+        if findLinks is not None:
+            args += ["--find-links", findLinks]
+        if indexUrl is not None:
+            args += ["--index-url", indexUrl]
+        result = runPip(args)
+        if result.returncode != 0:
+            raise Exception("pip could not resolve \"{}\" for Python {} on {}:\n{}"
+                            .format(requirementsPath, target.python, target.platform, getPipError(result)))
+        with open(reportPath, 'r') as f:
+            report = json.load(f)
+    wheels = []
+    for item in report["install"]:
+        info = item["download_info"]
+        wheels.append(ResolvedWheel(info["url"], info.get("archive_info", {}).get("hashes", {}).get("sha256")))
+    return wheels
+
+
+def fetchWheels(log: LogFunc, wheelhouse: Wheelhouse, wheels: typing.List[ResolvedWheel], target: WheelTarget,
+                progress: ProgressFunc = None) -> int:
+    # Download the wheels the cache doesn't have into it, returns the bytes downloaded
+    # pip downloads them, as it has just fetched them to resolve the requirements and so has them in its own cache,
+    # and with whatever proxy and certificates it is set up for; each is then checked against what the index listed
+    if not wheels:
+        return 0
+    log("Downloading {}".format(", ".join(wheel.filename for wheel in wheels)))
+    # In the wheelhouse, so adding each one is a rename on the same volume
+    with tempfile.TemporaryDirectory(dir=wheelhouse.root) as tmpDir:
+        result = runPip(["download", "--no-deps", "--quiet", "--dest", tmpDir, "--only-binary=:all:",
+                         "--python-version", target.python, "--platform", target.platform] +
+                        [wheel.url for wheel in wheels])
+        if result.returncode != 0:
+            raise Exception("pip could not download the Python packages:\n{}".format(getPipError(result)))
+        total = sum(os.path.getsize(os.path.join(tmpDir, wheel.filename)) for wheel in wheels)
+        done = 0
+        for wheel in wheels:
+            tmpPath = os.path.join(tmpDir, wheel.filename)
+            sha256 = hashFile(tmpPath)
+            if wheel.sha256 is not None and sha256 != wheel.sha256:
+                raise Exception("\"{}\" is not the file the package index lists (SHA-256 {}, expected {})"
+                                .format(wheel.url, sha256, wheel.sha256))
+            done += os.path.getsize(tmpPath)
+            wheelhouse.addWheel(tmpPath, wheel.filename, sha256)
+            if progress is not None:
+                progress(done, total)
+    return total
+
+
+def buildWheelhouse(log: LogFunc, wheelhouse: Wheelhouse, branch: str, requirementsPath: str,
+                    targets: typing.List[WheelTarget], indexUrl: str = None,
+                    progress: ProgressFunc = None) -> int:
+    # Bring the wheels for branch's requirements on each target up to date, returns the bytes downloaded
+    os.makedirs(wheelhouse.root, exist_ok=True)
+    requirementsHash = hashFile(requirementsPath)
+    downloaded = 0
+    for target in targets:
+        if wheelhouse.isResolved(branch, target, requirementsHash):
+            log("Python packages for branch \"{}\" on Python {} ({}) are unchanged".format(
+                branch, target.python, target.platform))
+            continue
+        log("Resolving the Python packages branch \"{}\" needs on Python {} ({})".format(
+            branch, target.python, target.platform))
+        wheels = resolveRequirements(requirementsPath, target, wheelhouse.root, indexUrl)
+        needed = [wheel for wheel in wheels if not wheelhouse.hasWheel(wheel.key, wheel.sha256)]
+        log("{} package(s), {} already on the USB stick".format(len(wheels), len(wheels) - len(needed)))
+        downloaded += fetchWheels(log, wheelhouse, needed, target, progress)
+        wheelhouse.saveResolution(branch, target, requirementsHash, [wheel.key for wheel in wheels])
+    return downloaded
+
+
+def isInstalled(key: str) -> bool:
+    # Whether the package is installed (in the Python running this) at the wheel's version
+    name, version, _ = key.split(" ")
+    try:
+        return importlib.metadata.version(name) == version
+    except importlib.metadata.PackageNotFoundError:
+        return False
+
+
+def installWheels(log: LogFunc, wheelhouse: Wheelhouse, branch: str, requirementsPath: str):
+    # Install what the requirements need from the wheelhouse alone, pip leaving alone whatever already satisfies them
+    target = getLocalTarget()
+    resolution = wheelhouse.loadResolution(branch, target)
+    if resolution is None:
+        log("There are no Python packages for branch \"{}\" on Python {} ({}) on the USB stick, so none are "
+            "installed".format(branch, target.python, target.platform))
+        return
+    if resolution["requirements"] != hashFile(requirementsPath):
+        log("The Python packages on the USB stick were resolved from different requirements, installing what "
+            "they can")
+    missing = [key for key in resolution["wheels"] if not isInstalled(key)]
+    if not missing:
+        log("The {} Python package(s) needed are already installed".format(len(resolution["wheels"])))
+        return
+    log("Installing Python packages: {}".format(", ".join("{} {}".format(*key.split(" ")[:2]) for key in missing)))
+    result = runPip(["install", "--no-index", "--find-links", wheelhouse.root, "-r", requirementsPath])
+    for line in result.stdout.splitlines():
+        if line.strip():
+            log(line)
+    if result.returncode != 0:
+        raise Exception("The new code is in place, but pip could not install its Python packages:\n{}"
+                        .format(getPipError(result)))
@@ -1,8 +1,11 @@
+import collections
 import typing
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtWidgets import QSizePolicy, QWidget, QHBoxLayout, QFileDialog
 
+from progressmodel import ProgressMeter, formatBytes
+
 def widgetPropertyChanged(widget: QWidget):
     # Whenever a widget property is changed
     # (widget.setProperty() or something like QLineEdit.setReadOnly()) called to alter a property after initialisation)
@@ -185,6 +188,78 @@ class JTextEdit(QtWidgets.QTextEdit):
         textHeight = textSize.height() + 40  # Need to tweak
         self.setFixedHeight(textHeight)
 
+class JLogView(JTextEdit):
+    """A read-only log which only ever appends, in batches, and keeps at most maxLines lines"""
+    # Rebuilding the whole text for every line (toPlainText() + line, setText()) gets slower the longer the log,
+    # which with one line per extracted file ends up costing more than the extraction itself
+    # Instead lines are queued and appended together on a short timer, and the document drops its oldest
+    # lines once it holds maxLines
+    # Runs of lines starting with one of collapsePrefixes (e.g. "Extracting: ") are shown as a single summary line
+
+    def __init__(self, text: str = None, parent=None, maxLines: int = 5000, flushInterval: int = 100,
+                 collapsePrefixes: typing.Sequence[str] = ()):
+        super().__init__(text, parent)
+        self.setReadOnly(True)
+        self.maxLines = maxLines
+        self.collapsePrefixes = tuple(collapsePrefixes)
+        # Ring buffer of lines waiting to be shown: if more than maxLines arrive between flushes
+        # the oldest would have scrolled out of the document anyway
+        self.pendingLines = collections.deque(maxlen=maxLines)
+        self.document().setMaximumBlockCount(maxLines)
+
+        self.flushTimer = QtCore.QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.setInterval(flushInterval)
+        self.flushTimer.timeout.connect(self.flush)
+
+    def appendLine(self, text: str):
+        self.pendingLines.append(text)
+        if not self.flushTimer.isActive():
+            self.flushTimer.start()
+
+    def collapseLines(self, lines: typing.Iterable[str]) -> typing.List[str]:
+        # Replace each run of lines sharing a collapse prefix with one line giving the count and the last of them
+        collapsed = []
+        runPrefix, runCount, runLast = None, 0, None
+        for line in lines:
+            prefix = next((p for p in self.collapsePrefixes if line.startswith(p)), None)
+            if prefix is not None and prefix == runPrefix:
+                runCount += 1
+                runLast = line
+                continue
+            if runPrefix is not None:
+                collapsed.append(self.summariseRun(runPrefix, runCount, runLast))
+            if prefix is not None:
+                runPrefix, runCount, runLast = prefix, 1, line
+            else:
+                runPrefix = None
+                collapsed.append(line)
+        if runPrefix is not None:
+            collapsed.append(self.summariseRun(runPrefix, runCount, runLast))
+        return collapsed
+
+    def summariseRun(self, prefix: str, count: int, last: str) -> str:
+        if count == 1:
+            return last
+        return "{}{} files (... {})".format(prefix, count, last[len(prefix):])
+
+    def flush(self):
+        # Append everything queued since the last flush in a single edit
+        self.flushTimer.stop()
+        if not self.pendingLines:
+            return
+        lines = self.collapseLines(self.pendingLines) if self.collapsePrefixes else list(self.pendingLines)
+        self.pendingLines.clear()
+
+        # Only follow the end of the log if the user hasn't scrolled up to read something
+        scrollBar = self.verticalScrollBar()
+        atBottom = scrollBar.value() >= scrollBar.maximum()
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText("\n" + "\n".join(lines))
+        if atBottom:
+            scrollBar.setValue(scrollBar.maximum())
+
 class JProgressBar(QtWidgets.QProgressBar):
     def event(self, e: QtCore.QEvent):
         widgetEvent(self, e)
@@ -194,6 +269,51 @@ class LabelledProgressBar(LabelledWidget):
     def __init__(self, labelText: str=None, parent=None):
         self.pb = JProgressBar()
         super().__init__(labelText, self.pb, parent)
+        # Throughput and time left, shown on the bar (see progressmodel.py)
+        self.meter = ProgressMeter()
+        self.pb.setTextVisible(True)
+
+    def setProgress(self, done: int, total: int):
+        # Progress is in bytes, which can be more than a QProgressBar's int allows, so the bar counts KB
+        # A total of 0 means the size is unknown, which makes the bar show "busy"
+        self.meter.update(done, total)
+        self.pb.setMaximum((total + 1023) // 1024)
+        self.pb.setValue(min(done, total) // 1024 if total else 0)
+        self.pb.setFormat(("%p%, " if total else "") + self.meter.describe())
+
+    def setFinished(self):
+        self.pb.setMaximum(max(self.pb.maximum(), 1))
+        self.pb.setValue(self.pb.maximum())
+        self.pb.setFormat(formatBytes(self.meter.done) if self.meter.done else "Done")
+
+class ProgressPanel(QWidget):
+    """A LabelledProgressBar for each phase (or each branch) of a PipelineWorker, added as each first reports"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.bars = {}
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.layout.setContentsMargins(0, 0, 0, 0)
+
+    def addBar(self, name: str) -> LabelledProgressBar:
+        if name not in self.bars:
+            self.bars[name] = LabelledProgressBar(name, self)
+            self.layout.addWidget(self.bars[name])
+        return self.bars[name]
+
+    def updateProgress(self, name: str, done: int, total: int):
+        # Connect PipelineWorker.progressChanged here
+        self.addBar(name).setProgress(done, total)
+
+    def setFinished(self):
+        for bar in self.bars.values():
+            bar.setFinished()
+
+    def clear(self):
+        for bar in self.bars.values():
+            self.layout.removeWidget(bar)
+            bar.deleteLater()
+        self.bars = {}
 
 class DirectorySelector(QWidget):
     def __init__(self, parent: typing.Optional[QWidget] = None, caption: str = None, directory: str = None):
@@ -0,0 +1,84 @@
+import traceback
+import typing
+
+from PyQt5 import QtCore
+
+from progressmodel import PipelineCancelled, ProgressThrottle
+from tracing import RunTrace
+
+# As pipeline.ProgressFunc, without importing pipeline.py, which the dialogs leave until there is something to run
+ProgressFunc = typing.Optional[typing.Callable[[int, int], None]]
+
+
+class PipelineWorker(QtCore.QThread):
+    """Runs a list of phases (download, extract, copy...) one after another on a background thread"""
+    # The phases must never touch a widget: everything goes back to the GUI thread through these signals
+    # Qt queues signals emitted from this thread, so the connected slots run on the GUI thread
+    logMessage = QtCore.pyqtSignal(str)
+    phaseStarted = QtCore.pyqtSignal(str)
+    progressChanged = QtCore.pyqtSignal(str, int, int)
+    succeeded = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.phases = []
+        self.currentPhase = ""
+        # If set, each phase is timed as a span of this trace (see tracing.py)
+        self.trace: RunTrace = None
+        # Only a few progress reports a second are worth a signal (see progressmodel.py)
+        self.throttle = ProgressThrottle()
+
+    def addPhase(self, name: str, func: typing.Callable[[], typing.Any]):
+        # func is called with no arguments, use self.log/self.progress inside it to report back
+        self.phases.append((name, func))
+
+    def addPhases(self, phases: typing.List[tuple]):
+        # Phases as put together by jobs.py, which report back through the functions they are given
+        for name, func in phases:
+            self.addPhase(name, lambda func=func: func(self.log, self.progressFor))
+
+    def log(self, text: str):
+        self.logMessage.emit(text)
+
+    def progress(self, done: int, total: int):
+        # Phases call this regularly, so it doubles as our cancellation point
+        if self.isInterruptionRequested():
+            raise PipelineCancelled("Cancelled during \"{}\"".format(self.currentPhase))
+        if self.throttle.isDue(self.currentPhase, done, total):
+            self.progressChanged.emit(self.currentPhase, done, total)
+
+    def progressFor(self, name: str) -> ProgressFunc:
+        # For a phase doing several things at once (e.g. downloading several branches), each reporting separately
+        def progress(done: int, total: int):
+            if self.isInterruptionRequested():
+                raise PipelineCancelled("Cancelled during \"{}\"".format(self.currentPhase))
+            if self.throttle.isDue(name, done, total):
+                self.progressChanged.emit(name, done, total)
+        return progress
+
+    def run(self):
+        try:
+            for name, func in self.phases:
+                if self.isInterruptionRequested():
+                    raise PipelineCancelled("Cancelled before \"{}\"".format(name))
+                self.currentPhase = name
+                self.phaseStarted.emit(name)
+                if self.trace is not None:
+                    with self.trace.span(name, isPhase=True):
+                        func()
+                else:
+                    func()
+        except Exception as ex:
+            # An uncaught exception in QThread.run() would just be lost, so pass it back to the dialog instead
+            traceback.print_exc()
+            self.failed.emit(str(ex))
+            return
+        self.succeeded.emit()
+
+    def stop(self, timeout: int = 5000):
+        # Ask the worker to stop at its next cancellation point, and wait for it
+        # (a QThread must not be destroyed while it is still running)
+        if self.isRunning():
+            self.requestInterruption()
+            self.wait(timeout)